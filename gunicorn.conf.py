@@ -0,0 +1,21 @@
+"""
+gunicorn settings, read from the working directory: ``gunicorn sbf.wsgi``.
+
+The app is loaded and warmed up once in the master (preload_app, main.warmup
+via sbf/wsgi.py) and the workers fork from that warm copy.
+"""
+import gc
+
+preload_app = True
+
+
+def when_ready(server):
+    # Everything loaded so far is shared with the workers. Freezing it keeps
+    # the garbage collector from writing to those pages, which would copy them.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from main import warmup
+
+    warmup.connect()
@@ -1,7 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or getattr(settings, 'DATABASE_PROFILE', 'stock') == 'stock':
+        return
+    # On the raw connection: these aren't request queries, keep them out of query counts
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
 
 
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
 
+    def ready(self):
+        from . import metrics, timing
+
+        connection_created.connect(apply_sqlite_pragmas, dispatch_uid='main.apply_sqlite_pragmas')
+        connection_created.connect(metrics.install_query_hook, dispatch_uid='main.metrics.install_query_hook')
+        connection_created.connect(timing.install_query_hook, dispatch_uid='main.timing.install_query_hook')
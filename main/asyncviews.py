@@ -0,0 +1,110 @@
+"""
+Async GET handlers for the busiest read views, for ASGI deployments.
+
+DRF's APIView is synchronous: under an ASGI server each request to one
+holds a thread for its whole duration. Views with AsyncReadMixin also
+define ``aget()``, a native async version of ``get()`` written against the
+async ORM, and when settings.ASYNC_READ_VIEWS is on (sbf.asgi turns it on)
+their URL serves GETs through it. Catalog cache hits then never leave the
+event loop, and a request only borrows a thread for the queries themselves.
+
+The async path goes through the same DRF machinery (content negotiation,
+authentication, permissions, exception handling, response finalization),
+so responses are the same either way. Requests it can't serve natively go
+to the DRF view, run in a thread as before: other methods, renderers other
+than JSON (the browsable API), Basic auth credentials and authenticators
+with neither an async path here nor ``aauthenticate()``.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication, get_authorization_header
+
+
+class AsyncReadMixin:
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        if not settings.ASYNC_READ_VIEWS:
+            return view
+        sync_view = sync_to_async(view)
+
+        async def async_view(request, *args, **kwargs):
+            if request.method == "GET":
+                self = cls(**initkwargs)
+                self.setup(request, *args, **kwargs)
+                response = await self.adispatch(request, *args, **kwargs)
+                if response is not None:
+                    return response
+            return await sync_view(request, *args, **kwargs)
+
+        # What as_view() sets, for resolvers, middleware (main.routers) and schema generators
+        async_view.view_class = async_view.cls = cls
+        async_view.view_initkwargs = async_view.initkwargs = initkwargs
+        return csrf_exempt(async_view)
+
+    async def adispatch(self, request, *args, **kwargs):
+        """
+        dispatch() for GET through ``aget()``. None when the request should
+        go to the DRF view instead.
+        """
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            self.format_kwarg = self.get_format_suffix(**kwargs)
+            request.accepted_renderer, request.accepted_media_type = self.perform_content_negotiation(request)
+        except exceptions.NotAcceptable:
+            return None
+        if request.accepted_renderer.format != "json":
+            return None
+        request.version, request.versioning_scheme = self.determine_version(request, *args, **kwargs)
+
+        try:
+            if not await self.aperform_authentication(request):
+                return None
+            self.check_permissions(request)
+            self.check_throttles(request)
+            response = await self.aget(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return self.finalize_response(request, response, *args, **kwargs)
+
+    async def aperform_authentication(self, request):
+        """
+        perform_authentication() with async authenticators. False if one of
+        them can only run synchronously.
+        """
+        for authenticator in request.authenticators:
+            if hasattr(authenticator, "aauthenticate"):
+                user_auth_tuple = await authenticator.aauthenticate(request)
+            elif isinstance(authenticator, SessionAuthentication) and hasattr(request._request, "auser"):
+                user_auth_tuple = await authenticate_session(authenticator, request)
+            elif isinstance(authenticator, BasicAuthentication) and not has_basic_credentials(request):
+                continue
+            else:
+                return False
+            if user_auth_tuple is not None:
+                request._authenticator = authenticator
+                request.user, request.auth = user_auth_tuple
+                return True
+        request._not_authenticated()
+        return True
+
+
+async def authenticate_session(authenticator, request):
+    """SessionAuthentication.authenticate() through AuthenticationMiddleware's ``auser()``."""
+    user = await request._request.auser()
+    if not user or not user.is_active:
+        return None
+    authenticator.enforce_csrf(request)
+    return (user, None)
+
+
+def has_basic_credentials(request):
+    auth = get_authorization_header(request).split()
+    return bool(auth) and auth[0].lower() == b"basic"
@@ -0,0 +1,317 @@
+"""
+Endpoint benchmarks with query budgets.
+
+SCENARIOS holds one representative request per route and method of
+sbf/urls.py, with the status it must answer and the most SQL statements it
+may run, savepoints and BEGINs included, so that it holds both inside a test
+transaction and in autocommit. seed() fills the database with a catalog and
+carts of 1 to ``max_lines`` lines; run() sends
+every scenario through the Django test client and reports latency
+percentiles and queries per request. Budgets must not depend on the amount
+of data, so main.tests.QueryBudgetTests checks them on a small catalog and
+``manage.py bench_endpoints`` on a large one.
+"""
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.test import Client
+from django.urls import reverse
+
+from . import metrics, tokens
+from .cache import catalog_cache
+from .models import Cart, CartItem, Items, User
+
+ADJECTIVES = ["red", "small", "classic", "organic", "wireless", "vintage", "compact", "deluxe"]
+NOUNS = ["lamp", "mug", "chair", "backpack", "keyboard", "kettle", "jacket", "notebook", "speaker", "blanket"]
+
+
+class Dataset:
+    """What seed() created: item ids and slugs in id order, shoppers with carts and a spare user."""
+
+    def __init__(self, run, items, users, spare, max_lines, rng):
+        self.run = run
+        self.item_ids = [item_id for item_id, _ in items]
+        self.slugs = [slug for _, slug in items]
+        self.users = users
+        self.spare = spare
+        self.max_lines = max_lines
+        self.rng = rng
+
+    def user(self, n):
+        return self.users[n % len(self.users)]
+
+    def auth(self, user):
+        """Authorization header with a signed token; the token version is cached, as for an active user."""
+        tokens.current_version(user.pk)
+        return {"HTTP_AUTHORIZATION": f"Token {tokens.issue(user)}"}
+
+    def random_lines(self):
+        count = self.rng.randint(1, min(self.max_lines, len(self.item_ids)))
+        return [(item_id, "add", self.rng.randint(1, 3)) for item_id in self.rng.sample(self.item_ids, count)]
+
+
+def seed(items=10_000, carts=100, max_lines=200, seed=0, batch_size=5000):
+    """Create ``items`` items and ``carts`` users, each with a cart of 1 to ``max_lines`` lines."""
+    rng = random.Random(seed)
+    run = uuid.uuid4().hex[:6]
+    for start in range(0, items, batch_size):
+        Items.objects.bulk_create([
+            Items(
+                item_name=f"{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {i}",
+                item_description=f"A {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} for benchmarks.",
+                price=Decimal(rng.randint(99, 99_999)) / 100,
+                slug=f"bn{run}-{i}",
+            )
+            for i in range(start, min(items, start + batch_size))
+        ], batch_size=batch_size)
+    created = list(Items.objects.filter(slug__startswith=f"bn{run}-").order_by("id").values_list("id", "slug"))
+
+    users = [User(username=f"bn{run}-{i}", user_password="bench") for i in range(carts + 1)]
+    User.objects.bulk_create(users, batch_size=batch_size)
+    users, spare = users[:-1], users[-1]
+    Cart.objects.bulk_create([Cart(user=user) for user in users], batch_size=batch_size)
+
+    data = Dataset(run, created, users, spare, max_lines, rng)
+    cart_ids = list(Cart.objects.filter(user__in=users).values_list("id", flat=True))
+    lines = []
+    for cart_id in cart_ids:
+        lines += [CartItem(cart_id=cart_id, item_id=item_id, quantity=quantity) for item_id, _, quantity in data.random_lines()]
+        if len(lines) >= batch_size:
+            CartItem.objects.bulk_create(lines, batch_size=batch_size)
+            lines = []
+    CartItem.objects.bulk_create(lines, batch_size=batch_size)
+    Cart.objects.filter(pk__in=cart_ids).recompute_totals()
+    return data
+
+
+class Scenario:
+    def __init__(self, url_name, method, budget, request, status=200, prepare=None, name=None):
+        self.url_name = url_name
+        self.method = method
+        self.budget = budget
+        # request(data, n, prepared) -> (path, JSON body or None, extra headers)
+        self.request = request
+        self.status = status
+        # prepare(data, n) runs before each request, untimed; its result is passed on
+        self.prepare = prepare
+        self.name = name or f"{method} {url_name}"
+
+
+SCENARIOS = []
+
+
+def scenario(url_name, method, budget, **kwargs):
+    def register(request):
+        SCENARIOS.append(Scenario(url_name, method, budget, request, **kwargs))
+        return request
+    return register
+
+
+def cold_catalog(data, n):
+    catalog_cache.bump()
+
+
+def filled_cart(data, n):
+    user = data.user(n)
+    Cart.objects.get(user=user).apply_changes(data.random_lines(), replace=True)
+    return user
+
+
+def cart_line(data, n):
+    user = data.user(n)
+    slug = data.rng.choice(data.slugs)
+    CartItem.objects.add(Cart.objects.get(user=user), slug, 1)
+    return user, slug
+
+
+def fresh_token(data, n):
+    # Logging out revoked the previous one
+    data.spare.refresh_from_db(fields=["token_version"])
+
+
+def throwaway_item(data, n):
+    return Items.objects.create(item_name=f"Throwaway {n}", price=1).pk
+
+
+def client_address(n):
+    # Every sign-in from its own address, or the IP rate limits would kick in
+    return {"REMOTE_ADDR": f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}"}
+
+
+@scenario("register", "POST", budget=3, status=201)
+def register(data, n, prepared):
+    return reverse("register"), {"username": f"bn{data.run}-r{n}", "user_password": "bench"}, client_address(n)
+
+
+@scenario("login", "POST", budget=5)
+def login(data, n, prepared):
+    return reverse("login"), {"username": data.user(n).username, "user_password": "bench"}, client_address(n)
+
+
+@scenario("logout", "POST", budget=1, prepare=fresh_token)
+def logout(data, n, prepared):
+    return reverse("logout"), None, data.auth(data.spare)
+
+
+@scenario("item_list", "GET", budget=3, prepare=cold_catalog, name="GET item_list (cold)")
+def item_list(data, n, prepared):
+    sort = ["name", "-price", "-created"][n % 3]
+    return f"{reverse('item_list')}?sort={sort}&page_size=20", None, {}
+
+
+@scenario("item_list", "GET", budget=0, name="GET item_list (cached)")
+def item_list_cached(data, n, prepared):
+    return f"{reverse('item_list')}?page_size=20", None, {}
+
+
+@scenario("item_list", "POST", budget=6, status=201)
+def item_create(data, n, prepared):
+    return reverse("item_list"), {"item_name": f"Bench new {n}", "price": "9.99"}, {}
+
+
+@scenario("item_search", "GET", budget=2, prepare=cold_catalog)
+def item_search(data, n, prepared):
+    return f"{reverse('item_search')}?q={NOUNS[n % len(NOUNS)]}", None, {}
+
+
+@scenario("item_export", "GET", budget=1)
+def item_export(data, n, prepared):
+    # The last 500 items, as a client resuming an export would ask
+    after_id = data.item_ids[max(0, len(data.item_ids) - 501)]
+    return f"{reverse('item_export')}?after_id={after_id}", None, {}
+
+
+@scenario("item_detail", "GET", budget=2, prepare=cold_catalog)
+def item_detail(data, n, prepared):
+    return reverse("item_detail", args=[data.rng.choice(data.item_ids)]), None, {}
+
+
+@scenario("item_detail", "PUT", budget=5)
+def item_update(data, n, prepared):
+    return reverse("item_detail", args=[data.rng.choice(data.item_ids)]), {"price": f"{n % 100}.50"}, {}
+
+
+@scenario("item_detail", "DELETE", budget=8, prepare=throwaway_item)
+def item_delete(data, n, prepared):
+    return reverse("item_detail", args=[prepared]), None, {}
+
+
+@scenario("cart", "GET", budget=2)
+def cart(data, n, prepared):
+    return reverse("cart"), None, data.auth(data.user(n))
+
+
+@scenario("cart", "POST", budget=9, status=201)
+def cart_add(data, n, prepared):
+    return reverse("cart"), {"slug": data.rng.choice(data.slugs), "quantity": 1}, data.auth(data.user(n))
+
+
+@scenario("cart", "PATCH", budget=12)
+def cart_patch(data, n, prepared):
+    operations = [{"slug": slug, "quantity": 2, "op": "set"} for slug in data.rng.sample(data.slugs, min(5, len(data.slugs)))]
+    return reverse("cart"), operations, data.auth(data.user(n))
+
+
+@scenario("cart", "DELETE", budget=10, prepare=cart_line)
+def cart_remove(data, n, prepared):
+    user, slug = prepared
+    return reverse("cart"), {"slug": slug}, data.auth(user)
+
+
+@scenario("cart_summary", "GET", budget=1)
+def cart_summary(data, n, prepared):
+    return reverse("cart_summary"), None, data.auth(data.user(n))
+
+
+@scenario("checkout", "POST", budget=9, status=201, prepare=filled_cart)
+def checkout(data, n, prepared):
+    return reverse("checkout"), None, {**data.auth(prepared), "HTTP_IDEMPOTENCY_KEY": f"bench-{data.run}-{n}"}
+
+
+@scenario("metrics", "GET", budget=0)
+def metrics_scrape(data, n, prepared):
+    return reverse("metrics"), None, {}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def start_server(args, name, env=None, timeout=30):
+    """
+    Run ``python -m <args>`` from BASE_DIR, with ``{port}`` in ``args``
+    replaced by a free local port, and wait until it accepts connections.
+    Returns the process and its base URL.
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    env = {"DJANGO_SETTINGS_MODULE": "sbf.settings", **os.environ, **(env or {})}
+    server = subprocess.Popen(
+        [sys.executable, "-m", *(arg.format(port=port) for arg in args)], cwd=settings.BASE_DIR, env=env,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"{name} exited on start; is it installed?")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"{name} did not start listening within {timeout}s")
+
+
+def run(data, scenarios=None, requests=50, host="localhost"):
+    """
+    Send ``requests`` requests per scenario, after one untimed warm-up;
+    yields a result dict per scenario. Streaming responses are read to the
+    end inside the timing. Latencies include the commit of write requests
+    only in autocommit: inside an outer transaction (a TestCase) nothing is
+    committed and the numbers are a lower bound.
+    """
+    client = Client(HTTP_HOST=host)
+    for scenario in SCENARIOS if scenarios is None else scenarios:
+        timings, queries, statuses = [], [], Counter()
+        for n in range(requests + 1):
+            prepared = scenario.prepare(data, n) if scenario.prepare else None
+            path, body, headers = scenario.request(data, n, prepared)
+            started = time.perf_counter()
+            with metrics.counting_queries() as counter:
+                response = client.generic(
+                    scenario.method, path, "" if body is None else json.dumps(body),
+                    content_type="application/json", **headers,
+                )
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            elapsed = time.perf_counter() - started
+            # Login and register set auth cookies; every request brings its own
+            client.cookies.clear()
+            if n == 0:
+                continue
+            timings.append(elapsed)
+            queries.append(counter.count)
+            statuses[response.status_code] += 1
+
+        yield {
+            "scenario": scenario,
+            "p50_ms": percentile(timings, 50) * 1000,
+            "p99_ms": percentile(timings, 99) * 1000,
+            "queries": max(queries),
+            "statuses": statuses,
+            "over_budget": max(queries) > scenario.budget,
+            "failed": sum(count for code, count in statuses.items() if code != scenario.status),
+        }
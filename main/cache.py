@@ -0,0 +1,120 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class CatalogCache:
+    """
+    Response cache for catalog reads, invalidated by a version counter.
+
+    Every key is namespaced by the current catalog version, so a write only
+    has to bump the counter (``bump()``) and all previously cached listings
+    and item details become unreachable; they age out of the backend on
+    their own. Entries live in the Django cache alias named by
+    ``CATALOG_CACHE['ALIAS']`` (local memory, or a file-based backend to share
+    them between workers) with a bounded, per-process LRU in front of it so a
+    warm worker answers without touching the backend either. Only the
+    version counter is read from the backend on every lookup.
+    """
+    version_key = 'catalog:version'
+
+    def __init__(self, alias=None, local_max_entries=None):
+        options = getattr(settings, 'CATALOG_CACHE', {})
+        self.alias = alias or options.get('ALIAS', 'default')
+        self.local_max_entries = local_max_entries or options.get('LOCAL_MAX_ENTRIES', 256)
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def version(self):
+        version = self.backend.get(self.version_key)
+        if version is None:
+            # Seed from the clock rather than 1: if the counter is ever evicted,
+            # a fresh one must not collide with versions used before.
+            self.backend.add(self.version_key, time.time_ns() // 1000, timeout=None)
+            version = self.backend.get(self.version_key)
+        return version
+
+    def bump(self):
+        """Invalidate everything cached so far, now and again once the current transaction commits."""
+        self._bump()
+        # A reader that ran between the bump above and the commit may have
+        # cached pre-commit data under the new version, so bump once more.
+        transaction.on_commit(self._bump)
+
+    def _bump(self):
+        try:
+            self.backend.incr(self.version_key)
+        except ValueError:
+            self.backend.set(self.version_key, time.time_ns() // 1000, timeout=None)
+        with self._lock:
+            self._local.clear()
+
+    def make_key(self, key, version=None):
+        if version is None:
+            version = self.version()
+        digest = hashlib.md5(key.encode('utf-8'), usedforsecurity=False).hexdigest()
+        return f'catalog:{version}:{digest}'
+
+    def get(self, key):
+        full_key = self.make_key(key)
+        with self._lock:
+            value = self._local.get(full_key)
+            if value is not None:
+                self._local.move_to_end(full_key)
+                self.hits += 1
+                return value
+
+        value = self.backend.get(full_key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(full_key, value, hit=True)
+        return value
+
+    def set(self, key, value):
+        full_key = self.make_key(key)
+        self.backend.set(full_key, value)
+        self._remember(full_key, value)
+
+    def _remember(self, full_key, value, hit=False):
+        # Counters are only touched under the lock: += isn't atomic across threads
+        with self._lock:
+            self.hits += hit
+            self._local[full_key] = value
+            self._local.move_to_end(full_key)
+            while len(self._local) > self.local_max_entries:
+                self._local.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            entries, hits, misses = len(self._local), self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'alias': self.alias,
+            'version': self.version(),
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / lookups if lookups else 0.0,
+            'local_entries': entries,
+            'local_max_entries': self.local_max_entries,
+        }
+
+    def clear_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,39 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_etag(*parts):
+    """Strong, quoted ETag from cheap validators (counts, timestamps, request URL)."""
+    raw = ':'.join('' if part is None else str(part) for part in parts)
+    return '"%s"' % hashlib.md5(raw.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+def latest(*timestamps):
+    timestamps = [ts for ts in timestamps if ts is not None]
+    return max(timestamps) if timestamps else None
+
+
+def conditional_response(request, etag, last_modified=None):
+    """
+    304/412 response if the request's preconditions already settle it, else None.
+
+    ``last_modified`` is a datetime (or None). Runs before the payload is
+    built, so a revalidation costs the validator lookup and nothing more.
+    """
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
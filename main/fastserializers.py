@@ -0,0 +1,142 @@
+"""
+Read-only fast path for list responses.
+
+FastListSerializer mirrors a DRF serializer for output only: it reads
+``values_list()`` rows and converts each value through a plan built once
+from the serializer's fields, skipping model instances, bound field objects
+and per-value ``to_representation()`` dispatch. Rendered with render_json()
+(DRF's JSONRenderer), the bytes match what the DRF serializer would produce;
+main.tests.FastListSerializerTests keeps it that way.
+"""
+import decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+from . import renditions
+from .serializers import RenditionsField
+
+
+class FastListSerializer:
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._plan = None
+
+    @property
+    def plan(self):
+        """
+        ``[(key, column index, converter or None)]`` in output order; built
+        on first use. Converters marked ``per_timezone`` take the time zone
+        and return the actual converter.
+        """
+        if self._plan is None:
+            self._plan, self._columns = build_plan(self.serializer_class)
+        return self._plan
+
+    @property
+    def columns(self):
+        if self._plan is None:
+            self._plan, self._columns = build_plan(self.serializer_class)
+        return self._columns
+
+    def rows(self, queryset):
+        """``queryset`` narrowed to the columns the plan reads, as named rows (for cursor positions)."""
+        return queryset.values_list(*self.columns, named=True)
+
+    def to_representation(self, rows):
+        # Datetime converters are bound to the active time zone once per call
+        tz = timezone.get_current_timezone()
+        plan = [
+            (key, index, convert(tz) if getattr(convert, "per_timezone", False) else convert)
+            for key, index, convert in self.plan
+        ]
+        data = []
+        for row in rows:
+            item = {}
+            for key, index, convert in plan:
+                value = row[index]
+                item[key] = value if convert is None or value is None else convert(value)
+            data.append(item)
+        return data
+
+
+def render_json(data):
+    """JSON bytes exactly as DRF's JSONRenderer writes them for API responses."""
+    return JSONRenderer().render(data)
+
+
+def build_plan(serializer_class):
+    model = serializer_class.Meta.model
+    columns, plan = [], []
+    for key, field in serializer_class().fields.items():
+        if field.write_only:
+            continue
+        if "." in field.source or field.source == "*":
+            raise ImproperlyConfigured(f"{serializer_class.__name__}.{key}: the fast path only reads plain columns")
+        if field.source not in columns:
+            columns.append(field.source)
+        model_field = model._meta.get_field(field.source)
+        plan.append((key, columns.index(field.source), converter(field, model_field)))
+    return plan, tuple(columns)
+
+
+def converter(field, model_field):
+    """A function reproducing ``field.to_representation()`` for non-null database values."""
+    # Order matters: ImageField is a FileField, SlugField a CharField, ...
+    if isinstance(field, RenditionsField):
+        return renditions.urls
+    if isinstance(field, serializers.FileField):
+        if not getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL):
+            return lambda name: name or None
+        storage = model_field.storage
+        return lambda name: storage.url(name) if name else None
+    if isinstance(field, serializers.DecimalField):
+        return decimal_converter(field)
+    if isinstance(field, serializers.DateTimeField):
+        return datetime_converter(field)
+    if isinstance(field, (serializers.BooleanField, serializers.FloatField)):
+        return None
+    if isinstance(field, serializers.IntegerField):
+        return int
+    if isinstance(field, serializers.CharField) and type(field).to_representation is serializers.CharField.to_representation:
+        return str
+    raise ImproperlyConfigured(f"{type(field).__name__} has no fast-path converter")
+
+
+def decimal_converter(field):
+    coerce_to_string = getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+    if field.localize or field.normalize_output or not coerce_to_string:
+        return field.to_representation
+    exponent = decimal.Decimal(".1") ** field.decimal_places if field.decimal_places is not None else None
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        if exponent is not None:
+            value = value.quantize(exponent, rounding=rounding, context=context)
+        return "{:f}".format(value)
+    return convert
+
+
+def datetime_converter(field):
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601 or hasattr(field, "timezone") or not settings.USE_TZ:
+        return field.to_representation
+
+    def bind(tz):
+        def convert(value):
+            if value.utcoffset() is None:
+                return field.to_representation(value)
+            value = value.astimezone(tz).isoformat()
+            return value[:-6] + "Z" if value.endswith("+00:00") else value
+        return convert
+    bind.per_timezone = True
+    return bind
@@ -0,0 +1,161 @@
+"""
+Stock tracking for items.
+
+``Items.stock`` NULL means the item is not tracked. Otherwise the count only
+ever moves through conditional UPDATEs (``stock = stock - n WHERE stock >= n``),
+never read-modify-write, so concurrent reservations cannot oversell. Adding
+to a cart reserves, removing a line or expiring a cart releases, and checkout
+keeps the reservation.
+
+A very hot item can spread its count over ``stock_shards`` ItemStockShard
+rows; each reservation then locks one random shard row instead of the item
+row, so concurrent add-to-carts don't queue on a single lock.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+
+from .models import ItemStockShard, Items
+
+
+class OutOfStock(Exception):
+    def __init__(self, item_ids):
+        super().__init__(f"Not enough stock for items {sorted(item_ids)}")
+        self.item_ids = item_ids
+
+
+def reserve_slug(slug, quantity):
+    """
+    Reserve ``quantity`` of the item with ``slug``.
+
+    True if reserved (or the item is not tracked), False if there is no such
+    item; raises OutOfStock. One UPDATE for a tracked item in stock, plus one
+    SELECT otherwise.
+    """
+    if Items.objects.filter(slug=slug, stock__gte=quantity).update(stock=F("stock") - quantity):
+        return True
+    item = Items.objects.filter(slug=slug).values("id", "stock", "stock_shards").first()
+    if item is None:
+        return False
+    if item["stock_shards"]:
+        if reserve_from_shards(item["id"], item["stock_shards"], quantity):
+            return True
+    elif item["stock"] is None:
+        return True
+    raise OutOfStock([item["id"]])
+
+
+def change(deltas):
+    """
+    Apply ``{item_id: delta}``: positive deltas reserve, negative ones release.
+
+    All or nothing: raises OutOfStock naming every item short of stock.
+    Untracked items are skipped. One SELECT, one UPDATE for all the
+    reservations and one for all the releases (sharded items: a few per item).
+    """
+    deltas = {item_id: delta for item_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    tracked = Items.objects.filter(Q(stock__isnull=False) | Q(stock_shards__gt=0), id__in=deltas)
+    shards = dict(tracked.values_list("id", "stock_shards"))
+    if not shards:
+        return
+
+    plain = {item_id: deltas[item_id] for item_id, count in shards.items() if not count}
+    needed = {item_id: delta for item_id, delta in plain.items() if delta > 0}
+    returned = {item_id: -delta for item_id, delta in plain.items() if delta < 0}
+
+    with transaction.atomic():
+        if needed:
+            amount = per_item(needed)
+            reserved = Items.objects.filter(id__in=needed, stock__gte=amount).update(stock=F("stock") - amount)
+            if reserved < len(needed):
+                short = Items.objects.filter(id__in=needed).exclude(stock__gte=per_item(needed))
+                # Raising rolls back the reservations that did succeed
+                raise OutOfStock(list(short.values_list("id", flat=True)))
+        if returned:
+            Items.objects.filter(id__in=returned, stock__isnull=False).update(stock=F("stock") + per_item(returned))
+
+        short = []
+        for item_id, count in shards.items():
+            if not count:
+                continue
+            delta = deltas[item_id]
+            if delta < 0:
+                release_to_shard(item_id, count, -delta)
+            elif not reserve_from_shards(item_id, count, delta):
+                short.append(item_id)
+        if short:
+            raise OutOfStock(short)
+
+
+def release(deltas):
+    """Give back ``{item_id: quantity}`` reserved earlier."""
+    change({item_id: -quantity for item_id, quantity in deltas.items()})
+
+
+def per_item(amounts):
+    return Case(
+        *[When(id=item_id, then=Value(amount)) for item_id, amount in amounts.items()],
+        output_field=IntegerField(),
+    )
+
+
+def reserve_from_shards(item_id, shards, quantity):
+    start = random.randrange(shards)
+    for offset in range(shards):
+        shard = (start + offset) % shards
+        if ItemStockShard.objects.filter(item_id=item_id, shard=shard, stock__gte=quantity).update(
+            stock=F("stock") - quantity
+        ):
+            return True
+
+    # No single shard holds enough (the item is nearly sold out): take it
+    # across shards with all of them locked.
+    with transaction.atomic():
+        rows = list(ItemStockShard.objects.select_for_update().filter(item_id=item_id).order_by("shard"))
+        if sum(row.stock for row in rows) < quantity:
+            return False
+        remaining = quantity
+        for row in rows:
+            taken = min(row.stock, remaining)
+            row.stock -= taken
+            remaining -= taken
+        ItemStockShard.objects.bulk_update(rows, ["stock"])
+    return True
+
+
+def release_to_shard(item_id, shards, quantity):
+    ItemStockShard.objects.filter(item_id=item_id, shard=random.randrange(shards)).update(stock=F("stock") + quantity)
+
+
+def available(item):
+    """Units left to reserve, or None if the item is not tracked."""
+    if item.stock_shards:
+        return ItemStockShard.objects.filter(item=item).aggregate(total=Sum("stock"))["total"] or 0
+    return Items.objects.filter(pk=item.pk).values_list("stock", flat=True).first()
+
+
+def set_stock(item, count, shards=None):
+    """
+    Set the units of ``item`` left to reserve; ``None`` stops tracking it.
+
+    With ``shards`` > 1 the count is split over that many shard rows.
+    Reservations already held by carts are not included in ``count``.
+    """
+    with transaction.atomic():
+        # Serializes concurrent set_stock() calls on the item
+        list(Items.objects.select_for_update().filter(pk=item.pk).values_list("pk"))
+        ItemStockShard.objects.filter(item=item).delete()
+        if count is not None and shards and shards > 1:
+            base, extra = divmod(count, shards)
+            ItemStockShard.objects.bulk_create([
+                ItemStockShard(item=item, shard=shard, stock=base + (shard < extra)) for shard in range(shards)
+            ])
+            Items.objects.filter(pk=item.pk).update(stock=None, stock_shards=shards)
+        else:
+            shards = None
+            Items.objects.filter(pk=item.pk).update(stock=count, stock_shards=None)
+    item.stock = None if shards else count
+    item.stock_shards = shards
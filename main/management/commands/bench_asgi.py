@@ -0,0 +1,117 @@
+import asyncio
+import time
+import uuid
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import tokens
+from main.benchmarks import percentile, start_server
+from main.models import Cart, Items, User
+
+ROUTES = ("item_list", "item_detail", "cart")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the catalog and cart GETs under an ASGI server (uvicorn) served by the DRF "
+        "views (ASYNC_READ_VIEWS=0) and by the async views (ASYNC_READ_VIEWS=1, "
+        "main.asyncviews). Many clients share few worker processes, each request on its own "
+        "connection. Read only; a temporary shopper is created and removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000, help="Requests per mode (default 2000).")
+        parser.add_argument("--concurrency", type=int, default=200, help="Requests in flight (default 200).")
+        parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (default 1).")
+        parser.add_argument("--route", action="append", choices=ROUTES, help="Only these routes (repeatable).")
+        parser.add_argument("--host", default="localhost", help="Host header, must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        if min(options["requests"], options["concurrency"], options["workers"]) < 1:
+            raise CommandError("--requests, --concurrency and --workers must be >= 1")
+        item_ids = list(Items.objects.order_by("id").values_list("id", flat=True)[:500])
+        if not item_ids:
+            raise CommandError("The catalog is empty")
+
+        user = User.objects.create(username=f"asgi-bench-{uuid.uuid4().hex[:6]}", user_password="-")
+        Cart.objects.ensure_for_user(user)
+        try:
+            requests = self.requests(options, item_ids, f"Token {tokens.issue(user)}")
+            self.stdout.write(f"{'mode':6} {'route':12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}  statuses")
+            for mode, flag in (("sync", "0"), ("async", "1")):
+                self.bench(mode, flag, requests, options)
+        finally:
+            user.delete()
+
+    def requests(self, options, item_ids, auth):
+        """(route, path, headers) of every request, cycling through the routes."""
+        routes = options["route"] or ROUTES
+        requests = []
+        for n in range(options["requests"]):
+            route = routes[n % len(routes)]
+            if route == "item_list":
+                # 50 distinct pages: mostly catalog cache hits, as in production
+                requests.append((route, f"/item_list/?page_size={n % 50 + 1}", {}))
+            elif route == "item_detail":
+                requests.append((route, f"/item/{item_ids[n % len(item_ids)]}/", {}))
+            else:
+                requests.append((route, "/cart/", {"Authorization": auth}))
+        return requests
+
+    def bench(self, mode, flag, requests, options):
+        try:
+            server, url = start_server(
+                ["uvicorn", "sbf.asgi:application", "--port", "{port}", "--workers", str(options["workers"]),
+                 "--log-level", "warning", "--no-access-log"],
+                "uvicorn", env={"ASYNC_READ_VIEWS": flag},
+            )
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+        port = urlsplit(url).port
+        try:
+            # Untimed: imports, connections and the catalog cache
+            asyncio.run(self.load(port, options["host"], requests[:100], options["concurrency"]))
+            started = time.perf_counter()
+            results = asyncio.run(self.load(port, options["host"], requests, options["concurrency"]))
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait(10)
+
+        routes = defaultdict(list)
+        statuses = defaultdict(Counter)
+        for route, status, duration in results:
+            routes[route].append(duration)
+            statuses[route][status] += 1
+        self.stdout.write(
+            f"{mode:6} {'all':12} {len(results) / elapsed:>8.1f} "
+            f"{percentile([d for _, _, d in results], 50) * 1000:>8.1f} {percentile([d for _, _, d in results], 99) * 1000:>8.1f}"
+        )
+        for route, durations in routes.items():
+            self.stdout.write(
+                f"{mode:6} {route:12} {'':>8} {percentile(durations, 50) * 1000:>8.1f} "
+                f"{percentile(durations, 99) * 1000:>8.1f}  {dict(statuses[route])}"
+            )
+
+    async def load(self, port, host, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(route, path, headers):
+            lines = [f"GET {path} HTTP/1.1", f"Host: {host}", "Connection: close"]
+            lines += [f"{name}: {value}" for name, value in headers.items()]
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+                    await writer.drain()
+                    status = int((await reader.readline()).split()[1])
+                    await reader.read()
+                    writer.close()
+                except (OSError, IndexError, ValueError) as exc:
+                    status = type(exc).__name__
+                return route, status, time.perf_counter() - started
+
+        return await asyncio.gather(*(fetch(*request) for request in requests))
@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+
+from main import tokens
+from main.benchmarks import percentile
+from main.models import Items, ItemTombstone, User
+from sbf.databases import PROFILES
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare concurrent cart-write throughput (POST and PATCH /cart/) across database "
+        "profiles (DATABASE_PROFILE). Each profile runs in its own process; on SQLite each "
+        "gets a fresh copy of the database, since WAL mode sticks to the file. On PostgreSQL "
+        "the runs use the configured database and remove their data afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", default=",".join(PROFILES), help=f"Comma separated (default {','.join(PROFILES)}).")
+        parser.add_argument("--requests", type=int, default=500, help="Cart writes per profile (default 500).")
+        parser.add_argument("--workers", type=int, default=16, help="Concurrent threads (default 16).")
+        parser.add_argument("--users", type=int, default=50, help="Distinct shoppers (default 50).")
+        parser.add_argument("--items", type=int, default=200, help="Items to put in carts (default 200).")
+        parser.add_argument("--host", default="localhost", help="Host header, must be in ALLOWED_HOSTS.")
+        parser.add_argument("--single", action="store_true", help="Run once in this process's profile and print JSON (used internally).")
+
+    def handle(self, *args, **options):
+        if min(options["requests"], options["workers"], options["users"], options["items"]) < 1:
+            raise CommandError("--requests, --workers, --users and --items must be >= 1")
+        if options["single"]:
+            self.stdout.write(json.dumps(self.run(options)))
+            return
+
+        profiles = [p.strip() for p in options["profiles"].split(",") if p.strip()]
+        unknown = set(profiles) - set(PROFILES)
+        if unknown:
+            raise CommandError(f"Unknown profiles: {', '.join(sorted(unknown))}")
+
+        self.stdout.write(f"{'profile':12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}  outcomes")
+        for profile in profiles:
+            result = self.run_profile(profile, options)
+            self.stdout.write(
+                f"{profile:12} {result['throughput']:>8.1f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f}  {result['outcomes']}"
+            )
+
+    def run_profile(self, profile, options):
+        env = {**os.environ, "DATABASE_PROFILE": profile}
+        tmpdir = None
+        primary = settings.DATABASES["default"]
+        if primary["ENGINE"] == "django.db.backends.sqlite3":
+            tmpdir = tempfile.mkdtemp()
+            copy = Path(tmpdir) / "bench.sqlite3"
+            shutil.copyfile(primary["NAME"], copy)
+            env["DATABASE_URL"] = f"sqlite:///{copy}"
+        # Replicas play no part in writes
+        env.pop("DATABASE_REPLICA_URLS", None)
+
+        command = [
+            sys.executable, str(Path(settings.BASE_DIR) / "manage.py"), "bench_cart_writes", "--single",
+            "--requests", str(options["requests"]), "--workers", str(options["workers"]),
+            "--users", str(options["users"]), "--items", str(options["items"]), "--host", options["host"],
+        ]
+        try:
+            finished = subprocess.run(command, env=env, capture_output=True, text=True)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir)
+        if finished.returncode != 0:
+            raise CommandError(f"{profile} run failed:\n{finished.stderr}")
+        return json.loads(finished.stdout.strip().splitlines()[-1])
+
+    def run(self, options):
+        run = uuid.uuid4().hex[:6]
+        Items.objects.bulk_create([Items(item_name=f"Write bench {i}", price=1, slug=f"wb{run}-{i}") for i in range(options["items"])])
+        slugs = [f"wb{run}-{i}" for i in range(options["items"])]
+        users = [User(username=f"wb{run}-{i}", user_password="-") for i in range(options["users"])]
+        User.objects.bulk_create(users)
+        headers = [{"HTTP_AUTHORIZATION": f"Token {tokens.issue(user)}"} for user in users]
+
+        def write(n):
+            client = Client(HTTP_HOST=options["host"])
+            auth = headers[n % len(headers)]
+            started = time.perf_counter()
+            try:
+                if n % 4:
+                    response = client.post("/cart/", {"slug": slugs[n % len(slugs)], "quantity": 1}, content_type="application/json", **auth)
+                else:
+                    operations = [{"slug": slugs[(n + k) % len(slugs)], "quantity": 2, "op": "set"} for k in range(3)]
+                    response = client.patch("/cart/", operations, content_type="application/json", **auth)
+                outcome = response.status_code
+            except Exception as exc:
+                outcome = f"{type(exc).__name__}: {exc}"
+            return outcome, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["workers"]) as pool:
+            results = list(pool.map(write, range(options["requests"])))
+        elapsed = time.perf_counter() - started
+        connections.close_all()
+
+        User.objects.filter(username__startswith=f"wb{run}-").delete()
+        item_ids = list(Items.objects.filter(slug__startswith=f"wb{run}-").values_list("id", flat=True))
+        Items.objects.filter(id__in=item_ids).delete()
+        ItemTombstone.objects.filter(item_id__in=item_ids).delete()
+
+        durations = [duration for _, duration in results]
+        return {
+            "throughput": len(results) / elapsed,
+            "p50_ms": percentile(durations, 50) * 1000,
+            "p99_ms": percentile(durations, 99) * 1000,
+            "outcomes": dict(Counter(str(outcome) for outcome, _ in results)),
+        }
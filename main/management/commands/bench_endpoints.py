@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from main import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a catalog and carts, then measure p50/p99 latency and queries per request of "
+        "every route (main.benchmarks.SCENARIOS). Fails when a route runs more queries than "
+        "its budget or answers with an unexpected status. Runs against throwaway test "
+        "databases (as manage.py test creates them), in autocommit, so every write request "
+        "pays for its commit."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--items", type=int, default=10_000, help="Items to seed (default 10000).")
+        parser.add_argument("--carts", type=int, default=100, help="Shoppers with a cart (default 100).")
+        parser.add_argument("--max-lines", type=int, default=200, help="Lines per cart, 1 to this (default 200).")
+        parser.add_argument("--requests", type=int, default=50, help="Requests per scenario (default 50).")
+        parser.add_argument("--route", action="append", help="Only these URL names (repeatable).")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed of the generated data.")
+        parser.add_argument("--host", default="localhost", help="Host header, must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        if min(options["items"], options["carts"], options["max_lines"], options["requests"]) < 1:
+            raise CommandError("--items, --carts, --max-lines and --requests must be >= 1")
+        scenarios = benchmarks.SCENARIOS
+        if options["route"]:
+            scenarios = [s for s in scenarios if s.url_name in options["route"]]
+            if not scenarios:
+                raise CommandError(f"No scenarios for {', '.join(options['route'])}")
+
+        verbosity = options["verbosity"]
+        old_config = setup_databases(verbosity, interactive=False)
+        try:
+            failures = self.run(scenarios, options)
+        finally:
+            teardown_databases(old_config, verbosity)
+        if failures:
+            raise CommandError(f"{len(failures)} scenario(s) failed: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Every route is within its query budget."))
+
+    def run(self, scenarios, options):
+        started = time.perf_counter()
+        data = benchmarks.seed(options["items"], options["carts"], options["max_lines"], seed=options["seed"])
+        self.stdout.write(f"Seeded {options['items']} items and {options['carts']} carts in {time.perf_counter() - started:.1f}s")
+
+        self.stdout.write(f"{'scenario':28} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8} {'budget':>7}  statuses")
+        failures = []
+        for result in benchmarks.run(data, scenarios, options["requests"], options["host"]):
+            scenario = result["scenario"]
+            line = (
+                f"{scenario.name:28} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+                f"{result['queries']:>8} {scenario.budget:>7}  {dict(result['statuses'])}"
+            )
+            if result["over_budget"] or result["failed"]:
+                failures.append(scenario.name)
+                line = self.style.ERROR(line)
+            self.stdout.write(line)
+        return failures
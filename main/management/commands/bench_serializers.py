@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main.fastserializers import FastListSerializer, render_json
+from main.models import Items
+from main.serializers import ItemsSerializer, serializer_columns
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rows/sec of ItemsSerializer and the fast list path (FastListSerializer), "
+        "query plus serialization plus JSON encoding. Uses the catalog, topped up with "
+        "throwaway items inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5000, help="Rows per run (default 5000).")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per path; the best one counts (default 5).")
+
+    def handle(self, *args, **options):
+        if options["rows"] < 1 or options["repeat"] < 1:
+            raise CommandError("--rows and --repeat must be >= 1")
+        try:
+            with transaction.atomic():
+                self.run(options["rows"], options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, rows, repeat):
+        missing = rows - Items.objects.count()
+        if missing > 0:
+            Items.objects.bulk_create(
+                [Items(item_name=f"Bench item {i}", price=i % 1000, slug=f"bench-item-{i}") for i in range(missing)],
+                batch_size=500,
+            )
+
+        queryset = Items.objects.order_by("id")[:rows]
+        columns = serializer_columns(ItemsSerializer)
+        fast = FastListSerializer(ItemsSerializer)
+        paths = {
+            "ItemsSerializer": lambda: render_json(ItemsSerializer(queryset.only(*columns), many=True).data),
+            "FastListSerializer": lambda: render_json(fast.to_representation(fast.rows(queryset))),
+        }
+
+        results = {}
+        for name, path in paths.items():
+            path()  # warm up
+            best = min(self.timed(path) for _ in range(repeat))
+            results[name] = rows / best
+            self.stdout.write(f"{name:20} {rows / best:>12,.0f} rows/s  ({best * 1000:.1f}ms per {rows} rows)")
+        self.stdout.write(f"Speed-up: {results['FastListSerializer'] / results['ItemsSerializer']:.1f}x")
+
+    @staticmethod
+    def timed(path):
+        started = time.perf_counter()
+        path()
+        return time.perf_counter() - started
@@ -0,0 +1,55 @@
+import time
+import uuid
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from main.benchmarks import percentile
+from main.views import LoginAPIView
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure what the login rate limits (main.throttling) add to requests that are not "
+        "throttled: failed logins, each for another username from another address so no bucket "
+        "runs out, with the throttles and with them removed. Nothing is written to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000, help="Logins per run (default 2000).")
+        parser.add_argument("--rounds", type=int, default=3, help="Alternating runs of each (default 3).")
+        parser.add_argument("--host", default="localhost", help="Host header, must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        if options["requests"] < 1 or options["rounds"] < 1:
+            raise CommandError("--requests and --rounds must be >= 1")
+        client = Client(HTTP_HOST=options["host"])
+        timings = {"throttled": [], "unthrottled": []}
+        for _ in range(options["rounds"]):
+            timings["throttled"] += self.run(client, options["requests"])
+            with mock.patch.object(LoginAPIView, "throttle_classes", ()):
+                timings["unthrottled"] += self.run(client, options["requests"])
+
+        self.stdout.write(f"{'':12} {'p50 us':>8} {'p99 us':>8} {'mean us':>8}")
+        for name, durations in timings.items():
+            self.stdout.write(
+                f"{name:12} {percentile(durations, 50) * 1e6:>8.0f} {percentile(durations, 99) * 1e6:>8.0f} "
+                f"{sum(durations) / len(durations) * 1e6:>8.0f}"
+            )
+        overhead = percentile(timings["throttled"], 50) - percentile(timings["unthrottled"], 50)
+        self.stdout.write(self.style.SUCCESS(f"Rate limiting adds {overhead * 1e6:.0f}us per login at p50"))
+
+    def run(self, client, requests):
+        run = uuid.uuid4().hex[:8]
+        durations = []
+        for n in range(requests):
+            started = time.perf_counter()
+            response = client.post(
+                "/login/", {"username": f"nobody-{run}-{n}", "user_password": "-"}, content_type="application/json",
+                REMOTE_ADDR=f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}",
+            )
+            durations.append(time.perf_counter() - started)
+            if response.status_code != 401:
+                raise CommandError(f"Expected a failed login, got {response.status_code}")
+        return durations
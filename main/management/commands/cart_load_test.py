@@ -0,0 +1,74 @@
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Sum
+from django.test import Client
+
+from main import inventory, tokens
+from main.models import CartItem, Items, ItemTombstone, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent add-to-cart requests (POST /cart/) at one stock-tracked item "
+        "and check that stock is never oversold. Creates its own item and users in the "
+        "configured database and removes them afterwards; run it against staging."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stock", type=int, default=100, help="Units in stock (default 100).")
+        parser.add_argument("--shards", type=int, default=None, help="Use sharded stock with this many shards.")
+        parser.add_argument("--requests", type=int, default=300, help="Add-to-cart requests (default 300).")
+        parser.add_argument("--workers", type=int, default=32, help="Concurrent threads (default 32).")
+        parser.add_argument("--users", type=int, default=50, help="Distinct shoppers (default 50).")
+        parser.add_argument("--quantity", type=int, default=1, help="Units per request (default 1).")
+        parser.add_argument("--host", default="localhost", help="Host header, must be in ALLOWED_HOSTS.")
+        parser.add_argument("--keep", action="store_true", help="Keep the test item and users.")
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:8]
+        item = Items.objects.create(item_name=f"Load test {run}", price=1)
+        inventory.set_stock(item, options["stock"], shards=options["shards"])
+        users = [User(username=f"lt-{run}-{i}", user_password="-") for i in range(options["users"])]
+        User.objects.bulk_create(users)
+        headers = [{"HTTP_AUTHORIZATION": f"Token {tokens.issue(user)}"} for user in users]
+
+        def add_to_cart(n):
+            try:
+                response = Client(HTTP_HOST=options["host"]).post(
+                    "/cart/", {"slug": item.slug, "quantity": options["quantity"]},
+                    content_type="application/json", **headers[n % len(headers)],
+                )
+                return response.status_code
+            except Exception as exc:
+                return type(exc).__name__
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["workers"]) as pool:
+            outcomes = Counter(pool.map(add_to_cart, range(options["requests"])))
+        elapsed = time.perf_counter() - started
+
+        left = inventory.available(item)
+        in_carts = CartItem.objects.filter(item=item).aggregate(total=Sum("quantity"))["total"] or 0
+        added = outcomes[201] * options["quantity"]
+        self.stdout.write(
+            f"{options['requests']} requests in {elapsed:.2f}s ({options['requests'] / elapsed:.0f} req/s), "
+            f"outcomes: {dict(outcomes)}"
+        )
+        self.stdout.write(f"stock {options['stock']}: {left} left, {in_carts} in carts, {added} reported added")
+
+        if not options["keep"]:
+            User.objects.filter(username__startswith=f"lt-{run}-").delete()
+            item_id = item.pk
+            item.delete()
+            ItemTombstone.objects.filter(item_id=item_id).delete()
+
+        if left < 0 or left + in_carts != options["stock"] or in_carts != added:
+            raise CommandError("Stock counts are inconsistent")
+        self.stdout.write(self.style.SUCCESS("Stock counts are consistent."))
@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main.cache import catalog_cache
+from main.models import Cart, Items, render_picture
+from main.slugs import SlugAllocator, slug_base
+
+IMPORT_FIELDS = ("item_name", "price", "item_description", "item_picture", "slug")
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream items from a CSV or JSONL file into the catalog in batches. "
+        "Columns: item_name, price, item_description, item_picture, slug. With --update, "
+        "existing items only change in the columns a row gives. New and changed pictures "
+        "(paths under MEDIA_ROOT) are rendered after their batch is committed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSONL file, or '-' for stdin.")
+        parser.add_argument(
+            "--format", choices=("csv", "jsonl"),
+            help="Input format (default: guessed from the file extension).",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows per insert batch.")
+        parser.add_argument(
+            "--update", action="store_true",
+            help="Update items whose slug already exists instead of rejecting the row.",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be >= 1")
+        fmt = options["format"] or ("jsonl" if options["path"].endswith((".jsonl", ".ndjson")) else "csv")
+        self.update = options["update"]
+        self.verbosity = options["verbosity"]
+        self.stats = {"read": 0, "created": 0, "updated": 0, "rejected": 0, "batches": 0}
+
+        started = time.perf_counter()
+        with self.open(options["path"]) as stream:
+            rows = read_jsonl(stream) if fmt == "jsonl" else read_csv(stream)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                self.import_batch(batch)
+        elapsed = time.perf_counter() - started
+
+        stats = self.stats
+        rate = stats["read"] / elapsed if elapsed else 0.0
+        self.stdout.write(
+            f"Read {stats['read']} rows in {stats['batches']} batches ({elapsed:.2f}s, {rate:.0f} rows/s): "
+            f"{stats['created']} created, {stats['updated']} updated, {stats['rejected']} rejected."
+        )
+
+    def open(self, path):
+        if path == "-":
+            return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+        try:
+            return open(path, encoding="utf-8", newline="")
+        except OSError as e:
+            raise CommandError(f"Cannot open {path}: {e}")
+
+    def import_batch(self, batch):
+        self.stats["batches"] += 1
+        self.stats["read"] += len(batch)
+
+        cleaned = []
+        for line_no, row in batch:
+            try:
+                cleaned.append((line_no, clean_row(row)))
+            except ValidationError as e:
+                self.reject(line_no, "; ".join(e.messages))
+
+        # One query for the explicit slugs that already exist, one prefix
+        # query to allocate slugs for everything else.
+        explicit = {values["slug"] for _, values in cleaned if values.get("slug")}
+        existing = {
+            slug: (picture, picture_hash)
+            for slug, picture, picture_hash in Items.objects.filter(slug__in=explicit).values_list("slug", "item_picture", "picture_hash")
+        }
+        allocator = SlugAllocator(
+            Items.objects.all(),
+            [slug_base(values["item_name"]) for _, values in cleaned if not values.get("slug")],
+        )
+        for slug in explicit:
+            allocator.reserve(slug)
+
+        # Rows by the columns they give: an update only writes those
+        groups, seen, render = {}, set(), []
+        for line_no, values in cleaned:
+            slug = values.get("slug")
+            if slug:
+                if slug in seen:
+                    self.reject(line_no, f"duplicate slug {slug!r} in batch")
+                    continue
+                if slug in existing and not self.update:
+                    self.reject(line_no, f"slug {slug!r} already exists")
+                    continue
+            else:
+                values["slug"] = allocator.allocate(slug_base(values["item_name"]))
+            seen.add(values["slug"])
+            if "item_picture" in values:
+                picture, picture_hash = existing.get(values["slug"], (None, None))
+                # The old hash names the old picture's renditions
+                values["picture_hash"] = picture_hash if values["item_picture"] == picture else None
+                if values["picture_hash"] is None:
+                    render.append((values["slug"], values["item_picture"]))
+            groups.setdefault(frozenset(values), []).append(Items(**values))
+
+        if not groups:
+            return
+        objs = [obj for group in groups.values() for obj in group]
+        with transaction.atomic():
+            if self.update:
+                for columns, group in groups.items():
+                    Items.objects.bulk_create(
+                        group, update_conflicts=True, unique_fields=["slug"],
+                        update_fields=sorted(columns - {"slug"}) + ["updated_at"],
+                    )
+                # Carts holding a repriced item need new stored totals
+                repriced = [obj.slug for obj in objs if obj.slug in existing]
+                Cart.objects.filter(cart_items__item__slug__in=repriced).recompute_totals()
+            else:
+                Items.objects.bulk_create(objs)
+            # bulk_create bypasses Items.save()
+            catalog_cache.bump()
+        self.render_pictures(render)
+
+        updated = sum(1 for obj in objs if obj.slug in existing)
+        self.stats["updated"] += updated
+        self.stats["created"] += len(objs) - updated
+
+    def render_pictures(self, pictures):
+        """Renditions and hash of new and changed pictures, as an upload through Items.save() gets them."""
+        slugs = dict(pictures)
+        for pk, slug in Items.objects.filter(slug__in=slugs).values_list("pk", "slug"):
+            render_picture(Items, pk, slugs[slug])
+
+    def reject(self, line_no, reason):
+        self.stats["rejected"] += 1
+        if self.verbosity >= 1:
+            self.stderr.write(f"Line {line_no}: {reason}")
+
+
+def read_csv(stream):
+    # Line numbers count the header as line 1
+    for line_no, row in enumerate(csv.DictReader(stream), start=2):
+        yield line_no, row
+
+
+def read_jsonl(stream):
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = {"__error__": f"invalid JSON: {e}"}
+        if not isinstance(row, dict):
+            row = {"__error__": "expected a JSON object"}
+        yield line_no, row
+
+
+def clean_row(row):
+    """Validate one input row with the model's own field validators, without touching the database."""
+    if "__error__" in row:
+        raise ValidationError(row["__error__"])
+    values, errors = {}, []
+    for name in IMPORT_FIELDS:
+        value = row.get(name)
+        if value is None or value == "":
+            if name in ("item_name", "price"):
+                errors.append(f"{name}: this field is required")
+            continue
+        field = Items._meta.get_field(name)
+        try:
+            if name == "item_picture":
+                # Stored as a path relative to MEDIA_ROOT; the file is not read
+                value = str(value)
+                if len(value) > field.max_length:
+                    raise ValidationError(f"at most {field.max_length} characters")
+            else:
+                value = field.clean(value, None)
+        except ValidationError as e:
+            errors.append(f"{name}: {' '.join(e.messages)}")
+            continue
+        values[name] = value
+    if errors:
+        raise ValidationError(errors)
+    return values
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from main import inventory
+from main.models import Cart, CartItem
+
+
+class Command(BaseCommand):
+    help = (
+        "Empty carts that haven't changed for CART_RESERVATION_MINUTES and give "
+        "their reserved stock back. Meant to run from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--minutes", type=int, help="Override CART_RESERVATION_MINUTES.")
+        parser.add_argument("--batch-size", type=int, default=200, help="Carts released per transaction (default 200).")
+
+    def handle(self, *args, **options):
+        minutes = options["minutes"] or getattr(settings, "CART_RESERVATION_MINUTES", 60)
+        cutoff = timezone.now() - timedelta(minutes=minutes)
+        expired = Cart.objects.filter(updated_at__lt=cutoff, item_count__gt=0).order_by("id")
+        if connection.features.has_select_for_update_skip_locked:
+            # Carts being changed right now are not expired; leave them to the next run
+            expired = expired.select_for_update(skip_locked=True)
+
+        carts = units = 0
+        while True:
+            with transaction.atomic():
+                ids = list(expired.values_list("id", flat=True)[:options["batch_size"]])
+                if not ids:
+                    break
+                lines = CartItem.objects.filter(cart_id__in=ids)
+                held = dict(lines.order_by().values("item_id").annotate(quantity=Sum("quantity")).values_list("item_id", "quantity"))
+                inventory.release(held)
+                lines.delete()
+                Cart.objects.filter(pk__in=ids).reset_totals()
+            carts += len(ids)
+            units += sum(held.values())
+
+        self.stdout.write(self.style.SUCCESS(f"Released {units} unit(s) from {carts} expired cart(s)."))
@@ -0,0 +1,112 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import django
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from main import renditions
+from main.cache import catalog_cache
+from main.models import PICTURE_FIELDS, Items, User
+
+
+def init_worker():
+    # Forked workers inherit a configured Django; spawned ones start cold
+    if not django_apps.ready:
+        django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the thumb/card/full renditions of every stored item and user picture "
+        "in a process pool. Progress is saved after each batch, so an interrupted run "
+        "resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (default: CPU count).")
+        parser.add_argument("--batch-size", type=int, default=200, help="Pictures per batch (default 200).")
+        parser.add_argument("--force", action="store_true", help="Re-render sets that already exist.")
+        parser.add_argument("--restart", action="store_true", help="Ignore saved progress and start over.")
+        parser.add_argument(
+            "--progress-file",
+            default=str(Path(settings.MEDIA_ROOT) / "renditions" / f"backfill-{renditions.VERSION}.json"),
+            help="Where progress is kept.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--workers and --batch-size must be >= 1")
+        self.progress_file = Path(options["progress_file"])
+        progress = {} if options["restart"] else self.load_progress()
+
+        # Don't hand open database connections to forked workers
+        connections.close_all()
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        started = time.perf_counter()
+        with ProcessPoolExecutor(options["workers"], mp_context=context, initializer=init_worker) as pool:
+            for model in (Items, User):
+                self.backfill(pool, model, progress, options)
+        self.stdout.write(self.style.SUCCESS(f"Done in {time.perf_counter() - started:.1f}s."))
+
+    def backfill(self, pool, model, progress, options):
+        field = PICTURE_FIELDS[model]
+        label = model._meta.label
+        state = progress.setdefault(label, {"after": None, "rendered": 0, "failed": 0})
+        pictures = model.objects.exclude(**{f"{field}__isnull": True}).exclude(**{field: ""}).order_by("pk")
+
+        while True:
+            batch = pictures if state["after"] is None else pictures.filter(pk__gt=state["after"])
+            batch = list(batch.values_list("pk", field)[:options["batch_size"]])
+            if not batch:
+                break
+
+            # Workers are forked as needed; keep them off our connections
+            connections.close_all()
+            names = {name for _, name in batch}
+            futures = [pool.submit(renditions.render_stored, name, options["force"]) for name in names]
+            hashes = {}
+            for future in as_completed(futures):
+                try:
+                    name, digest = future.result()
+                except Exception as exc:
+                    state["failed"] += 1
+                    self.stderr.write(f"{label}: {exc}")
+                    continue
+                hashes[name] = digest
+
+            objs = [model(pk=pk, picture_hash=hashes[name]) for pk, name in batch if name in hashes]
+            update_fields = ["picture_hash"]
+            if model is Items:
+                # Listing ETags and ?since= sync key off updated_at
+                now = timezone.now()
+                for obj in objs:
+                    obj.updated_at = now
+                update_fields.append("updated_at")
+            model.objects.bulk_update(objs, update_fields)
+            if model is Items:
+                catalog_cache.bump()
+
+            state["after"] = str(batch[-1][0])
+            state["rendered"] += len(objs)
+            self.save_progress(progress)
+            self.stdout.write(f"{label}: {state['rendered']} rendered, {state['failed']} failed")
+
+    def load_progress(self):
+        try:
+            return json.loads(self.progress_file.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def save_progress(self, progress):
+        self.progress_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.progress_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(progress))
+        os.replace(tmp, self.progress_file)
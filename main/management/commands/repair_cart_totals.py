@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import Cart
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare every cart's stored item_count/subtotal with its lines and "
+        "recompute the ones that drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report drifted carts.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Carts repaired per UPDATE (default 500).")
+
+    def handle(self, *args, **options):
+        drifted = list(
+            Cart.objects.drifted().order_by("id").values_list("id", "item_count", "line_count", "subtotal", "line_subtotal")
+        )
+        for cart_id, count, line_count, subtotal, line_subtotal in drifted:
+            self.stdout.write(
+                f"Cart {cart_id}: stored {count} items / {subtotal}, lines say {line_count} items / {line_subtotal}"
+            )
+
+        if options["dry_run"] or not drifted:
+            self.stdout.write(f"{len(drifted)} drifted cart(s) found.")
+            return
+
+        ids = [row[0] for row in drifted]
+        batch_size = options["batch_size"]
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                Cart.objects.filter(pk__in=ids[start:start + batch_size]).recompute_totals()
+        self.stdout.write(self.style.SUCCESS(f"Repaired {len(ids)} cart(s)."))
@@ -0,0 +1,155 @@
+import json
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import Resolver404, resolve
+
+from main.benchmarks import percentile, start_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a request log against the app and report throughput and latency per route. "
+        "The log is JSONL, one request per line: "
+        '{"method": "GET", "path": "/item_list/?page_size=20", "headers": {"Authorization": "Token ..."}, '
+        '"body": {...}}; only path is required. Requests go through the Django test client by '
+        "default, to --url, or to a gunicorn started with --gunicorn. Unlike bench_endpoints, "
+        "replayed requests are not rolled back: run it against staging."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("log", help="JSONL request log.")
+        parser.add_argument("--workers", type=int, default=8, help="Concurrent clients (default 8).")
+        parser.add_argument("--repeat", type=int, default=1, help="Replay the log this many times (default 1).")
+        parser.add_argument("--limit", type=int, default=None, help="Only the first N requests of the log.")
+        target = parser.add_mutually_exclusive_group()
+        target.add_argument("--url", help="Send to a running server instead, e.g. http://127.0.0.1:8000.")
+        target.add_argument("--gunicorn", type=int, metavar="PROCESSES", help="Start a local gunicorn with this many worker processes and send to it.")
+        parser.add_argument("--host", default="localhost", help="Host header for the test client, must be in ALLOWED_HOSTS.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["repeat"] < 1:
+            raise CommandError("--workers and --repeat must be >= 1")
+        entries = self.load(options["log"], options["limit"]) * options["repeat"]
+        if not entries:
+            raise CommandError(f"{options['log']} has no requests")
+
+        server = None
+        if options["gunicorn"]:
+            server, url = self.start_gunicorn(options["gunicorn"])
+            send = self.http_sender(url)
+        elif options["url"]:
+            send = self.http_sender(options["url"].rstrip("/"))
+        else:
+            send = self.client_sender(options["host"])
+
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(options["workers"]) as pool:
+                outcomes = list(pool.map(send, entries))
+            elapsed = time.perf_counter() - started
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(10)
+        self.report(entries, outcomes, elapsed)
+
+    def load(self, path, limit):
+        entries = []
+        with open(path) as log:
+            for number, line in enumerate(log, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    entry["path"]
+                except (ValueError, TypeError, KeyError):
+                    raise CommandError(f"{path}:{number}: not a request entry")
+                entries.append(entry)
+                if limit is not None and len(entries) >= limit:
+                    break
+        return entries
+
+    @staticmethod
+    def encode_body(entry):
+        body = entry.get("body")
+        if body is None:
+            return b""
+        return body.encode() if isinstance(body, str) else json.dumps(body).encode()
+
+    def client_sender(self, host):
+        def send(entry):
+            headers = {
+                "HTTP_" + name.upper().replace("-", "_"): value
+                for name, value in entry.get("headers", {}).items() if name.lower() != "content-type"
+            }
+            content_type = entry.get("headers", {}).get("Content-Type", "application/json")
+            started = time.perf_counter()
+            try:
+                response = Client(HTTP_HOST=host).generic(
+                    entry.get("method", "GET"), entry["path"], self.encode_body(entry),
+                    content_type=content_type, **headers,
+                )
+                if response.streaming:
+                    b"".join(response.streaming_content)
+                return response.status_code, time.perf_counter() - started
+            except Exception as exc:
+                return type(exc).__name__, time.perf_counter() - started
+            finally:
+                connections.close_all()
+        return send
+
+    def http_sender(self, base_url):
+        def send(entry):
+            body = self.encode_body(entry)
+            headers = {"Content-Type": "application/json", **entry.get("headers", {})}
+            request = urllib.request.Request(
+                base_url + entry["path"], data=body or None, headers=headers, method=entry.get("method", "GET"),
+            )
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as exc:
+                exc.read()
+                status = exc.code
+            except OSError as exc:
+                status = type(exc).__name__
+            return status, time.perf_counter() - started
+        return send
+
+    def start_gunicorn(self, processes):
+        try:
+            return start_server(
+                ["gunicorn", "sbf.wsgi:application", "--workers", str(processes), "--bind", "127.0.0.1:{port}"], "gunicorn",
+            )
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+
+    def report(self, entries, outcomes, elapsed):
+        routes = defaultdict(list)
+        statuses = Counter()
+        for entry, (status, duration) in zip(entries, outcomes):
+            method = entry.get("method", "GET")
+            try:
+                route = resolve(urlsplit(entry["path"]).path).url_name or "-"
+            except Resolver404:
+                route = "(unresolved)"
+            routes[f"{method} {route}"].append(duration)
+            statuses[status] += 1
+
+        self.stdout.write(f"{len(entries)} requests in {elapsed:.2f}s: {len(entries) / elapsed:.1f} req/s, statuses {dict(statuses)}")
+        self.stdout.write(f"{'route':28} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for route, durations in sorted(routes.items()):
+            self.stdout.write(
+                f"{route:28} {len(durations):>6} "
+                + " ".join(f"{percentile(durations, pct) * 1000:>8.1f}" for pct in (50, 90, 99, 100))
+            )
@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from main import timing
+
+
+class Command(BaseCommand):
+    help = (
+        "Show or change the sample rate of the request timing middleware at runtime. "
+        "Workers pick the change up through REQUEST_TIMING['CACHE_ALIAS'], which they must share."
+    )
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--sample-rate", type=float, help="Fraction of requests to sample, 0 to 1.")
+        group.add_argument("--reset", action="store_true", help="Go back to REQUEST_TIMING['SAMPLE_RATE'].")
+        parser.add_argument(
+            "--expire-after", type=int, metavar="SECONDS", help="Go back to the setting after this long.",
+        )
+
+    def handle(self, *args, **options):
+        rate = options["sample_rate"]
+        expire_after = options["expire_after"]
+        if expire_after is not None and (rate is None or expire_after < 1):
+            raise CommandError("--expire-after needs --sample-rate and must be >= 1")
+        try:
+            if rate is not None:
+                if not 0 <= rate <= 1:
+                    raise CommandError("--sample-rate must be between 0 and 1")
+                timing.set_sample_rate(rate, expire_after)
+            elif options["reset"]:
+                timing.set_sample_rate(None)
+            override = timing.sample_rate_override()
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+
+        configured = timing.options()["SAMPLE_RATE"]
+        if override is None:
+            self.stdout.write(f"Sample rate: {configured} (from settings)")
+            return
+        rate, until = override
+        expiry = "" if until is None else f" until {datetime.fromtimestamp(until, timezone.utc):%Y-%m-%d %H:%M:%S} UTC"
+        self.stdout.write(f"Sample rate: {rate} (runtime override{expiry}; settings say {configured})")
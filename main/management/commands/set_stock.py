@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main import inventory
+from main.models import Items
+
+
+class Command(BaseCommand):
+    help = (
+        "Set the units of an item left to reserve, or stop tracking it with 'none'. "
+        "--shards spreads the count over several rows for very hot items."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug")
+        parser.add_argument("count", help="Units available, or 'none' to stop tracking stock.")
+        parser.add_argument("--shards", type=int, default=None, help="Split the count over this many shard rows.")
+
+    def handle(self, *args, **options):
+        item = Items.objects.filter(slug=options["slug"]).first()
+        if item is None:
+            raise CommandError(f"No item with slug {options['slug']!r}")
+        if options["count"].lower() == "none":
+            count = None
+        else:
+            try:
+                count = int(options["count"])
+            except ValueError:
+                raise CommandError("count must be a number or 'none'")
+            if count < 0:
+                raise CommandError("count must be >= 0")
+        if options["shards"] is not None and options["shards"] < 1:
+            raise CommandError("--shards must be >= 1")
+
+        inventory.set_stock(item, count, shards=options["shards"])
+        if count is None:
+            self.stdout.write(f"{item.slug}: stock not tracked")
+        else:
+            shards = f" over {item.stock_shards} shards" if item.stock_shards else ""
+            self.stdout.write(f"{item.slug}: {inventory.available(item)} available{shards}")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from main import warmup
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the worker warm-up (main.warmup) and print what each step costs. Imports are only "
+        "timed for modules nothing imported yet, so this is closest to a worker's cold start "
+        "when run on its own."
+    )
+    # The checks would import the URLconf, and with it the views, first
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-prefill", action="store_true", help="Skip WARMUP_PREFILL_URLS.")
+
+    def handle(self, *args, **options):
+        report = warmup.warm_up(prefill=not options["no_prefill"])
+        for name, seconds in report:
+            self.stdout.write(f"{seconds * 1000:8.1f}ms  {name}")
+        self.stdout.write(self.style.SUCCESS(f"{sum(seconds for _, seconds in report) * 1000:8.1f}ms  total"))
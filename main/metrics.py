@@ -0,0 +1,410 @@
+"""
+Request metrics in Prometheus text format, aggregated across worker processes.
+
+Each thread records into its own shard, so the request path never takes a
+lock. Every FLUSH_SECONDS a process writes a snapshot of its shards to
+``<METRICS['DIR']>/<pid>-<start time>.json`` (atomically, via rename);
+``/metrics`` sums the snapshots. The files of exited workers are folded
+into ``retained.json`` so counters and histograms never go backwards, even
+when a new worker gets a recycled pid; in-flight gauges only count live
+processes. Without a DIR, metrics cover this process only.
+
+The endpoint answers clients in METRICS['ALLOWED_NETWORKS'] only
+(ScrapePermission).
+"""
+import ipaddress
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from rest_framework.permissions import BasePermission
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+COUNTERS = {
+    "sbf_http_requests_total": "Requests handled, by view, method and status code.",
+    "sbf_catalog_cache_hits_total": "Catalog cache lookups answered from the cache.",
+    "sbf_catalog_cache_misses_total": "Catalog cache lookups that went to the database.",
+}
+HISTOGRAMS = {
+    "sbf_http_request_duration_seconds": ("Request latency, by view.", LATENCY_BUCKETS),
+    "sbf_db_queries_per_request": ("SQL queries per request, by view.", QUERY_BUCKETS),
+}
+GAUGES = {
+    "sbf_http_requests_in_flight": "Requests currently being handled, by view.",
+}
+
+
+RETAINED = "retained.json"
+
+
+def options():
+    defaults = {"DIR": None, "FLUSH_SECONDS": 1.0, "ALLOWED_NETWORKS": ["127.0.0.1/32", "::1/128"]}
+    return {**defaults, **getattr(settings, "METRICS", {})}
+
+
+class ScrapePermission(BasePermission):
+    """Lets in clients whose address (REMOTE_ADDR) is in METRICS['ALLOWED_NETWORKS']."""
+
+    def has_permission(self, request, view):
+        try:
+            address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+        except ValueError:
+            return False
+        return any(address in ipaddress.ip_network(network, strict=False) for network in options()["ALLOWED_NETWORKS"])
+
+
+class Shard:
+    """One thread's metrics; only that thread writes to it."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            buckets = HISTOGRAMS[name][1]
+            # per-bucket counts (last one is +Inf), then sum
+            histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        buckets = HISTOGRAMS[name][1]
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def add(self, name, labels, amount):
+        key = (name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + amount
+
+
+class ProcessMetrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # only taken when a thread records for the first time
+        self._flush_at = 0.0
+        self._pid = None
+
+    @property
+    def identity(self):
+        """``(pid, start time)``; a forked worker gets its own."""
+        if self._pid != os.getpid():
+            self._pid, self._started = os.getpid(), time.time()
+        return self._pid, self._started
+
+    @property
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = Shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def snapshot(self):
+        """This process's metrics merged over its threads, as JSON-serializable lists."""
+        counters, histograms, gauges = {}, {}, {}
+        for shard in list(self._shards):
+            # dict() copies are atomic under the GIL
+            for key, value in dict(shard.counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, value in dict(shard.histograms).items():
+                merged = histograms.setdefault(key, [0] * len(value))
+                for i, count in enumerate(list(value)):
+                    merged[i] += count
+            for key, value in dict(shard.gauges).items():
+                gauges[key] = gauges.get(key, 0) + value
+
+        # Cache hit/miss totals are kept by the cache itself
+        from .cache import catalog_cache
+        counters[("sbf_catalog_cache_hits_total", ())] = catalog_cache.hits
+        counters[("sbf_catalog_cache_misses_total", ())] = catalog_cache.misses
+
+        def pack(values):
+            return [[name, list(labels), value] for (name, labels), value in values.items()]
+
+        pid, started = self.identity
+        return {
+            "pid": pid, "started": started,
+            "counters": pack(counters), "histograms": pack(histograms), "gauges": pack(gauges),
+        }
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now >= self._flush_at:
+            self._flush_at = now + options()["FLUSH_SECONDS"]
+            self.flush()
+
+    def flush(self):
+        directory = options()["DIR"]
+        if not directory:
+            return
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        pid, started = self.identity
+        write_json(directory / f"{pid}-{started:.6f}.json", self.snapshot())
+
+
+metrics = ProcessMetrics()
+
+
+def write_json(path, data):
+    tmp = path.parent / f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        # Gone (folded by another worker) or not there yet
+        return None
+
+
+def collect():
+    """Snapshots of the live workers (this one freshly taken) and the retained totals of exited ones."""
+    directory = options()["DIR"]
+    if not directory:
+        return [metrics.snapshot()]
+    metrics.flush()
+    directory = Path(directory)
+    snapshots = [(path, read_json(path)) for path in directory.glob("*-*.json")]
+    snapshots = [(path, snapshot) for path, snapshot in snapshots if snapshot is not None]
+    # A pid may have been reused: only its newest snapshot can be alive
+    newest = {}
+    for path, snapshot in snapshots:
+        if snapshot["started"] > newest.get(snapshot["pid"], float("-inf")):
+            newest[snapshot["pid"]] = snapshot["started"]
+    dead = [
+        path for path, snapshot in snapshots
+        if snapshot["started"] != newest[snapshot["pid"]] or not pid_alive(snapshot["pid"])
+    ]
+    if dead:
+        fold(directory, dead)
+        snapshots = [(path, snapshot) for path, snapshot in snapshots if path not in dead]
+    retained = read_json(directory / RETAINED)
+    return [snapshot for _, snapshot in snapshots] + ([retained] if retained else [])
+
+
+def fold(directory, paths):
+    """Add the counters and histograms of exited workers' snapshots to retained.json and remove them."""
+    import fcntl
+
+    with open(directory / ".fold.lock", "w") as lock:
+        # Concurrent scrapes must not fold the same file twice
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retained = read_json(directory / RETAINED) or {"pid": None, "started": None, "counters": [], "histograms": [], "gauges": []}
+        counters, histograms = unpack(retained["counters"]), unpack(retained["histograms"])
+        folded = []
+        for path in paths:
+            snapshot = read_json(path)
+            if snapshot is None:
+                continue
+            merge(counters, histograms, snapshot)
+            folded.append(path)
+        if not folded:
+            return
+        retained["counters"] = [[name, list(labels), value] for (name, labels), value in counters.items()]
+        retained["histograms"] = [[name, list(labels), value] for (name, labels), value in histograms.items()]
+        write_json(directory / RETAINED, retained)
+        for path in folded:
+            path.unlink(missing_ok=True)
+
+
+def unpack(values):
+    return {(name, tuple(map(tuple, labels))): value for name, labels, value in values}
+
+
+def merge(counters, histograms, snapshot):
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, value in snapshot["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        merged = histograms.setdefault(key, [0] * len(value))
+        for i, count in enumerate(value):
+            merged[i] += count
+
+
+def pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def render(snapshots):
+    counters, histograms, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        merge(counters, histograms, snapshot)
+        # Snapshots passed in are live; retained totals have no pid and no gauges
+        if snapshot["pid"] is not None:
+            for name, labels, value in snapshot["gauges"]:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        lines += [f"{name}{format_labels(labels)} {value}" for (n, labels), value in sorted(counters.items()) if n == name]
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for (n, labels), value in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    for name, help_text in GAUGES.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f"{name}{format_labels(labels)} {value}" for (n, labels), value in sorted(gauges.items()) if n == name]
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class QueryCounter:
+    """
+    Queries run in a context, counted by count_query(). Counters nest: a
+    query also counts for the counter that was current when this one was
+    started (``parent``).
+    """
+    __slots__ = ("count", "parent")
+
+    def __init__(self, parent=None):
+        self.count = 0
+        self.parent = parent
+
+
+_request_queries = ContextVar("request_queries", default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    counter = _request_queries.get()
+    while counter is not None:
+        counter.count += 1
+        counter = counter.parent
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def counting_queries():
+    """Count the queries run inside the block, on any connection, as MetricsMiddleware does per request."""
+    counter = QueryCounter(_request_queries.get())
+    token = _request_queries.set(counter)
+    try:
+        yield counter
+    finally:
+        _request_queries.reset(token)
+
+
+def install_query_hook(sender, connection, **kwargs):
+    """
+    connection_created receiver: count every connection's queries for the
+    request in progress (MetricsMiddleware). A per-request execute_wrapper()
+    would miss async views, whose ORM calls run on another thread and so on
+    another connection object; the counter travels in the request's context.
+    """
+    if count_query not in connection.execute_wrappers:
+        # First, as execute_wrapper() blocks pop the last wrapper on exit
+        connection.execute_wrappers.insert(0, count_query)
+
+
+class MetricsMiddleware:
+    """Records count, status, latency, query count and in-flight requests per URL name."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Django would run a sync process_view in a thread
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started, counter, token = self.begin(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.end(request, token)
+        self.record(request, response, started, counter)
+        return response
+
+    async def __acall__(self, request):
+        started, counter, token = self.begin(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.end(request, token)
+        self.record(request, response, started, counter)
+        return response
+
+    def begin(self, request):
+        request._metrics_view = None
+        counter = QueryCounter(_request_queries.get())
+        return time.perf_counter(), counter, _request_queries.set(counter)
+
+    def end(self, request, token):
+        _request_queries.reset(token)
+        if request._metrics_view is not None:
+            metrics.shard.add("sbf_http_requests_in_flight", (("view", request._metrics_view),), -1)
+
+    def record(self, request, response, started, counter):
+        elapsed = time.perf_counter() - started
+        view = request._metrics_view or "unmatched"
+        shard = metrics.shard
+        shard.inc("sbf_http_requests_total", (("view", view), ("method", request.method), ("status", str(response.status_code))))
+        shard.observe("sbf_http_request_duration_seconds", (("view", view),), elapsed)
+        shard.observe("sbf_db_queries_per_request", (("view", view),), counter.count)
+        metrics.maybe_flush()
+
+    def enter_view(self, request):
+        if request._metrics_view is not None:
+            # View middleware ran again for the same request (main.routers
+            # retries a request on the primary); end() only leaves once
+            return
+        view = request.resolver_match.url_name or request.resolver_match.view_name or "unnamed"
+        request._metrics_view = view
+        metrics.shard.add("sbf_http_requests_in_flight", (("view", view),), 1)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.enter_view(request)
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        self.enter_view(request)
+        return None
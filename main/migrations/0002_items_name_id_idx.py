@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='items',
+            index=models.Index(fields=['item_name', 'id'], name='items_name_id_idx'),
+        ),
+    ]
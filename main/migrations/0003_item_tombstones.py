@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_items_name_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item_id', models.BigIntegerField(db_index=True)),
+                ('slug', models.SlugField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['deleted_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='items',
+            index=models.Index(fields=['updated_at', 'id'], name='items_updated_id_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from main import search
+
+
+def install_search_index(apps, schema_editor):
+    search.install(schema_editor)
+
+
+def uninstall_search_index(apps, schema_editor):
+    search.uninstall(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_item_tombstones'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
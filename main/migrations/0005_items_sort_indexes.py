@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_item_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='items',
+            index=models.Index(fields=['price', 'id'], name='items_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='items',
+            index=models.Index(fields=['created_at', 'id'], name='items_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_items_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:22
+
+import django.utils.timezone
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('main', 'Cart')
+    CartItem = apps.get_model('main', 'CartItem')
+    lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    count = lines.annotate(count=Sum('quantity')).values('count')
+    subtotal = lines.annotate(
+        subtotal=Sum(F('quantity') * F('item__price'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    ).values('subtotal')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(count), 0),
+        subtotal=Coalesce(Subquery(subtotal), Value(Decimal('0.00'))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_user_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
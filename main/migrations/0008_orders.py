@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:23
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_cart_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(blank=True, max_length=64, null=True)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='main.user')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='main.order'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(fields=('user', 'idempotency_key'), name='orders_user_idempotency_key'),
+        ),
+    ]
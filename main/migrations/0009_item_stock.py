@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_orders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='items',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='items',
+            name='stock_shards',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ItemStockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('stock', models.PositiveIntegerField(default=0)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shard_rows', to='main.items')),
+            ],
+            options={
+                'unique_together': {('item', 'shard')},
+            },
+        ),
+    ]
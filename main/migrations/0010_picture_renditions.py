@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_item_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='items',
+            name='picture_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='picture_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
@@ -1,17 +1,33 @@
 from decimal import Decimal
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Subquery, Sum, Value, aprefetch_related_objects, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
 from django.core.validators import MinValueValidator
 from django.urls import reverse
-from django.utils.text import slugify
+from django.utils import timezone
+import logging
 import uuid
 import secrets
 
+from .cache import catalog_cache
+from .slugs import random_slug, slug_base
+
+SLUG_SAVE_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
 
 class User(models.Model):
     user_id = models.UUIDField(default=uuid.uuid4, primary_key=True)
     username = models.CharField(max_length=20, unique=True)
     user_password = models.CharField(max_length=20)
     user_picture = models.ImageField(upload_to="users/%Y/%m/%d/", blank=True, null=True)
+    # sha256 of user_picture; names its renditions (see main.renditions)
+    picture_hash = models.CharField(max_length=64, blank=True, null=True, editable=False)
+    # Bumped to revoke every signed auth token issued so far (see main.tokens)
+    token_version = models.PositiveIntegerField(default=0)
 
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -32,31 +48,81 @@ class Items(models.Model):
     item_name = models.CharField(max_length=200)
     price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal("0.00"))])
     item_picture = models.ImageField(upload_to="items/%Y/%m/%d/", blank=True, null=True)
+    # sha256 of item_picture; names its renditions (see main.renditions)
+    picture_hash = models.CharField(max_length=64, blank=True, null=True, editable=False)
     slug = models.SlugField(unique=True, blank=True)
     item_description = models.TextField(blank=True)
+    # Units left to reserve, NULL when the item is not tracked. Changed only
+    # through main.inventory, never by save().
+    stock = models.PositiveIntegerField(null=True, blank=True)
+    # When set, the count lives in this many ItemStockShard rows instead
+    stock_shards = models.PositiveSmallIntegerField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["item_name"]
+        indexes = [
+            # Keyset pagination of the catalog: (item_name, id) is unique and
+            # matches the default ordering, so every page is a range scan.
+            models.Index(fields=["item_name", "id"], name="items_name_id_idx"),
+            # Delta sync (?since=) pages through changes in (updated_at, id) order.
+            models.Index(fields=["updated_at", "id"], name="items_updated_id_idx"),
+            # Sorted / range-filtered listings (see ItemListQuerySerializer)
+            models.Index(fields=["price", "id"], name="items_price_id_idx"),
+            models.Index(fields=["created_at", "id"], name="items_created_id_idx"),
+        ]
         verbose_name = "item"
         verbose_name_plural = "items"
 
     def __str__(self):
         return f"{self.item_name} ({self.price})"
-    
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so save() can tell when carts holding the item need new totals
+        instance._loaded_price = instance.__dict__.get("price")
+        return instance
+
     def save(self, *args, **kwargs):
-        if not self.slug:
-            base_slug = slugify(self.item_name)
-            self.slug = base_slug
-            # Handle duplicate slugs by adding a counter
-            counter = 1
-            while Items.objects.filter(slug=self.slug).exclude(pk=self.pk).exists():
-                self.slug = f"{base_slug}-{counter}"
-                counter += 1
-        super().save(*args, **kwargs)
-    
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # A stale in-memory stock must not overwrite concurrent reservations
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ("stock", "stock_shards")
+            ]
+        loaded_price = getattr(self, "_loaded_price", None)
+        price_changed = loaded_price is not None and loaded_price != self.price
+        with transaction.atomic():
+            if self.slug:
+                super().save(*args, **kwargs)
+            else:
+                self._save_with_free_slug(*args, **kwargs)
+            if price_changed:
+                Cart.objects.filter(cart_items__item_id=self.pk).recompute_totals()
+        self._loaded_price = self.price
+        catalog_cache.bump()
+
+    def _save_with_free_slug(self, *args, **kwargs):
+        # The name's slug if it is free, else "<name>-<random n>": one index
+        # lookup however many items share the name. A concurrent save can
+        # still take the slug first, so retry inside a savepoint on a collision.
+        base = slug_base(self.item_name)
+        others = Items.objects.exclude(pk=self.pk) if self.pk else Items.objects.all()
+        self.slug = random_slug(base) if others.filter(slug=base).exists() else base
+        for attempt in range(SLUG_SAVE_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                return
+            except IntegrityError:
+                if attempt == SLUG_SAVE_ATTEMPTS - 1 or not others.filter(slug=self.slug).exists():
+                    self.slug = ""
+                    raise
+                self.slug = random_slug(base)
+
     def get_add_to_cart(self):
         return reverse('core:add_to_cart', kwargs={
             'slug': self.slug
@@ -68,33 +134,462 @@ class Items(models.Model):
         })
 
 
+class ItemStockShard(models.Model):
+    """One slice of a hot item's stock (see main.inventory)."""
+    item = models.ForeignKey(Items, on_delete=models.CASCADE, related_name="stock_shard_rows")
+    shard = models.PositiveSmallIntegerField()
+    stock = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("item", "shard")
+
+    def __str__(self):
+        return f"{self.item_id}#{self.shard}: {self.stock}"
+
+
+class ItemTombstone(models.Model):
+    """Record of a deleted item, so delta sync can tell clients to drop it."""
+    item_id = models.BigIntegerField(db_index=True)
+    slug = models.SlugField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ["deleted_at"]
+
+    def __str__(self):
+        return f"Deleted item {self.item_id} ({self.slug})"
+
+
+PICTURE_FIELDS = {User: "user_picture", Items: "item_picture"}
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Items)
+def picture_changing(sender, instance, **kwargs):
+    picture = getattr(instance, PICTURE_FIELDS[sender])
+    if not picture:
+        instance.picture_hash = None
+    # A freshly assigned upload is uncommitted until the field's pre_save stores it
+    instance._render_picture = bool(picture) and not picture._committed
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Items)
+def picture_changed(sender, instance, **kwargs):
+    if not getattr(instance, "_render_picture", False):
+        return
+    instance._render_picture = False
+    name = getattr(instance, PICTURE_FIELDS[sender]).name
+    # Rendering takes a while; the saving transaction mustn't hold its locks meanwhile
+    transaction.on_commit(lambda: render_picture(sender, instance.pk, name, instance))
+
+
+def render_picture(model, pk, name, instance=None):
+    """
+    Render the stored picture ``name`` of the ``model`` row ``pk`` and
+    record its hash, unless the row has another picture by then. Runs
+    after the transaction that stored the picture has committed.
+    """
+    from . import renditions
+
+    try:
+        _, digest = renditions.render_stored(name)
+    except OSError:
+        logger.warning("Could not render the picture of %s %s", model.__name__, pk, exc_info=True)
+        return
+    changes = {"picture_hash": digest}
+    if model is Items:
+        # Listing ETags and ?since= sync key off updated_at
+        changes["updated_at"] = timezone.now()
+    if model.objects.filter(pk=pk, **{PICTURE_FIELDS[model]: name}).update(**changes) and instance is not None:
+        instance.picture_hash = digest
+    if model is Items:
+        catalog_cache.bump()
+
+
+@receiver(pre_delete, sender=Items)
+def items_deleting(sender, instance, **kwargs):
+    # The cascade removes the item's cart lines; note whose totals change
+    instance._cart_ids = list(Cart.objects.filter(cart_items__item_id=instance.pk).values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Items)
+def items_deleted(sender, instance, **kwargs):
+    ItemTombstone.objects.create(item_id=instance.pk, slug=instance.slug)
+    cart_ids = getattr(instance, "_cart_ids", None)
+    if cart_ids:
+        Cart.objects.filter(pk__in=cart_ids).recompute_totals()
+    catalog_cache.bump()
+
+
+class CartEmpty(Exception):
+    pass
+
+
+class OrderManager(models.Manager):
+    def place(self, user, idempotency_key=None):
+        """
+        Turn the user's cart into an order; returns ``(order, created)``.
+
+        One transaction with a fixed number of queries: lock the cart row,
+        look up an order already placed with ``idempotency_key`` (a retry
+        gets that order back with ``created=False``), read the lines with
+        their prices, insert the order and bulk insert its lines, then empty
+        the cart with one DELETE and reset its totals. Raises CartEmpty.
+        """
+        with transaction.atomic():
+            # Concurrent checkouts of the same cart (retries included) queue
+            # here, so the idempotency lookup below sees any order they placed.
+            cart = Cart.objects.select_for_update().filter(user_id=user.pk).first()
+            if idempotency_key:
+                order = self.filter(user_id=user.pk, idempotency_key=idempotency_key).first()
+                if order is not None:
+                    return order.load_lines(), False
+            lines = list(cart.cart_items.select_related("item").order_by("id")) if cart else []
+            if not lines:
+                raise CartEmpty()
+
+            order = self.create(
+                user_id=user.pk,
+                idempotency_key=idempotency_key or None,
+                item_count=sum(line.quantity for line in lines),
+                total=sum((line.item.price * line.quantity for line in lines), Decimal("0.00")),
+            )
+            order_items = OrderItem.objects.bulk_create([
+                OrderItem(order=order, user_id=user.pk, item=line.item, quantity=line.quantity, unit_price=line.item.price)
+                for line in lines
+            ])
+            CartItem.objects.filter(cart=cart).delete()
+            Cart.objects.filter(pk=cart.pk).reset_totals()
+
+        # The lines just written, so serializing the order needs no query
+        order._prefetched_objects_cache = {"lines": order_items}
+        return order, True
+
+
+class Order(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders")
+    # Client-chosen key of the checkout request; a retry with the same key
+    # returns the order instead of placing another one.
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True)
+    item_count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal("0.00"))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OrderManager()
+
+    class Meta:
+        ordering = ["-created_at"]
+        constraints = [
+            models.UniqueConstraint(fields=["user", "idempotency_key"], name="orders_user_idempotency_key"),
+        ]
+
+    def __str__(self):
+        return f"Order {self.pk} of {self.user_id}"
+
+    def load_lines(self):
+        self._prefetched_objects_cache = {}
+        prefetch_related_objects(
+            [self], Prefetch("lines", queryset=OrderItem.objects.select_related("item").order_by("id"))
+        )
+        return self
+
+
 class OrderItem(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines", null=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     item = models.ForeignKey(Items, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # Price when the order was placed; later catalog changes don't touch it
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
 
     def get_total_price(self):
-        return self.item.price * self.quantity
+        price = self.item.price if self.unit_price is None else self.unit_price
+        return price * self.quantity
     
 
+
+class CartQuerySet(models.QuerySet):
+    def shift_totals(self, item_count, subtotal):
+        """
+        Add ``item_count`` and ``subtotal`` (numbers or expressions, may be
+        negative) to the carts' stored totals in one UPDATE and bump their
+        version. Run in the transaction that changed the lines.
+        """
+        return self.update(
+            item_count=F("item_count") + item_count,
+            subtotal=F("subtotal") + subtotal,
+            version=F("version") + 1,
+            updated_at=timezone.now(),
+        )
+
+    def reset_totals(self):
+        return self.update(item_count=0, subtotal=Decimal("0.00"), version=F("version") + 1, updated_at=timezone.now())
+
+    def recompute_totals(self):
+        """Recompute the carts' stored totals from their lines in one UPDATE."""
+        lines = CartItem.objects.filter(cart=OuterRef("pk")).order_by().values("cart")
+        count = lines.annotate(count=Sum("quantity")).values("count")
+        subtotal = lines.annotate(
+            subtotal=Sum(F("quantity") * F("item__price"), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        ).values("subtotal")
+        return self.update(
+            item_count=Coalesce(Subquery(count), 0),
+            subtotal=Coalesce(Subquery(subtotal), Value(Decimal("0.00"))),
+            version=F("version") + 1,
+            updated_at=timezone.now(),
+        )
+
+    def drifted(self):
+        """Carts whose stored totals disagree with their lines."""
+        return self.annotate(
+            line_count=Coalesce(Sum("cart_items__quantity"), 0),
+            line_subtotal=Coalesce(
+                Sum(F("cart_items__quantity") * F("cart_items__item__price"),
+                    output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+                Value(Decimal("0.00")),
+            ),
+        ).exclude(item_count=F("line_count"), subtotal=F("line_subtotal"))
+
+
+class CartManager(models.Manager.from_queryset(CartQuerySet)):
+    def for_user(self, user, create=True, lines=True):
+        """
+        The user's cart, with its lines loaded unless ``lines`` is false.
+        Created on first use through ensure_for_user(), or None if there is
+        none and not ``create``.
+        """
+        cart = self.filter(user_id=user.pk).first()
+        if cart is None:
+            if not create:
+                return None
+            cart = self.ensure_for_user(user)
+        return cart.load_lines() if lines else cart
+
+    async def afor_user(self, user, create=True, lines=True):
+        """for_user() for async views."""
+        cart = await self.filter(user_id=user.pk).afirst()
+        if cart is None:
+            if not create:
+                return None
+            cart = await self.aensure_for_user(user)
+        return await cart.aload_lines() if lines else cart
+
+    def ensure_for_user(self, user):
+        """
+        The user's cart, created if missing.
+
+        Creation is an ``INSERT ... ON CONFLICT DO NOTHING`` rather than
+        get_or_create(), so concurrent first writes cannot collide on the
+        unique user column.
+        """
+        self.bulk_create([self.model(user_id=user.pk)], ignore_conflicts=True)
+        return self.get(user_id=user.pk)
+
+    async def aensure_for_user(self, user):
+        await self.abulk_create([self.model(user_id=user.pk)], ignore_conflicts=True)
+        return await self.aget(user_id=user.pk)
+
+
 class Cart(models.Model):
     user = models.OneToOneField(to=User, on_delete=models.CASCADE, related_name="cart")
     items = models.ManyToManyField(to=Items, through="CartItem", related_name="carts")
+    # Denormalized from the lines so the header badge reads a single row; kept
+    # in step by every write path below (see CartQuerySet).
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal("0.00"))
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = CartManager()
 
     def __str__(self):
         return f"Cart of {self.user}"
-    
+
+    def load_lines(self):
+        """(Re)load cart_items together with their items in a single query."""
+        self._prefetched_objects_cache = {}
+        prefetch_related_objects(
+            [self], Prefetch("cart_items", queryset=CartItem.objects.select_related("item").order_by("id"))
+        )
+        return self
+
+    async def aload_lines(self):
+        """load_lines() for async views."""
+        self._prefetched_objects_cache = {}
+        await aprefetch_related_objects(
+            [self], Prefetch("cart_items", queryset=CartItem.objects.select_related("item").order_by("id"))
+        )
+        return self
+
+    def get_totals(self):
+        """
+        (item_count, total) of the cart.
+
+        Uses the lines already loaded by load_lines() when there are any, so
+        the totals match the lines shown next to them; otherwise the stored
+        item_count and subtotal.
+        """
+        lines = getattr(self, "_prefetched_objects_cache", {}).get("cart_items")
+        if lines is not None:
+            count = sum(line.quantity for line in lines)
+            total = sum((line.item.price * line.quantity for line in lines), Decimal("0.00"))
+        else:
+            count, total = self.item_count, self.subtotal
+        return count, Decimal(total).quantize(Decimal("0.01"))
+
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total = total + order_item.get_final_price()
-        return total
+        return self.get_totals()[1]
+
+    def apply_changes(self, changes, replace=False):
+        """
+        Apply ``(item_id, op, quantity)`` changes to the cart's lines in bulk.
+
+        ``op`` is "add" (increment), "set" (a quantity of 0 removes the line)
+        or "remove"; changes to the same item apply in order. With
+        ``replace=True`` lines not mentioned in ``changes`` are removed. Costs
+        the cart lock (see lock()), one SELECT of the affected lines, the
+        stock reservations (see inventory.change), then at most one bulk
+        insert, one bulk update, one DELETE and one UPDATE of the stored
+        totals, whatever the number of changes. Raises inventory.OutOfStock.
+        Call inside a transaction.
+        """
+        from . import inventory
+
+        # The quantities below are written back as absolute values: no other
+        # write to the lines may land between the read and the write
+        self.lock()
+        lines = self.cart_items.all()
+        if not replace:
+            lines = lines.filter(item_id__in={item_id for item_id, _, _ in changes})
+        existing = {line.item_id: line for line in lines}
+
+        quantities = {item_id: line.quantity for item_id, line in existing.items()}
+        if replace:
+            quantities = dict.fromkeys(quantities, 0)
+        for item_id, op, quantity in changes:
+            if op == "add":
+                quantities[item_id] = quantities.get(item_id, 0) + quantity
+            elif op == "set":
+                quantities[item_id] = quantity
+            elif op == "remove":
+                quantities[item_id] = 0
+            else:
+                raise ValueError(f"Unknown cart operation {op!r}")
+
+        inventory.change({
+            item_id: max(quantity, 0) - (existing[item_id].quantity if item_id in existing else 0)
+            for item_id, quantity in quantities.items()
+        })
+
+        to_create, to_update, to_delete = [], [], []
+        for item_id, quantity in quantities.items():
+            line = existing.get(item_id)
+            if quantity <= 0:
+                if line is not None:
+                    to_delete.append(item_id)
+            elif line is None:
+                to_create.append(CartItem(cart=self, item_id=item_id, quantity=quantity))
+            elif line.quantity != quantity:
+                line.quantity = quantity
+                to_update.append(line)
+
+        if to_create:
+            CartItem.objects.bulk_create(to_create)
+        if to_update:
+            CartItem.objects.bulk_update(to_update, ["quantity"])
+        if to_delete:
+            self.cart_items.filter(item_id__in=to_delete).delete()
+        if to_create or to_update or to_delete:
+            Cart.objects.filter(pk=self.pk).recompute_totals()
+
+    def lock(self):
+        """
+        Lock the cart's row until the transaction ends (SELECT ... FOR UPDATE;
+        SQLite has one writer at a time anyway). Every write to the lines
+        takes it first, so they apply one after the other and always in the
+        same lock order: cart, then items (stock), then lines.
+        """
+        list(Cart.objects.select_for_update().filter(pk=self.pk).values_list("pk"))
+
+    def remove_item(self, item):
+        """Delete the cart's line for ``item`` and release its stock; False if there is none."""
+        from . import inventory
+
+        with transaction.atomic():
+            self.lock()
+            line = self.cart_items.filter(item=item).first()
+            if line is None:
+                return False
+            line.delete()
+            inventory.release({item.pk: line.quantity})
+            # The price as the database has it now, not as ``item`` was read
+            # before the lock, the same subquery add() uses
+            price = Subquery(Items.objects.filter(pk=item.pk).values("price")[:1])
+            Cart.objects.filter(pk=self.pk).shift_totals(-line.quantity, price * -line.quantity)
+        return True
+
+    def clear(self):
+        from . import inventory
+
+        with transaction.atomic():
+            self.lock()
+            inventory.release(dict(self.cart_items.values_list("item_id", "quantity")))
+            self.cart_items.all().delete()
+            Cart.objects.filter(pk=self.pk).reset_totals()
+
+
+class CartItemManager(models.Manager):
+    def add(self, cart, slug, quantity):
+        """
+        Add ``quantity`` of the item with ``slug`` to ``cart``.
+
+        Three statements whatever the cart holds, four for an untracked
+        item: an UPDATE moves the cart's stored totals by the amount added,
+        which also takes the cart's lock (see Cart.lock());
+        inventory.reserve_slug reserves the stock (an UPDATE, plus a SELECT
+        when the item isn't tracked; raises OutOfStock); then ``INSERT ...
+        SELECT ... ON CONFLICT (cart_id, item_id) DO UPDATE`` resolves the
+        slug and creates the line or increments the existing one atomically
+        (supported by both SQLite and PostgreSQL), on the write database.
+        Call inside a transaction, rolled back when this returns False: no
+        item has that slug.
+        """
+        from . import inventory
+
+        db = router.db_for_write(self.model, instance=cart)
+        item = Items.objects.filter(slug=slug)
+        price = Subquery(item.values("price")[:1])
+        if not Cart.objects.using(db).filter(pk=cart.pk).filter(Exists(item)).shift_totals(quantity, price * quantity):
+            return False
+        if not inventory.reserve_slug(slug, quantity):
+            return False
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        opts, item_opts = self.model._meta, Items._meta
+        table = qn(opts.db_table)
+        cart_col = qn(opts.get_field("cart").column)
+        item_col = qn(opts.get_field("item").column)
+        quantity_col = qn(opts.get_field("quantity").column)
+        sql = (
+            f"INSERT INTO {table} ({cart_col}, {item_col}, {quantity_col}) "
+            f"SELECT %s, {qn(item_opts.pk.column)}, %s FROM {qn(item_opts.db_table)} "
+            f"WHERE {qn(item_opts.get_field('slug').column)} = %s "
+            f"ON CONFLICT ({cart_col}, {item_col}) "
+            f"DO UPDATE SET {quantity_col} = {table}.{quantity_col} + excluded.{quantity_col}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [cart.pk, quantity, slug])
+            return cursor.rowcount > 0
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name="cart_items")
     item = models.ForeignKey(Items, on_delete=models.CASCADE, related_name="cart_items")
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
 
+    objects = CartItemManager()
+
     class Meta:
         unique_together = ("cart", "item")
 
@@ -0,0 +1,240 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique, index-backed ordering.
+
+    Unlike DRF's CursorPagination (which keys on the first ordering field and
+    falls back to offsets on ties), the cursor stores the value of every
+    ordering field, so each page is a single range scan on the matching
+    composite index no matter how deep the client pages. The last ordering
+    field must be unique (normally ``id``).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'CATALOG_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'CATALOG_MAX_PAGE_SIZE', 200)
+    ordering = ('item_name', 'id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset() for async views."""
+        return self.set_page([row async for row in self.page_queryset(queryset, request, view)])
+
+    def page_queryset(self, queryset, request, view):
+        """The query for the requested page, plus one row to tell whether there is a next one."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.position, self.reverse = self.decode_cursor(request)
+        order_by = [_invert(f) for f in self.ordering] if self.reverse else list(self.ordering)
+
+        queryset = queryset.order_by(*order_by)
+        if self.position is not None:
+            try:
+                queryset = queryset.filter(_keyset_filter(order_by, self.position))
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+            self.has_next = self.position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.position is not None
+
+        self.page = results
+        return results
+
+    def get_ordering(self, request, queryset, view):
+        return tuple(self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, TypeError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            # Paged past the end: the previous page ends at the cursor we were given.
+            return self.encode_cursor(self.position, reverse=True)
+        return self.encode_cursor(self.get_position(self.page[0]), reverse=True)
+
+    def get_position(self, obj):
+        fields = [f.lstrip('-') for f in self.ordering]
+        if isinstance(obj, dict):
+            return [_encode_value(obj[f]) for f in fields]
+        return [_encode_value(getattr(obj, f)) for f in fields]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            position, reverse, ordering = payload['p'], bool(payload.get('r')), payload['o']
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        # A cursor only makes sense for the ordering it was issued for
+        if ordering != ','.join(self.ordering) or not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, position, reverse):
+        payload = {'o': ','.join(self.ordering), 'p': position}
+        if reverse:
+            payload['r'] = 1
+        raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        encoded = base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class SearchPagination(BasePagination):
+    """
+    Page-number pagination for ranked search results.
+
+    Relevance order has no stable key to seek on, so pages are offsets;
+    there is no total count (that would mean evaluating every match).
+    """
+    page_query_param = 'page'
+    page_size_query_param = 'page_size'
+    page_size = getattr(settings, 'CATALOG_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'CATALOG_MAX_PAGE_SIZE', 200)
+    max_page = 100
+
+    get_page_size = KeysetPagination.get_page_size
+
+    def paginate_ids(self, fetch, request):
+        """Paginate ``fetch(limit, offset)``, which returns ids in rank order."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        try:
+            self.page_number = max(1, int(request.query_params.get(self.page_query_param, 1)))
+        except (TypeError, ValueError):
+            raise NotFound('Invalid page.')
+        if self.page_number > self.max_page:
+            raise NotFound('Invalid page.')
+        ids = fetch(self.page_size + 1, (self.page_number - 1) * self.page_size)
+        self.has_next = len(ids) > self.page_size
+        return ids[:self.page_size]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.page_number <= 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+
+class ItemsCursorPagination(KeysetPagination):
+    """
+    Catalog listing, by default in ``Items.Meta.ordering`` order with ``id``
+    as tiebreaker. Views pick another indexed ordering by setting
+    ``ordering`` on the paginator.
+    """
+    ordering = ('item_name', 'id')
+
+
+def _invert(field):
+    return field[1:] if field.startswith('-') else '-' + field
+
+
+def _encode_value(value):
+    # Keep full precision: DjangoJSONEncoder would truncate microseconds and
+    # the cursor has to compare equal to the stored value.
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _keyset_filter(order_by, position):
+    """
+    Rows strictly after ``position`` in ``order_by`` order.
+
+    Expands to ``(a > x) OR (a = x AND b > y) OR ...`` and additionally bounds
+    the leading column (``a >= x``) so the planner can turn it into an index
+    range scan instead of evaluating the OR over the whole table.
+    """
+    fields = [(f.lstrip('-'), f.startswith('-')) for f in order_by]
+    condition = Q()
+    equal = Q()
+    for (name, descending), value in zip(fields, position):
+        lookup = 'lt' if descending else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+
+    leading, descending = fields[0]
+    bound = Q(**{f'{leading}__{"lte" if descending else "gte"}': position[0]})
+    return bound & condition
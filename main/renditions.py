@@ -0,0 +1,99 @@
+"""
+Fixed-size renditions of uploaded pictures.
+
+Every picture is rendered once per size in RENDITIONS, as WebP and JPEG,
+under ``renditions/<VERSION>/<sha256 of the upload>/``. Storage is content
+addressed: the same image uploaded twice (or shared by several items) is
+rendered and stored once, and the model only records the hash. Changing the
+sizes or encoder settings means bumping VERSION and re-running
+``manage.py render_images``.
+"""
+import hashlib
+import io
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+VERSION = "v1"
+
+# name: (width, height, mode). "crop" fills the box exactly, "fit" keeps the
+# whole picture inside it; neither upscales.
+RENDITIONS = {
+    "thumb": (160, 160, "crop"),
+    "card": (480, 480, "fit"),
+    "full": (1600, 1600, "fit"),
+}
+
+FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+# Written last, so its presence means the whole set is there
+LAST_FILE = ("full", "jpeg")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def path(digest, name, fmt):
+    ext = "jpg" if fmt == "jpeg" else fmt
+    return f"renditions/{VERSION}/{digest[:2]}/{digest}/{name}.{ext}"
+
+
+def urls(digest, storage=default_storage):
+    """``{rendition: {format: url}}`` for a picture hash, or None."""
+    if not digest:
+        return None
+    return {
+        name: {fmt: storage.url(path(digest, name, fmt)) for fmt in FORMATS}
+        for name in RENDITIONS
+    }
+
+
+def render(data, storage=default_storage, force=False):
+    """
+    Store every rendition of the image bytes ``data``; returns its hash.
+
+    Skips the work when the set already exists, unless ``force``. Raises
+    PIL.UnidentifiedImageError for data that isn't an image.
+    """
+    digest = content_hash(data)
+    if not force and storage.exists(path(digest, *LAST_FILE)):
+        return digest
+
+    with Image.open(io.BytesIO(data)) as source:
+        source = ImageOps.exif_transpose(source)
+        has_alpha = source.mode in ("RGBA", "LA") or "transparency" in source.info
+        source = source.convert("RGBA" if has_alpha else "RGB")
+
+        files = []
+        for name, (width, height, mode) in RENDITIONS.items():
+            if mode == "crop":
+                size = (min(width, source.width), min(height, source.height))
+                image = ImageOps.fit(source, size, Image.Resampling.LANCZOS)
+            else:
+                image = source.copy()
+                image.thumbnail((width, height), Image.Resampling.LANCZOS)
+            for fmt, (pil_format, options) in FORMATS.items():
+                encoded = image.convert("RGB") if pil_format == "JPEG" and image.mode != "RGB" else image
+                buffer = io.BytesIO()
+                encoded.save(buffer, pil_format, **options)
+                files.append(((name, fmt), buffer.getvalue()))
+
+    files.sort(key=lambda entry: entry[0] == LAST_FILE)
+    for (name, fmt), content in files:
+        target = path(digest, name, fmt)
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(content))
+    return digest
+
+
+def render_stored(name, force=False, storage=default_storage):
+    """Render the stored file ``name``; returns ``(name, hash)``. Picklable, for process pool workers."""
+    with storage.open(name, "rb") as stored:
+        return name, render(stored.read(), storage=storage, force=force)
+
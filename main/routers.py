@@ -0,0 +1,219 @@
+"""
+Catalog reads from read replicas.
+
+Only views that set ``read_replica = True`` (the catalog GET views) read from
+a replica, and only the catalog tables (CATALOG_MODELS); carts, stock, auth
+and every write stay on the primary. ReplicaMiddleware picks one replica
+per request, round-robin, skipping replicas that failed in the last
+RETRY_SECONDS. If a query fails on the replica, the replica is marked down
+and the request runs again on the primary.
+
+Reads are sticky after writes: any successful POST/PUT/PATCH/DELETE sets a
+cookie that sends the client's catalog reads to the primary for
+STICKY_SECONDS, so users see their own changes despite replication lag.
+Other users may briefly see (and the catalog cache keep) data that is up to
+the replication lag old.
+"""
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.http import HttpResponse
+
+CATALOG_MODELS = {"main.Items", "main.ItemTombstone"}
+
+SAFE_METHODS = ("GET", "HEAD")
+
+_replica = ContextVar("replica", default=None)
+
+
+def options():
+    defaults = {
+        # Replica aliases; None means every database other than "default"
+        "ALIASES": None,
+        "STICKY_SECONDS": 5,
+        "RETRY_SECONDS": 30,
+        "COOKIE_NAME": "db_primary_until",
+    }
+    return {**defaults, **getattr(settings, "DATABASE_REPLICAS", {})}
+
+
+def replica_aliases():
+    aliases = options()["ALIASES"]
+    return list(aliases) if aliases is not None else [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+
+
+class Route:
+    """
+    Where catalog reads go, for the code running in a reading_from() block.
+    Mutable, so that ReplicaMiddleware can choose the replica once the view
+    is known, and see the failure the view ran into, from hooks that run in
+    a copy of the context (sync_to_async) rather than the context itself.
+    """
+    __slots__ = ("alias", "failed")
+
+    def __init__(self, alias=None):
+        self.alias = alias
+        self.failed = False
+
+
+@contextmanager
+def reading_from(alias):
+    """Send catalog reads in this context to the database ``alias``; yields the Route."""
+    route = Route(alias)
+    token = _replica.set(route)
+    try:
+        yield route
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        route = _replica.get()
+        if route is not None and route.alias is not None and model._meta.label in CATALOG_MODELS:
+            return route.alias
+        # Explicit, or rows loaded from a replica would be re-read and saved there
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replica_aliases():
+            return False
+        return None
+
+
+class ReplicaPool:
+    """Round-robin over replica aliases, skipping the ones marked down."""
+
+    def __init__(self, aliases, retry_seconds):
+        self.aliases = list(aliases)
+        self.retry_seconds = retry_seconds
+        self._turn = itertools.count()
+        self._down_until = {}
+
+    def choose(self):
+        """A reachable replica alias, or None to use the primary."""
+        start = next(self._turn)
+        now = time.monotonic()
+        for offset in range(len(self.aliases)):
+            alias = self.aliases[(start + offset) % len(self.aliases)]
+            if self._down_until.get(alias, 0) > now:
+                continue
+            try:
+                connections[alias].ensure_connection()
+            except DatabaseError:
+                self.mark_down(alias)
+                continue
+            return alias
+        return None
+
+    def mark_down(self, alias):
+        self._down_until[alias] = time.monotonic() + self.retry_seconds
+        connections[alias].close()
+
+
+class ReplicaMiddleware:
+    """
+    Sends the catalog reads of ``read_replica`` views to a replica. Keep it
+    last in MIDDLEWARE, so its process_exception sees a failed replica
+    before any other middleware does. The retry on the primary goes through
+    the view middleware again, so process_view hooks must not count a
+    request twice (see MetricsMiddleware.enter_view).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+        aliases = replica_aliases()
+        self.pool = ReplicaPool(aliases, options()["RETRY_SECONDS"]) if aliases else None
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.pool is None:
+            return self.get_response(request)
+        self.check_sticky(request)
+        with reading_from(None) as route:
+            response = self.get_response(request)
+            if route.failed:
+                response = self.get_response(self.retry_on_primary(request, route))
+        self.stick(request, response)
+        return response
+
+    async def __acall__(self, request):
+        if self.pool is None:
+            return await self.get_response(request)
+        self.check_sticky(request)
+        with reading_from(None) as route:
+            response = await self.get_response(request)
+            if route.failed:
+                response = await self.get_response(self.retry_on_primary(request, route))
+        self.stick(request, response)
+        return response
+
+    def check_sticky(self, request):
+        try:
+            request.use_primary = float(request.COOKIES.get(options()["COOKIE_NAME"], 0)) > time.time()
+        except ValueError:
+            request.use_primary = False
+
+    def stick(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            sticky = options()["STICKY_SECONDS"]
+            response.set_cookie(
+                options()["COOKIE_NAME"], f"{time.time() + sticky:.3f}", max_age=sticky, httponly=True, samesite="Lax",
+            )
+
+    def routes(self, request, view_func):
+        if self.pool is None or request.use_primary or request.method not in SAFE_METHODS:
+            return False
+        return getattr(getattr(view_func, "view_class", None), "read_replica", False)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.routes(request, view_func):
+            _replica.get().alias = self.pool.choose()
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if self.routes(request, view_func):
+            # Connections belong to the thread running the queries, not the event loop's
+            _replica.get().alias = await sync_to_async(self.pool.choose)()
+        return None
+
+    def process_exception(self, request, exception):
+        route = _replica.get()
+        if route is None or route.alias is None or not isinstance(exception, DatabaseError):
+            return None
+        if not self.replica_failed(route.alias):
+            return None
+        route.failed = True
+        # Discarded: __call__ runs the request again, on the primary
+        return HttpResponse(status=503)
+
+    def retry_on_primary(self, request, route):
+        route.alias, route.failed = None, False
+        request.use_primary = True
+        return request
+
+    def replica_failed(self, alias):
+        """Mark ``alias`` down if the error came from it."""
+        if not connections[alias].errors_occurred:
+            return False
+        self.pool.mark_down(alias)
+        return True
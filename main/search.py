@@ -0,0 +1,122 @@
+"""
+Full-text item search.
+
+SQLite keeps an FTS5 index (``main_items_fts``, external content over
+``main_items``) in sync through triggers; PostgreSQL uses a GIN index on the
+``to_tsvector`` of the same two columns. Both answer ranked, prefix-matching
+queries from the index instead of scanning the table with LIKE.
+"""
+import re
+
+from django.db import connections
+
+MAX_TERMS = 8
+
+SQLITE_INSTALL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS main_items_fts USING fts5(
+        item_name, item_description,
+        content='main_items', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS main_items_fts_insert AFTER INSERT ON main_items BEGIN
+        INSERT INTO main_items_fts(rowid, item_name, item_description)
+        VALUES (new.id, new.item_name, new.item_description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS main_items_fts_delete AFTER DELETE ON main_items BEGIN
+        INSERT INTO main_items_fts(main_items_fts, rowid, item_name, item_description)
+        VALUES ('delete', old.id, old.item_name, old.item_description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS main_items_fts_update AFTER UPDATE OF item_name, item_description ON main_items BEGIN
+        INSERT INTO main_items_fts(main_items_fts, rowid, item_name, item_description)
+        VALUES ('delete', old.id, old.item_name, old.item_description);
+        INSERT INTO main_items_fts(rowid, item_name, item_description)
+        VALUES (new.id, new.item_name, new.item_description);
+    END
+    """,
+    "INSERT INTO main_items_fts(main_items_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS main_items_fts_insert",
+    "DROP TRIGGER IF EXISTS main_items_fts_delete",
+    "DROP TRIGGER IF EXISTS main_items_fts_update",
+    "DROP TABLE IF EXISTS main_items_fts",
+]
+
+POSTGRES_DOCUMENT = "to_tsvector('english', coalesce(item_name, '') || ' ' || coalesce(item_description, ''))"
+
+POSTGRES_INSTALL = [
+    f"CREATE INDEX IF NOT EXISTS items_search_idx ON main_items USING GIN ({POSTGRES_DOCUMENT})",
+]
+
+POSTGRES_UNINSTALL = [
+    "DROP INDEX IF EXISTS items_search_idx",
+]
+
+
+def install(schema_editor):
+    """
+    Create (or re-create) the search index for the connection's backend.
+
+    Idempotent. SQLite drops triggers whenever Django rebuilds
+    ``main_items`` during a migration, so migrations that rebuild it run
+    this again.
+    """
+    statements = {'sqlite': SQLITE_INSTALL, 'postgresql': POSTGRES_INSTALL}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def uninstall(schema_editor):
+    statements = {'sqlite': SQLITE_UNINSTALL, 'postgresql': POSTGRES_UNINSTALL}
+    for sql in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def search_item_ids(query, limit, offset=0, using='default'):
+    """
+    Ids of items matching every term of ``query`` as a word prefix, best
+    match first, ties broken by id.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        # Every term is a quoted prefix query; FTS5 ANDs them
+        match = ' '.join(f'"{term}"*' for term in terms)
+        sql = (
+            "SELECT rowid FROM main_items_fts WHERE main_items_fts MATCH %s "
+            "ORDER BY bm25(main_items_fts, 10.0, 1.0), rowid LIMIT %s OFFSET %s"
+        )
+        params = [match, limit, offset]
+    elif connection.vendor == 'postgresql':
+        match = ' & '.join(f'{term}:*' for term in terms)
+        sql = (
+            f"SELECT id FROM main_items, to_tsquery('english', %s) query "
+            f"WHERE {POSTGRES_DOCUMENT} @@ query "
+            f"ORDER BY ts_rank({POSTGRES_DOCUMENT}, query) DESC, id LIMIT %s OFFSET %s"
+        )
+        params = [match, limit, offset]
+    else:
+        from .models import Items
+
+        queryset = Items.objects.using(using)
+        for term in terms:
+            queryset = queryset.filter(item_name__icontains=term)
+        return list(queryset.order_by('id').values_list('id', flat=True)[offset:offset + limit])
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
@@ -1,17 +1,37 @@
 from decimal import Decimal
 
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from . import inventory, renditions
 from .models import *
+from .timing import TimedSerializerMixin
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class RenditionsField(serializers.Field):
+    """URLs of a picture's renditions, from its stored hash (see main.renditions)."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("source", "picture_hash")
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return renditions.urls(value)
 
 
 class UserSerializer(serializers.ModelSerializer):
     user_password = serializers.CharField(write_only=True, required=False)
     user_id = serializers.UUIDField(read_only=True)
+    renditions = RenditionsField()
 
     class Meta:
         model = User
-        fields = ("user_id", "username", "user_password", "user_picture", "created_at")
+        fields = ("user_id", "username", "user_password", "user_picture", "renditions", "created_at")
         read_only_fields = ("created_at",)
 
     def create(self, validated_data):
@@ -27,12 +47,106 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
-class ItemsSerializer(serializers.ModelSerializer):
+class ItemsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     item_id = serializers.IntegerField(source='id', read_only=True)
+    renditions = RenditionsField()
+
     class Meta:
         model = Items
-        fields = ("item_id", "item_name", "item_description", "item_picture", "price", "created_at", "updated_at", "slug")
+        fields = ("item_id", "item_name", "item_description", "item_picture", "renditions", "price", "created_at", "updated_at", "slug")
         read_only_fields = ("created_at", "updated_at")
+        list_serializer_class = TimedListSerializer
+
+
+class QueryDateTimeField(serializers.DateTimeField):
+    def to_internal_value(self, value):
+        # An unencoded "+00:00" offset in a query string arrives as " 00:00"
+        if isinstance(value, str):
+            value = value.strip().replace(" ", "+")
+        return super().to_internal_value(value)
+
+
+class ItemListQuerySerializer(serializers.Serializer):
+    """
+    Query parameters of the catalog listing.
+
+    Every sort has a composite ``(column, id)`` index on Items, and range
+    filters are only accepted on the column being sorted by, so each valid
+    combination is a single index range scan. Filtering without a sort
+    picks the sort of the filtered column.
+    """
+    SORTS = {
+        "name": ("item_name", "id"),
+        "-name": ("-item_name", "-id"),
+        "price": ("price", "id"),
+        "-price": ("-price", "-id"),
+        "created": ("created_at", "id"),
+        "-created": ("-created_at", "-id"),
+        "updated": ("updated_at", "id"),
+        "-updated": ("-updated_at", "-id"),
+    }
+    # parameter -> (column, lookup)
+    RANGE_FILTERS = {
+        "min_price": ("price", "gte"),
+        "max_price": ("price", "lte"),
+        "created_after": ("created_at", "gte"),
+        "created_before": ("created_at", "lt"),
+        "updated_after": ("updated_at", "gte"),
+        "updated_before": ("updated_at", "lt"),
+        # Delta sync: everything changed strictly after the client's last fetch
+        "since": ("updated_at", "gt"),
+    }
+    DEFAULT_SORTS = {"price": "price", "created_at": "-created", "updated_at": "-updated"}
+
+    sort = serializers.ChoiceField(choices=list(SORTS), required=False)
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    created_after = QueryDateTimeField(required=False)
+    created_before = QueryDateTimeField(required=False)
+    updated_after = QueryDateTimeField(required=False)
+    updated_before = QueryDateTimeField(required=False)
+    since = QueryDateTimeField(required=False)
+
+    def validate(self, attrs):
+        filters = {name: value for name, value in attrs.items() if name in self.RANGE_FILTERS}
+        columns = {self.RANGE_FILTERS[name][0] for name in filters}
+        if len(columns) > 1:
+            raise ValidationError("Range filters can only be combined on a single column.")
+
+        sort = attrs.get("sort")
+        if "since" in attrs:
+            if sort not in (None, "updated"):
+                raise ValidationError({"sort": "since= always lists changes in 'updated' order."})
+            sort = "updated"
+        elif sort is None:
+            sort = self.DEFAULT_SORTS[next(iter(columns))] if columns else "name"
+        ordering = self.SORTS[sort]
+
+        sort_column = ordering[0].lstrip("-")
+        if columns and sort_column not in columns:
+            raise ValidationError({"sort": f"Filtering on {next(iter(columns))} requires sorting by it."})
+
+        attrs["ordering"] = ordering
+        attrs["filters"] = {
+            f"{self.RANGE_FILTERS[name][0]}__{self.RANGE_FILTERS[name][1]}": value
+            for name, value in filters.items()
+        }
+        return attrs
+
+
+class ItemTombstoneSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ItemTombstone
+        fields = ("item_id", "slug", "deleted_at")
+        list_serializer_class = TimedListSerializer
+
+
+def serializer_columns(serializer_class):
+    """Model fields a serializer reads, for pruning querysets with ``only()``."""
+    return tuple(
+        field.source for field in serializer_class().fields.values()
+        if not field.write_only and field.source != "*"
+    )
 
 
 class CartItemSerializer(serializers.ModelSerializer):
@@ -66,25 +180,39 @@ class CartItemSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
-class CartSerializer(serializers.ModelSerializer):
+class CartOperationSerializer(serializers.Serializer):
+    """One entry of a batch cart update (PATCH /cart/)."""
+    slug = serializers.SlugField()
+    quantity = serializers.IntegerField(min_value=0, default=1)
+    op = serializers.ChoiceField(choices=("add", "set", "remove"), default="add")
+
+    def validate(self, attrs):
+        if attrs["op"] == "add" and attrs["quantity"] < 1:
+            raise ValidationError({"quantity": "quantity must be >= 1"})
+        return attrs
+
+
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True)
     cart_items = CartItemSerializer(many=True, required=False)
     total_price = serializers.SerializerMethodField()
+    item_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Cart
-        fields = ("id", "user", "cart_items", "total_price")
+        fields = ("id", "user", "cart_items", "item_count", "total_price")
 
     def create(self, validated_data):
         cart_items_data = validated_data.pop("cart_items", [])
         user = validated_data.get("user") or self.context.get("request") and getattr(self.context.get("request"), "user", None)
         if user is None or user.is_anonymous:
             raise ValidationError("User must be set to create a cart")
-        cart = Cart.objects.create(user=user)
-        for ci in cart_items_data:
-            item = ci.get("item")
-            quantity = ci.get("quantity", 1)
-            CartItem.objects.create(cart=cart, item=item, quantity=quantity)
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.create(user_id=user.pk)
+                cart.apply_changes([(ci["item"].id, "add", ci.get("quantity", 1)) for ci in cart_items_data])
+        except inventory.OutOfStock as exc:
+            raise ValidationError({"cart_items": f"not enough stock for items {sorted(exc.item_ids)}"})
         return cart
 
     def update(self, instance, validated_data):
@@ -93,25 +221,41 @@ class CartSerializer(serializers.ModelSerializer):
             instance.user = user
             instance.save()
 
-        incoming = {ci["item"].id: ci for ci in validated_data.get("cart_items", [])}
-        existing_qs = instance.cart_items.select_related("item").all()
-        existing_ids = {ci.item.id for ci in existing_qs}
+        # Incoming lines replace the cart's contents
+        incoming = [(ci["item"].id, "set", ci.get("quantity", 1)) for ci in validated_data.get("cart_items", [])]
+        try:
+            with transaction.atomic():
+                instance.apply_changes(incoming, replace=True)
+        except inventory.OutOfStock as exc:
+            raise ValidationError({"cart_items": f"not enough stock for items {sorted(exc.item_ids)}"})
 
-        for item_id, ci in incoming.items():
-            obj, created = CartItem.objects.update_or_create(
-                cart=instance, item_id=item_id,
-                defaults={"quantity": ci.get("quantity", 1)}
-            )
+        return instance
 
-        to_remove = [ci for ci in existing_qs if ci.item.id not in incoming]
-        for ci in to_remove:
-            ci.delete()
+    # Both totals come from the lines prefetched by Cart.load_lines()
+    def get_total_price(self, obj):
+        return str(obj.get_total())
 
-        return instance
+    def get_item_count(self, obj):
+        return obj.get_totals()[0]
+
+
+class OrderItemSerializer(serializers.ModelSerializer):
+    item_id = serializers.IntegerField(read_only=True)
+    item_name = serializers.CharField(source="item.item_name", read_only=True)
+    total_price = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = ("id", "item_id", "item_name", "quantity", "unit_price", "total_price")
 
     def get_total_price(self, obj):
-        total = Decimal("0.00")
-        for ci in obj.cart_items.select_related("item").all():
-            price = ci.item.price or Decimal("0.00")
-            total += price * ci.quantity
-        return str(total)
+        return str(obj.get_total_price())
+
+
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    user = serializers.PrimaryKeyRelatedField(read_only=True)
+    lines = OrderItemSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ("id", "user", "item_count", "total", "created_at", "lines")
@@ -0,0 +1,75 @@
+import random
+
+from django.db.models import Q
+from django.utils.text import slugify
+
+# Room left in the slug column for a "-<n>" de-duplication suffix
+SUFFIX_RESERVE = 10
+# Items.save() de-duplicates with a random suffix: with D duplicates of a
+# name, a pick collides with probability D / 10**RANDOM_SUFFIX_DIGITS
+RANDOM_SUFFIX_DIGITS = 6
+# For names with nothing slugify() keeps (e.g. only CJK characters)
+FALLBACK_BASE = "item"
+
+
+def slug_base(name, max_length=50):
+    """Slug for ``name``, shortened so a numeric suffix still fits in the column."""
+    return slugify(name)[:max_length - SUFFIX_RESERVE].strip("-") or FALLBACK_BASE
+
+
+def prefix_range(field, base):
+    """
+    ``field`` starts with ``base-``, as a range on the column's index.
+
+    ``startswith`` compiles to LIKE, which SQLite cannot answer from an
+    index (its LIKE is case-insensitive); "." sorts right after "-".
+    """
+    return Q(**{f"{field}__gt": f"{base}-", f"{field}__lt": f"{base}."})
+
+
+def random_slug(base):
+    """``base-<n>`` with a random n of up to RANDOM_SUFFIX_DIGITS digits."""
+    return f"{base}-{random.randrange(1, 10 ** RANDOM_SUFFIX_DIGITS)}"
+
+
+def split_suffix(slug):
+    """Ways to read ``slug`` as ``(base, n)``: itself with n=0, and ``base-n`` if it ends in digits."""
+    yield slug, 0
+    base, sep, digits = slug.rpartition("-")
+    if sep and digits.isdigit() and not (len(digits) > 1 and digits[0] == "0"):
+        yield base, int(digits)
+
+
+class SlugAllocator:
+    """
+    Hands out unique slugs for a batch of new rows without per-row probing.
+
+    Every slug already taken under the batch's bases (``base`` and
+    ``base-n``) is read up front with one prefix query (per
+    ``QUERY_CHUNK`` distinct bases, to keep the SQL expression small);
+    after that allocate() is in-memory and continues after the highest
+    suffix in use.
+    """
+    QUERY_CHUNK = 200
+
+    def __init__(self, queryset, bases, field="slug"):
+        self.next_suffix = {}
+        bases = set(bases)
+        ordered = sorted(bases)
+        for start in range(0, len(ordered), self.QUERY_CHUNK):
+            prefix_match = Q()
+            for base in ordered[start:start + self.QUERY_CHUNK]:
+                prefix_match |= Q(**{field: base}) | prefix_range(field, base)
+            for slug in queryset.filter(prefix_match).values_list(field, flat=True).iterator():
+                self.reserve(slug, bases=bases)
+
+    def allocate(self, base):
+        suffix = self.next_suffix.get(base, 0)
+        self.next_suffix[base] = suffix + 1
+        return f"{base}-{suffix}" if suffix else base
+
+    def reserve(self, slug, bases=None):
+        """Mark ``slug`` as taken so allocate() never hands it out."""
+        for base, suffix in split_suffix(slug):
+            if bases is None or base in bases:
+                self.next_suffix[base] = max(self.next_suffix.get(base, 0), suffix + 1)
@@ -1,7 +1,1457 @@
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
 from decimal import Decimal
+from pathlib import Path
+from unittest import mock, skipUnless
 
-from django.test import TestCase
+from asgiref.sync import iscoroutinefunction, sync_to_async
 
-from .models import User, Category, Items, Cart, CartItem
-from .serializers import CartSerializer
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import Sum
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from django.utils.http import parse_http_date
+from PIL import Image
 
+from sbf.databases import from_env
+
+from . import benchmarks, inventory, metrics, renditions, timing, tokens, warmup
+from .cache import CatalogCache
+from .fastserializers import FastListSerializer, render_json
+from .models import AuthToken, User, Items, Cart, CartItem, ItemTombstone, Order
+from .search import search_item_ids
+from .serializers import CartSerializer, ItemsSerializer
+from .slugs import RANDOM_SUFFIX_DIGITS
+from .views import AllItemsAPIView, CartAPIView, ItemDetailAPIView, ItemExportAPIView, ItemSearchAPIView
+
+
+class CatalogListingQueryPlanTests(TestCase):
+    """Every sort/filter combination the listing accepts must be answered from an index."""
+
+    # (query params, index that must serve the listing query)
+    SUPPORTED = [
+        ({}, "items_name_id_idx"),
+        ({"sort": "-name"}, "items_name_id_idx"),
+        ({"sort": "price"}, "items_price_id_idx"),
+        ({"sort": "-price", "min_price": "5.00", "max_price": "50.00"}, "items_price_id_idx"),
+        ({"min_price": "5.00"}, "items_price_id_idx"),
+        ({"sort": "-created"}, "items_created_id_idx"),
+        ({"created_after": "2000-01-01T00:00:00Z", "created_before": "2100-01-01T00:00:00Z"}, "items_created_id_idx"),
+        ({"sort": "-updated", "updated_after": "2000-01-01T00:00:00Z"}, "items_updated_id_idx"),
+        ({"since": "2000-01-01T00:00:00Z"}, "items_updated_id_idx"),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(30):
+            Items.objects.create(item_name=f"Item {i % 7}", price=Decimal(i))
+
+    def setUp(self):
+        caches["catalog"].clear()
+
+    def listing_queries(self, params):
+        """SQL of the listing query for the first two pages of ``params``."""
+        queries = []
+        url, data = "/item_list/", {**params, "page_size": 5}
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, data)
+            self.assertEqual(response.status_code, 200, response.content)
+            queries += [q["sql"] for q in ctx.captured_queries if "ORDER BY" in q["sql"] and "main_items" in q["sql"]]
+            url, data = response.json()["next"], None
+        return queries
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return "\n".join(row[-1] for row in cursor.fetchall())
+
+    def test_supported_listings_use_an_index(self):
+        for params, index in self.SUPPORTED:
+            with self.subTest(params=params):
+                queries = self.listing_queries(params)
+                self.assertEqual(len(queries), 2)
+                for sql in queries:
+                    plan = self.explain(sql)
+                    self.assertIn(f"INDEX {index}", plan)
+                    self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_filtered_pages_are_range_searches(self):
+        sql = self.listing_queries({"min_price": "5.00", "max_price": "20.00"})[1]
+        self.assertRegex(self.explain(sql), r"SEARCH main_items USING INDEX items_price_id_idx \(price>\? AND price<\?\)")
+
+    def test_unindexed_combinations_are_rejected(self):
+        rejected = [
+            {"sort": "name", "min_price": "5.00"},
+            {"min_price": "5.00", "created_after": "2000-01-01T00:00:00Z"},
+            {"sort": "-created", "since": "2000-01-01T00:00:00Z"},
+            {"sort": "popularity"},
+        ]
+        for params in rejected:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/item_list/", params).status_code, 400)
+
+    def test_cursor_is_bound_to_its_sort(self):
+        next_url = self.client.get("/item_list/", {"sort": "price", "page_size": 5}).json()["next"]
+        cursor = next_url.split("cursor=")[1].split("&")[0]
+        response = self.client.get("/item_list/", {"sort": "name", "cursor": cursor})
+        self.assertEqual(response.status_code, 404)
+
+
+class KeysetPaginationTests(TestCase):
+    """Walking the listing by cursor visits every item exactly once, in order, whatever the ties."""
+
+    @classmethod
+    def setUpTestData(cls):
+        created = timezone.now()
+        for i in range(13):
+            Items.objects.create(item_name=f"Lamp {i % 3}", price=Decimal(i % 4) + Decimal("0.99"))
+        # Ties on every sort key, broken by id only
+        Items.objects.filter(id__in=Items.objects.order_by("id").values("id")[:8]).update(created_at=created)
+
+    def setUp(self):
+        caches["catalog"].clear()
+
+    def walk(self, params):
+        """Item ids page by page, following the next links from the first page of ``params``."""
+        pages, url, data = [], "/item_list/", {**params, "page_size": 4}
+        while url:
+            response = self.client.get(url, data)
+            self.assertEqual(response.status_code, 200, response.content)
+            pages.append([row["item_id"] for row in response.json()["results"]])
+            url, data = response.json()["next"], None
+        return pages
+
+    def cursor(self, url):
+        encoded = url.split("cursor=")[1].split("&")[0]
+        return json.loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+
+    def encode(self, payload):
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+    def test_cursor_holds_every_ordering_value(self):
+        response = self.client.get("/item_list/", {"sort": "-price", "page_size": 4}).json()
+        last = Items.objects.get(pk=response["results"][-1]["item_id"])
+        self.assertEqual(self.cursor(response["next"]), {"o": "-price,-id", "p": [str(last.price), last.id]})
+        self.assertIsNone(response["previous"])
+
+        response = self.client.get(response["next"]).json()
+        first = Items.objects.get(pk=response["results"][0]["item_id"])
+        self.assertEqual(self.cursor(response["previous"]), {"o": "-price,-id", "p": [str(first.price), first.id], "r": 1})
+
+    def test_pages_follow_the_sort_with_ties_broken_by_id(self):
+        orders = {
+            "name": lambda item: (item.item_name, item.id),
+            "-price": lambda item: (-item.price, -item.id),
+            "-created": lambda item: (-item.created_at.timestamp(), -item.id),
+        }
+        for sort, key in orders.items():
+            with self.subTest(sort=sort):
+                pages = self.walk({"sort": sort})
+                expected = [item.id for item in sorted(Items.objects.all(), key=key)]
+                self.assertEqual([item_id for page in pages for item_id in page], expected)
+                self.assertEqual(len(pages), 4)
+
+    def test_previous_links_walk_the_same_pages_back(self):
+        pages = self.walk({"sort": "-created"})
+        response = self.client.get("/item_list/", {"sort": "-created", "page_size": 4}).json()
+        while response["next"]:
+            response = self.client.get(response["next"]).json()
+        back = [[row["item_id"] for row in response["results"]]]
+        while response["previous"]:
+            response = self.client.get(response["previous"]).json()
+            back.append([row["item_id"] for row in response["results"]])
+        self.assertEqual(back, pages[::-1])
+
+    def test_invalid_and_forged_cursors_are_not_found(self):
+        cursors = [
+            "garbage!",
+            self.encode(["not", "an", "object"]),
+            base64.urlsafe_b64encode(b"{not json").decode(),
+            self.encode({"o": "item_name,id", "p": ["Lamp 1"]}),
+            self.encode({"o": "item_name,id", "p": "Lamp 1"}),
+            self.encode({"o": "price,id", "p": ["1.99", 1]}),
+            self.encode({"o": "-price,-id", "p": ["cheap", 1]}),
+            self.encode({"o": "-created_at,-id", "p": ["yesterday", 1]}),
+        ]
+        for cursor in cursors:
+            for sort in ("name", "-price", "-created"):
+                with self.subTest(cursor=cursor, sort=sort):
+                    self.assertEqual(self.client.get("/item_list/", {"sort": sort, "cursor": cursor}).status_code, 404)
+
+
+class ConditionalCatalogTests(TestCase):
+    """Listing and item detail answer revalidations with 304 until the catalog changes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.item = Items.objects.create(item_name="Kettle", price=Decimal("20.00"))
+        Items.objects.create(item_name="Mug", price=Decimal("5.00"))
+        # An hour old, so the next write moves Last-Modified to a later second
+        Items.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def setUp(self):
+        caches["catalog"].clear()
+        self.urls = ["/item_list/", f"/item/{self.item.pk}/"]
+
+    def revalidate(self, url, **headers):
+        """Status of a conditional GET of ``url``, the same from the catalog cache and without it."""
+        statuses = set()
+        for cached in (True, False):
+            if not cached:
+                caches["catalog"].clear()
+            statuses.add(self.client.get(url, **headers).status_code)
+        self.assertEqual(len(statuses), 1)
+        return statuses.pop()
+
+    def test_unchanged_catalog_is_not_modified(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(self.revalidate(url, HTTP_IF_NONE_MATCH=response["ETag"]), 304)
+                self.assertEqual(self.revalidate(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]), 304)
+                self.assertEqual(self.revalidate(url, HTTP_IF_NONE_MATCH='"other"'), 200)
+
+    def test_revalidation_skips_the_payload(self):
+        url = f"/item/{self.item.pk}/"
+        etag = self.client.get(url)["ETag"]
+        caches["catalog"].clear()
+        # The validator lookup only
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response["ETag"]), (304, etag))
+
+    def test_validators_change_with_the_item(self):
+        before = {url: self.client.get(url) for url in self.urls}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(f"/item/{self.item.pk}/", {"price": "22.00"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        for url, old in before.items():
+            with self.subTest(url=url):
+                new = self.client.get(url)
+                self.assertNotEqual(new["ETag"], old["ETag"])
+                self.assertGreater(parse_http_date(new["Last-Modified"]), parse_http_date(old["Last-Modified"]))
+                self.assertEqual(self.revalidate(url, HTTP_IF_NONE_MATCH=old["ETag"]), 200)
+                self.assertEqual(self.revalidate(url, HTTP_IF_MODIFIED_SINCE=old["Last-Modified"]), 200)
+
+    def test_deletion_changes_the_listing_validators(self):
+        old = self.client.get("/item_list/")
+        with self.captureOnCommitCallbacks(execute=True):
+            Items.objects.exclude(pk=self.item.pk).get().delete()
+        self.assertEqual(self.revalidate("/item_list/", HTTP_IF_NONE_MATCH=old["ETag"]), 200)
+
+
+class DeltaSyncTests(TestCase):
+    """?since= lists every change after the client's last sync, deletions included, across pages."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.synced = timezone.now() - timedelta(hours=1)
+        for i in range(10):
+            Items.objects.create(item_name=f"Chair {i}", price=Decimal("30.00"))
+        Items.objects.update(updated_at=cls.synced - timedelta(minutes=5))
+        # Changed after the sync, many in the same instant
+        cls.changed = list(Items.objects.order_by("id").values_list("id", flat=True)[:7])
+        Items.objects.filter(id__in=cls.changed[:5]).update(updated_at=cls.synced + timedelta(minutes=1))
+        Items.objects.filter(id__in=cls.changed[5:]).update(updated_at=cls.synced + timedelta(minutes=2))
+
+    def setUp(self):
+        caches["catalog"].clear()
+
+    def sync(self, since):
+        """Every page of ``?since=``: (item ids, deletions, last_modified of the first page)."""
+        ids, deleted = [], []
+        response = self.client.get("/item_list/", {"since": since, "page_size": 3}).json()
+        last_modified = response["last_modified"]
+        deleted += response["deleted"]
+        while True:
+            ids += [row["item_id"] for row in response["results"]]
+            if not response["next"]:
+                return ids, deleted, last_modified
+            response = self.client.get(response["next"]).json()
+            self.assertNotIn("deleted", response)
+
+    def test_pages_after_since_hold_every_change_once(self):
+        ids, deleted, last_modified = self.sync(self.synced.isoformat())
+        self.assertEqual(ids, self.changed)
+        self.assertEqual(deleted, [])
+        # Syncing again from where that left off finds nothing new
+        self.assertEqual(self.sync(last_modified)[:2], ([], []))
+
+    def test_deletions_are_reported_as_tombstones(self):
+        gone = Items.objects.exclude(id__in=self.changed).first()
+        gone_id = gone.id
+        with self.captureOnCommitCallbacks(execute=True):
+            gone.delete()
+        ids, deleted, _ = self.sync(self.synced.isoformat())
+        self.assertEqual(ids, self.changed)
+        self.assertEqual([(entry["item_id"], entry["slug"]) for entry in deleted], [(gone_id, gone.slug)])
+
+        # Only deletions after ``since`` are reported
+        ItemTombstone.objects.update(deleted_at=self.synced - timedelta(minutes=1))
+        caches["catalog"].clear()
+        self.assertEqual(self.sync(self.synced.isoformat())[1], [])
+
+
+def use_private_control_cache(test):
+    """
+    Point the shared 'control' cache at a fresh directory for ``test``: its
+    entries outlive the test's rolled back transaction.
+    """
+    location = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, location)
+    control = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}
+    test.enterContext(override_settings(CACHES={**settings.CACHES, "control": control}))
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        caches["catalog"].clear()
+        self.cache = CatalogCache(alias="catalog", local_max_entries=2)
+
+    def test_bump_invalidates_now_and_after_the_commit(self):
+        self.cache.set("items", "old")
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.cache.bump()
+            self.assertIsNone(self.cache.get("items"))
+            # A reader that ran before the commit cached what it saw
+            self.cache.set("items", "stale")
+            self.assertEqual(self.cache.get("items"), "stale")
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(self.cache.get("items"))
+
+    def test_local_entries_are_evicted_least_recently_used_first(self):
+        self.cache.set("a", "A")
+        self.cache.set("b", "B")
+        self.cache.get("a")
+        self.cache.set("c", "C")
+        self.assertEqual(self.cache.stats()["local_entries"], 2)
+        # Without the backend copies, only what the LRU kept is left
+        caches["catalog"].delete_many([self.cache.make_key(key) for key in "abc"])
+        self.assertEqual([self.cache.get(key) for key in "abc"], ["A", None, "C"])
+
+    def test_counters_add_up_across_threads(self):
+        self.cache.set("hit", 1)
+
+        def lookups():
+            for n in range(2000):
+                self.cache.get("hit" if n % 2 else "miss")
+
+        threads = [threading.Thread(target=lookups) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (8000, 8000))
+
+
+class SignedTokenTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="signer", user_password="secret")
+
+    def setUp(self):
+        use_private_control_cache(self)
+
+    def summary(self, token, **headers):
+        return self.client.get("/cart/summary/", HTTP_AUTHORIZATION=f"Token {token}", **headers).status_code
+
+    def test_signed_token_authenticates_until_it_expires(self):
+        token = tokens.issue(self.user)
+        self.assertTrue(tokens.is_signed_token(token))
+        self.assertEqual(tokens.verify(token).pk, self.user.pk)
+        self.assertEqual(self.summary(token), 200)
+
+        issued = time.time()
+        with mock.patch("django.core.signing.time.time", return_value=issued + settings.SIGNED_AUTH_TOKENS["MAX_AGE"] + 1):
+            self.assertIsNone(tokens.verify(token))
+            self.assertEqual(self.summary(token), 401)
+
+    def test_tampered_tokens_are_rejected(self):
+        token = tokens.issue(self.user)
+        payload, signature = token.rsplit(":", 1)
+        other = User.objects.create(username="mallory", user_password="secret")
+        forged = tokens.issue(other).rsplit(":", 1)[0] + ":" + signature
+        for value in (payload + ":" + signature[::-1], forged, token.replace(":", ":x", 1)):
+            with self.subTest(value=value):
+                self.assertIsNone(tokens.verify(value))
+                self.assertEqual(self.summary(value), 401)
+
+    def test_logout_revokes_signed_tokens_on_every_device(self):
+        phone, laptop = tokens.issue(self.user), tokens.issue(self.user)
+        self.assertEqual((self.summary(phone), self.summary(laptop)), (200, 200))
+        response = self.client.post("/logout/", HTTP_AUTHORIZATION=f"Token {phone}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((self.summary(phone), self.summary(laptop)), (401, 401))
+        self.assertEqual(self.summary(tokens.issue(User.objects.get(pk=self.user.pk))), 200)
+
+    def test_revocation_reaches_workers_sharing_the_version_cache(self):
+        token = tokens.issue(self.user)
+        self.assertEqual(tokens.current_version(self.user.pk), 0)  # cached, as another worker would have it
+        tokens.revoke(self.user.pk)
+        self.assertIsNone(tokens.verify(token))
+        with override_settings(SIGNED_AUTH_TOKENS={**settings.SIGNED_AUTH_TOKENS, "CACHE_ALIAS": "default"}):
+            caches["default"].set(tokens.version_key(self.user.pk), 0)
+            self.addCleanup(caches["default"].delete, tokens.version_key(self.user.pk))
+            # A process-local cache keeps accepting it until VERSION_CACHE_TIMEOUT
+            self.assertIsNotNone(tokens.verify(token))
+
+    def test_legacy_tokens_still_authenticate(self):
+        legacy = AuthToken.objects.create(user=self.user)
+        self.assertFalse(tokens.is_signed_token(legacy.token))
+        self.assertEqual(self.summary(legacy.token), 200)
+        self.client.cookies["auth_token"] = legacy.token
+        self.assertEqual(self.client.get("/cart/summary/").status_code, 200)
+        self.assertEqual(self.summary("not-a-token"), 401)
+
+        with override_settings(SIGNED_AUTH_TOKENS={**settings.SIGNED_AUTH_TOKENS, "ENABLED": False}):
+            self.assertEqual(self.summary(tokens.issue(self.user)), 401)
+            self.assertEqual(self.summary(legacy.token), 200)
+
+    def test_legacy_cookie_counts_when_the_signed_one_is_rejected(self):
+        legacy = AuthToken.objects.create(user=self.user)
+        signed = tokens.issue(self.user)
+        self.client.cookies["auth_token"] = legacy.token
+        self.client.cookies["auth_signed_token"] = signed
+        self.assertEqual(self.client.get("/cart/summary/").status_code, 200)
+
+        # Rolled back to legacy tokens only
+        with override_settings(SIGNED_AUTH_TOKENS={**settings.SIGNED_AUTH_TOKENS, "ENABLED": False}):
+            self.assertEqual(self.client.get("/cart/summary/").status_code, 200)
+        # Expired signed token
+        expired = time.time() + settings.SIGNED_AUTH_TOKENS["MAX_AGE"] + 1
+        with mock.patch("django.core.signing.time.time", return_value=expired):
+            self.assertIsNone(tokens.verify(signed))
+            self.assertEqual(self.client.get("/cart/summary/").status_code, 200)
+
+        del self.client.cookies["auth_token"]
+        with override_settings(SIGNED_AUTH_TOKENS={**settings.SIGNED_AUTH_TOKENS, "ENABLED": False}):
+            self.assertEqual(self.client.get("/cart/summary/").status_code, 401)
+
+    async def test_legacy_cookie_fallback_in_async_views(self):
+        legacy = await AuthToken.objects.acreate(user=self.user)
+        self.async_client.cookies["auth_token"] = legacy.token
+        self.async_client.cookies["auth_signed_token"] = tokens.issue(self.user)
+        with override_settings(SIGNED_AUTH_TOKENS={**settings.SIGNED_AUTH_TOKENS, "ENABLED": False}):
+            self.assertEqual((await self.async_client.get("/cart/")).status_code, 200)
+
+
+class RequestTimingTests(TestCase):
+    """A sample rate set at runtime reaches every worker through the shared control cache."""
+
+    def setUp(self):
+        use_private_control_cache(self)
+        self.enterContext(override_settings(
+            REQUEST_TIMING={**settings.REQUEST_TIMING, "SAMPLE_RATE": 0.0, "REFRESH_SECONDS": 5},
+        ))
+
+    def test_override_is_read_back_until_it_expires(self):
+        self.assertIsNone(timing.sample_rate_override())
+        timing.set_sample_rate(0.25)
+        self.assertEqual(timing.sample_rate_override(), (0.25, None))
+
+        now = time.time()
+        with mock.patch("main.timing.time.time", return_value=now):
+            timing.set_sample_rate(0.5, expire_after=60)
+            self.assertEqual(timing.sample_rate_override(), (0.5, now + 60))
+        with mock.patch("main.timing.time.time", return_value=now + 61):
+            self.assertIsNone(timing.sample_rate_override())
+
+        timing.set_sample_rate(0.25)
+        timing.set_sample_rate(None)
+        self.assertIsNone(timing.sample_rate_override())
+
+    def test_middleware_picks_up_a_new_rate_after_refresh_seconds(self):
+        middleware = timing.RequestTimingMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get("/")
+        with mock.patch("main.timing.time.monotonic", return_value=100.0):
+            self.assertNotIn("Server-Timing", middleware(request))
+            timing.set_sample_rate(1)
+            self.assertNotIn("Server-Timing", middleware(request))
+        with mock.patch("main.timing.time.monotonic", return_value=105.0):
+            self.assertIn("Server-Timing", middleware(request))
+
+    def test_process_local_cache_is_refused(self):
+        with override_settings(REQUEST_TIMING={"CACHE_ALIAS": "default"}):
+            with self.assertRaises(ImproperlyConfigured):
+                timing.set_sample_rate(0.5)
+            with self.assertRaisesMessage(CommandError, "LocMemCache"):
+                call_command("request_timing", sample_rate=0.5, stdout=io.StringIO())
+
+
+class MetricsTests(TestCase):
+    LINE = 'sbf_http_requests_total{view="test",method="GET",status="200"}'
+
+    def test_shards_of_every_thread_are_summed(self):
+        process = metrics.ProcessMetrics()
+
+        def record():
+            process.shard.inc("sbf_http_requests_total", (("view", "test"),), 2)
+            process.shard.observe("sbf_http_request_duration_seconds", (("view", "test"),), 0.02)
+
+        record()
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        snapshot = process.snapshot()
+        self.assertEqual(metrics.unpack(snapshot["counters"])["sbf_http_requests_total", (("view", "test"),)], 4)
+        histogram = metrics.unpack(snapshot["histograms"])["sbf_http_request_duration_seconds", (("view", "test"),)]
+        self.assertEqual(histogram[metrics.LATENCY_BUCKETS.index(0.025)], 2)
+        self.assertAlmostEqual(histogram[-1], 0.04)
+
+    def test_exited_workers_are_retained_when_their_pid_is_reused(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        labels = [["view", "test"], ["method", "GET"], ["status", "200"]]
+
+        def worker(pid, started, requests):
+            metrics.write_json(directory / f"{pid}-{started:.6f}.json", {
+                "pid": pid, "started": started, "counters": [["sbf_http_requests_total", labels, requests]],
+                "histograms": [], "gauges": [["sbf_http_requests_in_flight", [["view", "test"]], 1]],
+            })
+
+        exited = 4 * 1024 * 1024 + 1  # above pid_max: never alive
+        worker(exited, 1.0, 5)
+        # An earlier worker that had this process's pid
+        worker(os.getpid(), 2.0, 3)
+        with override_settings(METRICS={"DIR": str(directory)}):
+            for _ in range(2):
+                rendered = metrics.render(metrics.collect()).splitlines()
+                self.assertIn(f"{self.LINE} 8", rendered)
+                self.assertFalse([line for line in rendered if line.startswith('sbf_http_requests_in_flight{view="test"}')])
+        # This process's own snapshot and the retained totals
+        self.assertEqual(sorted(path.name for path in directory.glob("*.json")), [f"{os.getpid()}-{metrics.metrics.identity[1]:.6f}.json", metrics.RETAINED])
+
+    def test_endpoint_is_limited_to_allowed_networks(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE sbf_http_requests_total counter", response.content.decode())
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.7").status_code, 403)
+        with override_settings(METRICS={**settings.METRICS, "ALLOWED_NETWORKS": ["203.0.113.0/24"]}):
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="203.0.113.7").status_code, 200)
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+
+class CartTotalsTests(TestCase):
+    """The stored item_count/subtotal must follow every write path."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="shopper", user_password="secret")
+        cls.a = Items.objects.create(item_name="A", price=Decimal("1.50"))
+        cls.b = Items.objects.create(item_name="B", price=Decimal("2.25"))
+
+    def assertTotalsMatchLines(self):
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.item_count, cart.subtotal), cart.load_lines().get_totals())
+        self.assertFalse(Cart.objects.drifted().exists())
+        return cart
+
+    def test_write_paths_keep_totals(self):
+        cart = Cart.objects.ensure_for_user(self.user)
+        CartItem.objects.add(cart, self.a.slug, 3)
+        self.assertEqual(self.assertTotalsMatchLines().subtotal, Decimal("4.50"))
+
+        cart.apply_changes([(self.b.id, "add", 2), (self.a.id, "set", 1)])
+        self.assertEqual(self.assertTotalsMatchLines().subtotal, Decimal("6.00"))
+
+        self.b.price = Decimal("3.00")
+        self.b.save()
+        self.assertEqual(self.assertTotalsMatchLines().subtotal, Decimal("7.50"))
+
+        cart.remove_item(self.a)
+        self.assertEqual(self.assertTotalsMatchLines().item_count, 2)
+
+        self.b.delete()
+        self.assertEqual(self.assertTotalsMatchLines().item_count, 0)
+
+    def test_remove_item_uses_the_current_price(self):
+        cart = Cart.objects.ensure_for_user(self.user)
+        CartItem.objects.add(cart, self.a.slug, 2)
+        CartItem.objects.add(cart, self.b.slug, 1)
+        stale = Items.objects.get(pk=self.a.pk)
+        self.a.price = Decimal("4.00")
+        self.a.save()
+        cart.remove_item(stale)
+        self.assertEqual(self.assertTotalsMatchLines().subtotal, Decimal("2.25"))
+
+    def test_summary_reads_one_row(self):
+        cart = Cart.objects.ensure_for_user(self.user)
+        CartItem.objects.add(cart, self.a.slug, 2)
+        self.client.cookies["auth_signed_token"] = tokens.issue(self.user)
+        self.client.get("/cart/summary/")  # warms the token version cache
+        with self.assertNumQueries(1):
+            response = self.client.get("/cart/summary/")
+        self.assertEqual(response.json()["total_price"], "3.00")
+        response = self.client.get("/cart/summary/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+
+@skipUnless(connection.vendor == "sqlite", "FTS5 index")
+class SearchIndexTests(TestCase):
+    """The FTS5 index follows every write to main_items, through its triggers."""
+
+    def search(self, query):
+        return search_item_ids(query, limit=20)
+
+    def assertIndexInSync(self):
+        # FTS5 compares the index with the content table; raises when they differ
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO main_items_fts(main_items_fts, rank) VALUES ('integrity-check', 1)")
+
+    def test_insert_update_and_delete_keep_the_index_in_sync(self):
+        item = Items.objects.create(item_name="Walnut desk", price=1, item_description="Solid wood")
+        Items.objects.bulk_create([Items(item_name="Oak shelf", price=1, slug="oak-shelf")])
+        self.assertEqual(self.search("walnut"), [item.id])
+        self.assertEqual(len(self.search("oak")), 1)
+        self.assertIndexInSync()
+
+        item.item_name = "Cherry desk"
+        item.save()
+        Items.objects.filter(slug="oak-shelf").update(item_description="Fits a walnut desk")
+        self.assertEqual(self.search("cherry"), [item.id])
+        self.assertEqual(self.search("walnut"), [Items.objects.get(slug="oak-shelf").id])
+        self.assertEqual(self.search("wood"), [item.id])
+        self.assertIndexInSync()
+
+        item.delete()
+        Items.objects.filter(slug="oak-shelf").delete()
+        self.assertEqual(self.search("desk"), [])
+        self.assertIndexInSync()
+
+    def test_name_matches_rank_first(self):
+        in_description = Items.objects.create(item_name="Side table", price=1, item_description="Pairs with a lamp")
+        in_name = Items.objects.create(item_name="Lamp", price=1)
+        in_both = Items.objects.create(item_name="Lamp shade", price=1, item_description="For any lamp")
+        ranked = self.search("lamp")
+        self.assertEqual(set(ranked[:2]), {in_name.id, in_both.id})
+        self.assertEqual(ranked[2], in_description.id)
+
+    def test_terms_are_word_prefixes_and_all_required(self):
+        cafe = Items.objects.create(item_name="Café mug", price=1)
+        Items.objects.create(item_name="Café press", price=1)
+        self.assertEqual(self.search("caf mu"), [cafe.id])
+        self.assertEqual(self.search("CAFE MUG!"), [cafe.id])
+        self.assertEqual(self.search("afé"), [])
+
+    def test_endpoint_pages_ranked_results(self):
+        ids = [Items.objects.create(item_name=f"Lamp {i}", price=1).id for i in range(3)]
+        Items.objects.create(item_name="Floor", price=1, item_description="lamp")
+        response = self.client.get("/items/search/", {"q": "lamp", "page_size": 2}).json()
+        self.assertEqual([row["item_id"] for row in response["results"]], ids[:2])
+        response = self.client.get(response["next"]).json()
+        self.assertEqual(len(response["results"]), 2)
+        self.assertIsNone(response["next"])
+
+
+class SlugTests(TestCase):
+    def test_duplicate_names_get_unique_slugs(self):
+        slugs = [Items.objects.create(item_name="T-Shirt", price=1).slug for _ in range(5)]
+        self.assertEqual(slugs[0], "t-shirt")
+        self.assertEqual(len(set(slugs)), 5)
+        for slug in slugs[1:]:
+            self.assertRegex(slug, r"^t-shirt-[1-9][0-9]{0,5}$")
+
+    def test_cost_does_not_grow_with_duplicates(self):
+        Items.objects.create(item_name="Mug", price=1)
+        with CaptureQueriesContext(connection) as few:
+            Items.objects.create(item_name="Mug", price=1)
+        Items.objects.bulk_create([Items(item_name="Mug", price=1, slug=f"mug-{n}") for n in range(1000)])
+        with CaptureQueriesContext(connection) as many:
+            Items.objects.create(item_name="Mug", price=1)
+        self.assertEqual(len(many), len(few))
+
+    def test_collision_retries_with_another_suffix(self):
+        Items.objects.create(item_name="Kettle", price=1)
+        Items.objects.create(item_name="Kettle", price=1, slug="kettle-7")
+        # As if a concurrent save took the suffix first
+        with mock.patch("main.models.random_slug", side_effect=["kettle-7", "kettle-8"]):
+            self.assertEqual(Items.objects.create(item_name="Kettle", price=1).slug, "kettle-8")
+
+    def test_gives_up_after_the_last_attempt(self):
+        Items.objects.create(item_name="Kettle", price=1)
+        Items.objects.create(item_name="Kettle", price=1, slug="kettle-7")
+        item = Items(item_name="Kettle", price=1)
+        with mock.patch("main.models.random_slug", return_value="kettle-7"), self.assertRaises(IntegrityError):
+            item.save()
+        self.assertEqual(item.slug, "")
+        self.assertEqual(Items.objects.filter(item_name="Kettle").count(), 2)
+
+    def test_unicode_names(self):
+        self.assertEqual(Items.objects.create(item_name="Crème Brûlée", price=1).slug, "creme-brulee")
+        # Nothing slugify() keeps
+        self.assertEqual(Items.objects.create(item_name="抹茶", price=1).slug, "item")
+        self.assertRegex(Items.objects.create(item_name="煎茶", price=1).slug, r"^item-[0-9]+$")
+        long_name = Items.objects.create(item_name="Ünïcödé " * 20, price=1)
+        self.assertLessEqual(len(long_name.slug) + 1 + RANDOM_SUFFIX_DIGITS, Items._meta.get_field("slug").max_length)
+        self.assertTrue(long_name.slug.startswith("unicode-unicode"))
+
+
+class CartRenderingTests(TestCase):
+    """GET /cart/ costs the same few queries however many lines the cart holds."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="browser", user_password="secret")
+        cls.items = Items.objects.bulk_create([
+            Items(item_name=f"Spoon {n}", price=Decimal("1.25"), slug=f"spoon-{n}") for n in range(30)
+        ])
+
+    def setUp(self):
+        use_private_control_cache(self)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {tokens.issue(self.user)}"}
+        tokens.current_version(self.user.pk)  # cached, as for an active user
+        self.cart = Cart.objects.ensure_for_user(self.user)
+
+    def fill(self, lines):
+        self.cart.apply_changes([(item.id, "set", 2) for item in self.items[:lines]], replace=True)
+
+    def test_query_count_does_not_depend_on_the_lines(self):
+        for lines in (1, 30):
+            with self.subTest(lines=lines):
+                self.fill(lines)
+                # The cart row with its totals, then its lines joined to their items
+                with self.assertNumQueries(2):
+                    response = self.client.get("/cart/", **self.auth)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()["cart_items"]), lines)
+
+
+class CartDeleteWithoutCartTests(TestCase):
+    """DELETE /cart/ by a user who never had a cart leaves it uncreated."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="passerby", user_password="secret")
+        cls.item = Items.objects.create(item_name="Saucer", price=Decimal("4.00"))
+
+    def setUp(self):
+        use_private_control_cache(self)
+        self.auth = {"HTTP_AUTHORIZATION": f"Token {tokens.issue(self.user)}"}
+
+    def test_clear(self):
+        response = self.client.delete("/cart/", **self.auth)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+
+    def test_remove_item(self):
+        response = self.client.delete(
+            "/cart/", data={"slug": self.item.slug}, content_type="application/json", **self.auth
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+
+
+class CartItemAddTests(TestCase):
+    """CartItem.objects.add() creates or increments the line and moves the stored totals with it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="adder", user_password="secret")
+        cls.item = Items.objects.create(item_name="Teapot", price=Decimal("12.50"))
+
+    def setUp(self):
+        self.cart = Cart.objects.ensure_for_user(self.user)
+
+    def state(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        lines = dict(cart.cart_items.values_list("item__slug", "quantity"))
+        return lines, cart.item_count, cart.subtotal
+
+    def test_new_line(self):
+        self.assertTrue(CartItem.objects.add(self.cart, self.item.slug, 2))
+        self.assertEqual(self.state(), ({self.item.slug: 2}, 2, Decimal("25.00")))
+
+    def test_existing_line_is_incremented(self):
+        CartItem.objects.add(self.cart, self.item.slug, 2)
+        self.assertTrue(CartItem.objects.add(self.cart, self.item.slug, 3))
+        self.assertEqual(self.state(), ({self.item.slug: 5}, 5, Decimal("62.50")))
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 1)
+
+    def test_unknown_slug_changes_nothing(self):
+        CartItem.objects.add(self.cart, self.item.slug, 1)
+        self.assertFalse(CartItem.objects.add(self.cart, "no-such-item", 4))
+        self.assertEqual(self.state(), ({self.item.slug: 1}, 1, Decimal("12.50")))
+
+    def test_totals_match_the_lines(self):
+        other = Items.objects.create(item_name="Cup", price=Decimal("3.20"))
+        for slug, quantity in [(self.item.slug, 1), (other.slug, 4), (self.item.slug, 2)]:
+            CartItem.objects.add(self.cart, slug, quantity)
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual((cart.item_count, cart.subtotal), cart.load_lines().get_totals())
+        self.assertEqual((cart.item_count, cart.subtotal), (7, Decimal("50.30")))
+
+    def test_upsert_runs_on_the_write_database(self):
+        # The manager's own alias is the read database
+        with mock.patch.object(CartItem.objects, "_db", "replica"):
+            self.assertTrue(CartItem.objects.add(self.cart, self.item.slug, 1))
+        self.assertEqual(self.state()[0], {self.item.slug: 1})
+
+    def test_untracked_item_takes_four_statements(self):
+        # Totals; the stock UPDATE and the SELECT that finds the item untracked; the upsert
+        with self.assertNumQueries(4):
+            CartItem.objects.add(self.cart, self.item.slug, 1)
+
+
+class CartBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="batcher", user_password="secret")
+        cls.a = Items.objects.create(item_name="A", price=Decimal("1.00"))
+        cls.b = Items.objects.create(item_name="B", price=Decimal("2.00"))
+        cls.c = Items.objects.create(item_name="C", price=Decimal("3.00"))
+
+    def setUp(self):
+        self.client.cookies["auth_signed_token"] = tokens.issue(self.user)
+
+    def patch(self, operations):
+        response = self.client.patch("/cart/", operations, content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertFalse(Cart.objects.drifted().exists())
+        return {line["item"]["slug"]: line["quantity"] for line in response.json()["cart_items"]}
+
+    def test_set_add_and_remove(self):
+        self.assertEqual(self.patch([{"slug": self.a.slug, "quantity": 2}, {"slug": self.b.slug, "op": "set", "quantity": 5}]),
+                         {self.a.slug: 2, self.b.slug: 5})
+        self.assertEqual(self.patch([
+            {"slug": self.a.slug, "op": "add", "quantity": 3},
+            {"slug": self.b.slug, "op": "remove"},
+            {"slug": self.c.slug, "op": "set", "quantity": 1},
+            {"slug": self.c.slug, "op": "add", "quantity": 1},
+        ]), {self.a.slug: 5, self.c.slug: 2})
+        self.assertEqual(self.patch([{"slug": self.a.slug, "op": "set", "quantity": 0}]), {self.c.slug: 2})
+
+    def test_replace_drops_lines_not_mentioned(self):
+        inventory.set_stock(self.b, 10)
+        self.patch([{"slug": self.a.slug, "quantity": 2}, {"slug": self.b.slug, "quantity": 4}])
+        cart = Cart.objects.get(user=self.user)
+        with transaction.atomic():
+            cart.apply_changes([(self.c.id, "set", 3), (self.a.id, "add", 1)], replace=True)
+        self.assertEqual(dict(cart.cart_items.values_list("item_id", "quantity")), {self.a.id: 1, self.c.id: 3})
+        self.assertFalse(Cart.objects.drifted().exists())
+        self.assertEqual(inventory.available(self.b), 10)
+
+
+class ConcurrentTestCase(TransactionTestCase):
+    """Runs requests from several threads, each on its own database connection."""
+
+    def setUp(self):
+        # Writers wait for each other from BEGIN (SQLite) instead of failing when upgrading a read lock
+        if connection.vendor == "sqlite":
+            self.enterContext(mock.patch.dict(connections.settings["default"]["OPTIONS"], transaction_mode="IMMEDIATE"))
+
+    def run_concurrently(self, requests, workers=8):
+        """Call every function in ``requests`` from ``workers`` threads; returns their results in order."""
+        results = [None] * len(requests)
+        pending = list(enumerate(requests))
+        lock = threading.Lock()
+
+        def work():
+            try:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        n, request = pending.pop()
+                    try:
+                        results[n] = request()
+                    except Exception as exc:
+                        results[n] = exc
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+class ConcurrentCartTests(ConcurrentTestCase):
+    def test_batch_updates_do_not_lose_concurrent_adds(self):
+        user = User.objects.create(username="racer", user_password="secret")
+        item = Items.objects.create(item_name="Contended", price=Decimal("2.00"))
+        other = Items.objects.create(item_name="Other", price=Decimal("1.00"))
+        inventory.set_stock(item, 100)
+        auth = {"HTTP_AUTHORIZATION": f"Token {tokens.issue(user)}"}
+
+        def add():
+            return Client().post("/cart/", {"slug": item.slug, "quantity": 1}, content_type="application/json", **auth).status_code
+
+        def patch():
+            operations = [{"slug": other.slug, "op": "add", "quantity": 1}, {"slug": item.slug, "op": "add", "quantity": 2}]
+            return Client().patch("/cart/", operations, content_type="application/json", **auth).status_code
+
+        statuses = self.run_concurrently([add, patch] * 10)
+        self.assertEqual(statuses, [201, 200] * 10)
+        cart = Cart.objects.get(user=user)
+        self.assertEqual(cart.cart_items.get(item=item).quantity, 30)
+        self.assertEqual(inventory.available(item), 70)
+        self.assertEqual((cart.item_count, cart.subtotal), (40, Decimal("70.00")))
+        self.assertFalse(Cart.objects.drifted().exists())
+
+
+class ConcurrentStockTests(ConcurrentTestCase):
+    def test_concurrent_adds_never_oversell(self):
+        users = User.objects.bulk_create([User(username=f"buyer{n}", user_password="secret") for n in range(20)])
+        for shards in (None, 4):
+            with self.subTest(shards=shards):
+                item = Items.objects.create(item_name=f"Limited {shards}", price=Decimal("5.00"))
+                # 25 units spread over the shards; 20 buyers want 2 each
+                inventory.set_stock(item, 25, shards=shards)
+
+                def add(user):
+                    auth = {"HTTP_AUTHORIZATION": f"Token {tokens.issue(user)}"}
+                    return Client().post("/cart/", {"slug": item.slug, "quantity": 2}, content_type="application/json", **auth).status_code
+
+                statuses = self.run_concurrently([lambda user=user: add(user) for user in users])
+                self.assertEqual(sorted(statuses), [201] * 12 + [409] * 8)
+                self.assertEqual(inventory.available(item), 1)
+                self.assertEqual(CartItem.objects.filter(item=item).aggregate(total=Sum("quantity"))["total"], 24)
+                if shards:
+                    self.assertTrue(all(stock >= 0 for stock in item.stock_shard_rows.values_list("stock", flat=True)))
+
+
+class CheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="buyer", user_password="secret")
+        cls.items = [Items.objects.create(item_name=f"Item {i}", price=Decimal(i + 1)) for i in range(5)]
+
+    def setUp(self):
+        self.client.cookies["auth_signed_token"] = tokens.issue(self.user)
+
+    def fill_cart(self, count):
+        cart = Cart.objects.ensure_for_user(self.user)
+        cart.apply_changes([(item.id, "add", 2) for item in self.items[:count]])
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        self.client.get("/cart/summary/")  # warms the token version cache
+        for count in (1, 5):
+            self.fill_cart(count)
+            with self.assertNumQueries(9):  # 7 statements + savepoint/release
+                response = self.client.post("/checkout/", HTTP_IDEMPOTENCY_KEY=f"order-{count}")
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.json()["lines"]), count)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_idempotency_key_replays_the_order(self):
+        self.fill_cart(2)
+        first = self.client.post("/checkout/", HTTP_IDEMPOTENCY_KEY="retry-me")
+        self.fill_cart(1)
+        retry = self.client.post("/checkout/", HTTP_IDEMPOTENCY_KEY="retry-me")
+        self.assertEqual((first.status_code, retry.status_code), (201, 200))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(self.user.orders.count(), 1)
+
+    def test_integrity_errors_are_replayed_only_for_a_taken_key(self):
+        self.fill_cart(1)
+        client = Client(raise_request_exception=False)
+        client.cookies["auth_signed_token"] = tokens.issue(self.user)
+        with mock.patch.object(Order.objects, "place", side_effect=IntegrityError("order lines")):
+            # Not a missing order (404): the error itself
+            self.assertEqual(client.post("/checkout/").status_code, 500)
+            self.assertEqual(client.post("/checkout/", HTTP_IDEMPOTENCY_KEY="unused").status_code, 500)
+
+        first = self.client.post("/checkout/", HTTP_IDEMPOTENCY_KEY="raced")
+        # The clash a concurrent request with the same key runs into
+        with mock.patch.object(Order.objects, "place", side_effect=IntegrityError("orders_user_idempotency_key")):
+            retry = client.post("/checkout/", HTTP_IDEMPOTENCY_KEY="raced")
+        self.assertEqual((retry.status_code, retry["Idempotent-Replayed"]), (200, "true"))
+        self.assertEqual(retry.json(), first.json())
+
+
+class InventoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="flash", user_password="secret")
+        cls.item = Items.objects.create(item_name="Hot item", price=Decimal("5.00"))
+        cls.untracked = Items.objects.create(item_name="Plenty", price=Decimal("1.00"))
+
+    def setUp(self):
+        self.client.cookies["auth_signed_token"] = tokens.issue(self.user)
+
+    def add(self, item, quantity):
+        return self.client.post("/cart/", {"slug": item.slug, "quantity": quantity}, content_type="application/json")
+
+    def test_reservations_never_oversell(self):
+        for shards in (None, 4):
+            with self.subTest(shards=shards):
+                self.client.delete("/cart/", content_type="application/json")
+                inventory.set_stock(self.item, 5, shards=shards)
+                self.assertEqual(self.add(self.item, 3).status_code, 201)
+                self.assertEqual(self.add(self.item, 3).status_code, 409)
+                self.assertEqual(self.add(self.item, 2).status_code, 201)
+                self.assertEqual(inventory.available(self.item), 0)
+                self.assertEqual(self.add(self.untracked, 100).status_code, 201)
+
+                # Removing the line gives its 5 units back
+                self.client.delete("/cart/", {"slug": self.item.slug}, content_type="application/json")
+                self.assertEqual(inventory.available(self.item), 5)
+
+    def test_batch_is_all_or_nothing(self):
+        inventory.set_stock(self.item, 2)
+        response = self.client.patch("/cart/", [
+            {"slug": self.untracked.slug, "quantity": 1},
+            {"slug": self.item.slug, "quantity": 3},
+        ], content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(inventory.available(self.item), 2)
+
+    def test_save_does_not_overwrite_reservations(self):
+        inventory.set_stock(self.item, 5)
+        stale = Items.objects.get(pk=self.item.pk)
+        self.add(self.item, 2)
+        stale.item_name = "Renamed"
+        stale.save()
+        self.assertEqual(inventory.available(self.item), 3)
+
+    def test_expired_carts_release_stock(self):
+        inventory.set_stock(self.item, 5)
+        self.add(self.item, 4)
+        Cart.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        call_command("release_expired_carts", stdout=io.StringIO())
+        self.assertEqual(inventory.available(self.item), 5)
+        self.assertFalse(CartItem.objects.exists())
+
+
+class RenditionTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+
+    def upload(self, name):
+        data = io.BytesIO()
+        Image.new("RGB", (900, 600), "teal").save(data, "PNG")
+        return SimpleUploadedFile(name, data.getvalue(), content_type="image/png")
+
+    def test_identical_uploads_share_one_rendition_set(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Items.objects.create(item_name="First", price=1, item_picture=self.upload("a.png"))
+        with self.captureOnCommitCallbacks(execute=True):
+            second = Items.objects.create(item_name="Second", price=1, item_picture=self.upload("b.png"))
+        self.assertIsNotNone(first.picture_hash)
+        self.assertEqual(first.picture_hash, second.picture_hash)
+
+        urls = self.client.get(f"/item/{first.pk}/").json()["renditions"]
+        self.assertEqual(set(urls), {"thumb", "card", "full"})
+        thumb = urls["thumb"]["webp"].removeprefix(settings.MEDIA_URL)
+        with Image.open(f"{settings.MEDIA_ROOT}/{thumb}") as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (160, 160)))
+
+    def test_rendering_waits_for_the_commit(self):
+        with mock.patch("main.renditions.render_stored", wraps=renditions.render_stored) as render_stored:
+            with self.captureOnCommitCallbacks() as callbacks:
+                item = Items.objects.create(item_name="Later", price=1, item_picture=self.upload("c.png"))
+                render_stored.assert_not_called()
+            self.assertIsNone(Items.objects.get(pk=item.pk).picture_hash)
+            for callback in callbacks:
+                callback()
+            render_stored.assert_called_once_with(item.item_picture.name)
+        self.assertEqual(Items.objects.get(pk=item.pk).picture_hash, item.picture_hash)
+        self.assertIsNotNone(item.picture_hash)
+
+
+class ImportItemsTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+
+    def picture(self, name, color):
+        Image.new("RGB", (300, 200), color).save(Path(settings.MEDIA_ROOT, name))
+        return name
+
+    def run_import(self, *rows, update=True):
+        source = Path(settings.MEDIA_ROOT, "import.jsonl")
+        source.write_text("".join(json.dumps(row) + "\n" for row in rows))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_items", str(source), *(["--update"] if update else []), stdout=io.StringIO())
+
+    def test_update_only_writes_the_columns_a_row_gives(self):
+        self.run_import(
+            {"slug": "lamp", "item_name": "Lamp", "price": "10.00", "item_description": "Brass"},
+            {"slug": "desk", "item_name": "Desk", "price": "80.00", "item_description": "Oak"},
+        )
+        self.run_import(
+            {"slug": "lamp", "item_name": "Lamp", "price": "12.00"},
+            {"slug": "desk", "item_name": "Desk", "price": "90.00", "item_description": "Walnut"},
+        )
+        lamp, desk = Items.objects.get(slug="lamp"), Items.objects.get(slug="desk")
+        self.assertEqual((lamp.price, lamp.item_description), (Decimal("12.00"), "Brass"))
+        self.assertEqual((desk.price, desk.item_description), (Decimal("90.00"), "Walnut"))
+
+    def test_changed_picture_is_rendered_again(self):
+        self.run_import({"slug": "lamp", "item_name": "Lamp", "price": "10.00", "item_picture": self.picture("a.png", "teal")})
+        first = Items.objects.get(slug="lamp").picture_hash
+        self.assertIsNotNone(first)
+
+        self.run_import({"slug": "lamp", "item_name": "Lamp", "price": "11.00", "item_picture": "a.png"})
+        self.assertEqual(Items.objects.get(slug="lamp").picture_hash, first)
+
+        self.run_import({"slug": "lamp", "item_name": "Lamp", "price": "11.00", "item_picture": self.picture("b.png", "navy")})
+        lamp = Items.objects.get(slug="lamp")
+        self.assertEqual(lamp.item_picture.name, "b.png")
+        self.assertNotIn(lamp.picture_hash, (None, first))
+
+
+class FastListSerializerTests(TestCase):
+    """The fast listing path must produce exactly the bytes ItemsSerializer does."""
+
+    @classmethod
+    def setUpTestData(cls):
+        Items.objects.create(item_name="Plain", price=Decimal("0"))
+        Items.objects.create(
+            item_name="Ünïcode \u2028 \"quoted\" ✓", price=Decimal("12345678.90"), item_description="line\nbreak",
+            item_picture="items/2024/01/01/picture.png", picture_hash="ab" * 32,
+        )
+        for i in range(20):
+            Items.objects.create(item_name=f"Item {i}", price=Decimal(i) / 3)
+
+    def setUp(self):
+        caches["catalog"].clear()
+
+    def test_rows_render_like_items_serializer(self):
+        queryset = Items.objects.order_by("id")
+        fast = FastListSerializer(ItemsSerializer)
+        self.assertEqual(
+            render_json(fast.to_representation(fast.rows(queryset))),
+            render_json(ItemsSerializer(queryset, many=True).data),
+        )
+
+    def test_listing_bytes_do_not_depend_on_the_path(self):
+        requests = [
+            ("/item_list/", {"page_size": 7}),
+            ("/item_list/", {"sort": "-price", "min_price": "1.00"}),
+            ("/item_list/", {"since": "2000-01-01T00:00:00Z"}),
+            ("/items/search/", {"q": "item"}),
+        ]
+        for url, params in requests:
+            with self.subTest(url=url, params=params):
+                fast = self.client.get(url, params)
+                caches["catalog"].clear()
+                with mock.patch.object(AllItemsAPIView, "fast_list_serializer", None), \
+                        mock.patch.object(ItemSearchAPIView, "fast_list_serializer", None):
+                    slow = self.client.get(url, params)
+                caches["catalog"].clear()
+                self.assertEqual(fast.status_code, 200)
+                self.assertEqual(fast.content, slow.content)
+
+
+class ItemExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(12):
+            Items.objects.create(item_name=f"Export {i}", price=Decimal(i))
+
+    def export(self, **params):
+        response = self.client.get("/items/export/", params, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        return gzip.decompress(b"".join(response.streaming_content)).decode()
+
+    def test_ndjson_rows_match_the_listing_and_resume_after_id(self):
+        rows = [json.loads(line) for line in self.export().splitlines()]
+        listing = self.client.get("/item_list/", {"sort": "created", "page_size": 50}).json()["results"]
+        self.assertEqual(rows, listing)
+
+        resumed = [json.loads(line) for line in self.export(after_id=rows[4]["item_id"]).splitlines()]
+        self.assertEqual(resumed, rows[5:])
+
+    def test_csv_has_the_serializer_fields(self):
+        lines = list(csv.reader(io.StringIO(self.export(type="csv"))))
+        self.assertEqual(lines[0], list(ItemsSerializer().fields))
+        self.assertEqual(len(lines), 13)
+
+    @mock.patch.object(ItemExportAPIView, "chunk_size", 5)
+    async def test_asgi_streams_chunk_by_chunk(self):
+        response = await self.async_client.get("/items/export/")
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertGreater(len([chunk for chunk in chunks if chunk]), 1)
+        expected = await sync_to_async(self.export)()
+        self.assertEqual(b"".join(chunks).decode(), expected)
+
+
+class QueryBudgetTests(TestCase):
+    """Every route must stay within the query budget declared in main.benchmarks."""
+
+    def setUp(self):
+        caches["catalog"].clear()
+
+    def test_every_route_has_a_scenario(self):
+        from sbf.urls import urlpatterns
+
+        routes = {pattern.name for pattern in urlpatterns if getattr(pattern, "name", None)}
+        self.assertEqual(routes - {s.url_name for s in benchmarks.SCENARIOS}, set())
+
+    def test_routes_stay_within_budget(self):
+        data = benchmarks.seed(items=200, carts=3, max_lines=30)
+        for result in benchmarks.run(data, requests=3):
+            with self.subTest(result["scenario"].name):
+                self.assertLessEqual(result["queries"], result["scenario"].budget)
+                self.assertEqual(result["failed"], 0, result["statuses"])
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """Catalog GETs read from the replica; carts, writes and clients that just wrote use the primary."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A second connection to the test database stands in for a replica
+        connections.settings["replica"] = {**connections.settings["default"], "TEST": {"MIRROR": "default"}}
+        cls.databases = {"default", "replica"}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+
+    def setUp(self):
+        caches["catalog"].clear()
+        self.item = Items.objects.create(item_name="Replicated", price=Decimal("2.00"))
+        self.user = User.objects.create(username="reader", user_password="secret")
+
+    def replica_queries(self, method, path, **kwargs):
+        with CaptureQueriesContext(connections["replica"]) as ctx:
+            response = getattr(self.client, method)(path, content_type="application/json", **kwargs)
+        self.assertLess(response.status_code, 400, response.content)
+        caches["catalog"].clear()
+        return len(ctx.captured_queries)
+
+    def test_catalog_reads_use_the_replica_until_the_client_writes(self):
+        self.assertGreater(self.replica_queries("get", f"/item/{self.item.pk}/"), 0)
+        self.assertGreater(self.replica_queries("get", "/item_list/"), 0)
+        auth = {"HTTP_AUTHORIZATION": f"Token {tokens.issue(self.user)}"}
+        self.assertEqual(self.replica_queries("get", "/cart/", **auth), 0)
+
+        self.assertEqual(self.replica_queries("post", "/item_list/", data={"item_name": "New", "price": "1.00"}), 0)
+        self.assertEqual(self.replica_queries("get", f"/item/{self.item.pk}/"), 0)
+
+    def test_failing_replica_falls_back_to_the_primary(self):
+        with mock.patch.dict(connections["replica"].settings_dict, NAME="/nonexistent/replica.sqlite3"):
+            connections["replica"].close()
+            response = self.client.get(f"/item/{self.item.pk}/")
+        self.assertEqual(response.json()["item_name"], "Replicated")
+
+    def failing_replica(self):
+        """Patch every query on the replica, in any thread, to fail as a dropped connection would."""
+        self.replica_failures = 0
+        execute = CursorWrapper._execute
+
+        def fail(cursor, sql, params, *ignore):
+            if cursor.db.alias != "replica":
+                return execute(cursor, sql, params, *ignore)
+            self.replica_failures += 1
+            cursor.db.errors_occurred = True
+            raise OperationalError("replica went away")
+
+        return mock.patch.object(CursorWrapper, "_execute", fail)
+
+    def item_detail_metrics(self):
+        """This process's (requests recorded, requests in flight) for the item_detail view."""
+        snapshot = metrics.metrics.snapshot()
+        counters, gauges = metrics.unpack(snapshot["counters"]), metrics.unpack(snapshot["gauges"])
+        total = counters.get(("sbf_http_requests_total", (("view", "item_detail"), ("method", "GET"), ("status", "200"))), 0)
+        return total, gauges.get(("sbf_http_requests_in_flight", (("view", "item_detail"),)), 0)
+
+    def test_query_failing_on_the_replica_reruns_the_request_on_the_primary(self):
+        total, _ = self.item_detail_metrics()
+        with self.failing_replica(), CaptureQueriesContext(connection) as primary:
+            response = self.client.get(f"/item/{self.item.pk}/")
+        self.assertEqual(response.json()["item_name"], "Replicated")
+        self.assertEqual(self.replica_failures, 1)
+        self.assertGreater(len(primary.captured_queries), 0)
+        # Counted once, and no longer in flight
+        self.assertEqual(self.item_detail_metrics(), (total + 1, 0))
+
+    async def test_query_failing_on_the_replica_under_asgi(self):
+        with self.failing_replica():
+            total, _ = self.item_detail_metrics()
+            response = await self.async_client.get(f"/item/{self.item.pk}/")
+        self.assertEqual(response.json()["item_name"], "Replicated")
+        self.assertEqual(self.replica_failures, 1)
+        self.assertEqual(self.item_detail_metrics(), (total + 1, 0))
+
+    def test_other_middleware_hooks_still_run(self):
+        RecordingMiddleware.calls = []
+        self.enterContext(override_settings(MIDDLEWARE=[*settings.MIDDLEWARE, f"{__name__}.RecordingMiddleware"]))
+        with mock.patch.object(ItemDetailAPIView, "get", side_effect=ValueError):
+            client = Client(raise_request_exception=False)
+            self.assertEqual(client.get(f"/item/{self.item.pk}/").status_code, 500)
+        self.assertEqual(RecordingMiddleware.calls, ["process_view", "ValueError"])
+
+
+class RecordingMiddleware:
+    """Records the view hooks Django calls on it."""
+    calls = []
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.calls.append("process_view")
+
+    def process_exception(self, request, exception):
+        self.calls.append(type(exception).__name__)
+
+
+class DatabaseProfileTests(TestCase):
+    postgres = {"DATABASE_URL": "postgres://shop:secret@db:5432/shop"}
+
+    def test_profiles(self):
+        postgres = self.postgres
+        persistent = from_env(postgres, default="", profile="persistent")["default"]
+        self.assertEqual((persistent["CONN_MAX_AGE"], persistent["CONN_HEALTH_CHECKS"]), (600, True))
+        with mock.patch("sbf.databases.find_spec", return_value=True):
+            pooled = from_env(postgres, default="", profile="pooled")["default"]
+        self.assertIn("pool", pooled["OPTIONS"])
+        self.assertNotIn("CONN_MAX_AGE", pooled)
+        self.assertNotIn("CONN_MAX_AGE", from_env(postgres, default="")["default"])
+
+    def test_pooled_profile_needs_psycopg3(self):
+        for missing in ("psycopg", "psycopg_pool"):
+            with self.subTest(missing=missing), mock.patch("sbf.databases.find_spec", side_effect=lambda name: name != missing):
+                with self.assertRaisesMessage(ImproperlyConfigured, "psycopg[binary,pool]"):
+                    from_env(self.postgres, default="", profile="pooled")
+        # SQLite has no pool and never needs psycopg
+        sqlite = from_env({}, default="sqlite:///shop.sqlite3", profile="pooled")["default"]
+        self.assertEqual(sqlite["CONN_MAX_AGE"], 600)
+
+    @override_settings(DATABASE_PROFILE="persistent")
+    def test_sqlite_connections_get_the_pragmas(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = from_env({}, default=f"sqlite:///{path}/profile.sqlite3", profile="persistent")["default"]
+        wrapper = SQLiteDatabaseWrapper({**connection.settings_dict, **config}, alias="profile")
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        pragmas = {name: wrapper.connection.execute(f"PRAGMA {name}").fetchone()[0] for name in ("journal_mode", "busy_timeout")}
+        self.assertEqual(pragmas, {"journal_mode": "wal", "busy_timeout": 5000})
+
+
+class AsyncReadViewTests(TestCase):
+    """With ASYNC_READ_VIEWS, catalog and cart GETs are served by aget() and answer exactly like get()."""
+
+    HEADERS = ("Content-Type", "ETag", "Last-Modified", "X-Cache", "Vary", "Allow", "WWW-Authenticate")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="async", user_password="secret")
+        cls.items = [Items.objects.create(item_name=f"Async {i}", price=Decimal(i)) for i in range(5)]
+        Cart.objects.ensure_for_user(cls.user).apply_changes([(cls.items[0].pk, "add", 2), (cls.items[3].pk, "add", 1)])
+
+    def setUp(self):
+        caches["catalog"].clear()
+        with self.settings(ASYNC_READ_VIEWS=True):
+            # A class: URL resolvers are cached by urlconf
+            self.urlconf = type("AsyncURLConf", (), {"urlpatterns": [
+                path("item_list/", AllItemsAPIView.as_view(), name="item_list"),
+                path("item/<int:id>/", ItemDetailAPIView.as_view(), name="item_detail"),
+                path("cart/", CartAPIView.as_view(), name="cart"),
+            ]})
+
+    async def test_responses_match_the_sync_views(self):
+        self.assertTrue(all(iscoroutinefunction(pattern.callback) for pattern in self.urlconf.urlpatterns))
+        auth = {"Authorization": f"Token {tokens.issue(self.user)}"}
+        requests = [
+            ("/item_list/", {"page_size": 2}, {}),
+            ("/item_list/", {"sort": "-price", "since": "2000-01-01T00:00:00Z"}, {}),
+            ("/item_list/", {"sort": "sideways"}, {}),
+            ("/item_list/", {"cursor": "garbage"}, {}),
+            (f"/item/{self.items[1].pk}/", {}, {}),
+            ("/item/999999/", {}, {}),
+            ("/cart/", {}, auth),
+            ("/cart/", {}, {}),
+        ]
+        for url, params, headers in requests:
+            with self.subTest(url=url, params=params, headers=headers):
+                expected = await sync_to_async(self.client.get)(url, params, headers=headers)
+                await sync_to_async(caches["catalog"].clear)()
+                with override_settings(ROOT_URLCONF=self.urlconf), \
+                        mock.patch.object(AllItemsAPIView, "get", side_effect=AssertionError("sync path")), \
+                        mock.patch.object(ItemDetailAPIView, "get", side_effect=AssertionError("sync path")), \
+                        mock.patch.object(CartAPIView, "get", side_effect=AssertionError("sync path")):
+                    response = await self.async_client.get(url, params, headers=headers)
+                await sync_to_async(caches["catalog"].clear)()
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.content, expected.content)
+                for header in self.HEADERS:
+                    self.assertEqual(response.get(header), expected.get(header), header)
+
+
+class WarmupTests(TestCase):
+    def setUp(self):
+        caches["catalog"].clear()
+
+    @override_settings(WARMUP={"PREFILL_URLS": ["http://testserver/item_list/?page_size=2"]})
+    def test_prefilled_pages_are_cache_hits(self):
+        Items.objects.create(item_name="Warm", price=Decimal("1.00"))
+        # Closing would end the test's transaction
+        with mock.patch.object(connections, "close_all") as close_all:
+            steps = [name for name, _ in warmup.warm_up()]
+        close_all.assert_called_once()
+        self.assertIn("prefill http://testserver/item_list/?page_size=2 (200 MISS)", steps)
+
+        self.assertEqual(self.client.get("/item_list/", {"page_size": 2})["X-Cache"], "HIT")
+        self.assertEqual(self.client.get("/item_list/", {"page_size": 3})["X-Cache"], "MISS")
+
+
+@override_settings(THROTTLING={"CACHE_ALIAS": "throttle", "RATES": {"login_ip": "3/min", "login_username": "2/min"}})
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        caches["throttle"].clear()
+
+    def login(self, username, address):
+        return self.client.post(
+            "/login/", {"username": username, "user_password": "guess"}, content_type="application/json", REMOTE_ADDR=address,
+        )
+
+    def test_bursts_per_username_and_per_address_get_429_before_any_query(self):
+        # One username from many addresses
+        self.assertEqual([self.login("Victim", f"10.0.0.{n}").status_code for n in range(2)], [401, 401])
+        with self.assertNumQueries(0):
+            response = self.login(" victim", "10.0.0.9")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+
+        # Many usernames from one address
+        self.assertEqual([self.login(f"user{n}", "10.0.1.1").status_code for n in range(3)], [401, 401, 401])
+        self.assertEqual(self.login("user9", "10.0.1.1").status_code, 429)
+
+    def test_buckets_refill_over_time(self):
+        now = time.time()
+        with mock.patch("main.throttling.time.time", return_value=now):
+            self.assertEqual([self.login("refill", f"10.0.2.{n}").status_code for n in range(3)], [401, 401, 429])
+        with mock.patch("main.throttling.time.time", return_value=now + 31):
+            self.assertEqual([self.login("refill", f"10.0.3.{n}").status_code for n in range(2)], [401, 429])
@@ -0,0 +1,101 @@
+"""
+Token-bucket rate limiting for DRF views.
+
+Each key (a client IP, a username) has a bucket of ``burst`` tokens that
+refills continuously at ``burst`` per period; a request takes one token
+and is refused with 429 and a Retry-After header when none is left. A
+check is one cache read and one write of ``(tokens, timestamp)``, made
+before the view runs (DRF's check_throttles), and a bucket is dropped from
+the cache once it would be full again, so memory is bounded by the keys
+active in the last period (and by the cache's MAX_ENTRIES).
+
+Views opt in with ``throttle_classes`` and a ``throttle_scope``; the rates
+are THROTTLING["RATES"]["<scope>_<kind>"] (kind "ip" or "username") as
+"burst/period", the period being s, min, hour or day. A scope without a
+rate is not throttled. Buckets live in the cache alias CACHE_ALIAS: local
+memory is per worker; a FileBasedCache in /dev/shm shares them between
+the workers of a host. Concurrent requests from different workers may
+both take the last token, so the limit is approximate across workers.
+"""
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def options():
+    defaults = {"CACHE_ALIAS": "throttle", "RATES": {}}
+    return {**defaults, **getattr(settings, "THROTTLING", {})}
+
+
+def parse_rate(rate):
+    """``"10/min"`` -> (10, 60)."""
+    burst, period = rate.split("/")
+    return int(burst), PERIODS[period[0]]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # Subclasses set the kind of key they throttle on and return it from get_key()
+    kind = None
+    # Makes read-update-write of a bucket atomic within the process
+    lock = threading.Lock()
+
+    def get_key(self, request, view):
+        """The key to throttle on, or None to let the request through."""
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        self.delay = None
+        opts = options()
+        rate_name = f"{getattr(view, 'throttle_scope', None)}_{self.kind}"
+        rate = opts["RATES"].get(rate_name)
+        if rate is None:
+            return True
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+
+        burst, period = parse_rate(rate)
+        refill = burst / period
+        cache = caches[opts["CACHE_ALIAS"]]
+        # Fixed length whatever the client sent
+        cache_key = f"throttle:{rate_name}:{hashlib.md5(key.encode('utf-8'), usedforsecurity=False).hexdigest()}"
+        with self.lock:
+            now = time.time()
+            tokens, updated = cache.get(cache_key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * refill)
+            if tokens < 1:
+                self.delay = (1 - tokens) / refill
+                return False
+            tokens -= 1
+            # Once full again the bucket is the same as a missing one
+            cache.set(cache_key, (tokens, now), timeout=math.ceil((burst - tokens) / refill))
+        return True
+
+    def wait(self):
+        return self.delay
+
+
+class ClientIPThrottle(TokenBucketThrottle):
+    """Per client address (REMOTE_ADDR, or X-Forwarded-For behind NUM_PROXIES proxies)."""
+    kind = "ip"
+
+    def get_key(self, request, view):
+        return self.get_ident(request)
+
+
+class UsernameThrottle(TokenBucketThrottle):
+    """Per ``username`` in the request body, whichever address it comes from."""
+    kind = "username"
+
+    def get_key(self, request, view):
+        username = request.data.get("username") if hasattr(request.data, "get") else None
+        if not isinstance(username, str) or not username.strip():
+            return None
+        return username.strip().lower()
@@ -0,0 +1,245 @@
+"""
+Per-request query and timing instrumentation.
+
+RequestTimingMiddleware counts SQL queries and time (through an execute
+wrapper on every connection, see install_query_hook), serializer time (TimedSerializerMixin) and
+total time for a sample of requests, reports them in a ``Server-Timing``
+header and logs requests over the configured budgets together with their
+SQL. Unsampled requests pay for one comparison.
+
+The sample rate can be overridden at runtime (set_sample_rate()). The
+override lives in the cache alias CACHE_ALIAS, which must be shared by the
+workers (not local memory), and each worker re-reads it every
+REFRESH_SECONDS.
+"""
+import logging
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger("main.timing")
+
+SAMPLE_RATE_KEY = "request_timing:sample_rate"
+
+_current = ContextVar("request_timing", default=None)
+
+
+def options():
+    defaults = {
+        "SAMPLE_RATE": 0.0,
+        "QUERY_BUDGET": 20,
+        "LATENCY_BUDGET_MS": 500,
+        # Where set_sample_rate() stores its override, and how often workers re-read it
+        "CACHE_ALIAS": "control",
+        "REFRESH_SECONDS": 5,
+        "MAX_LOGGED_QUERIES": 50,
+    }
+    return {**defaults, **getattr(settings, "REQUEST_TIMING", {})}
+
+
+def override_cache():
+    """The cache holding the runtime sample rate; ImproperlyConfigured if workers can't share it."""
+    alias = options()["CACHE_ALIAS"]
+    cache = caches[alias]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            f"REQUEST_TIMING['CACHE_ALIAS'] {alias!r} is {type(cache).__name__}; the workers would not see "
+            f"a sample rate stored there. Use a cache they share (e.g. FileBasedCache)."
+        )
+    return cache
+
+
+def set_sample_rate(rate, expire_after=None):
+    """
+    Override the sample rate at runtime (0 disables, 1 samples everything).
+
+    Workers pick the new rate up within REFRESH_SECONDS and go back to the
+    setting ``expire_after`` seconds later (never when None). ``rate=None``
+    removes the override.
+    """
+    cache = override_cache()
+    if rate is None:
+        cache.delete(SAMPLE_RATE_KEY)
+    else:
+        until = None if expire_after is None else time.time() + expire_after
+        cache.set(SAMPLE_RATE_KEY, (float(rate), until), timeout=expire_after)
+
+
+def sample_rate_override():
+    """``(rate, until)`` of the runtime override, or None."""
+    return unexpired(override_cache().get(SAMPLE_RATE_KEY))
+
+
+def unexpired(value):
+    # Checked here as well as by the cache timeout: the cache may keep an
+    # expired entry until it is read
+    if value is None or (value[1] is not None and value[1] <= time.time()):
+        return None
+    return value
+
+
+def current():
+    """The RequestTiming of the request being sampled, or None."""
+    return _current.get()
+
+
+class RequestTiming:
+    def __init__(self, max_logged_queries):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.statements = []
+        self.max_logged_queries = max_logged_queries
+        self._serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.sql_time += elapsed
+            if len(self.statements) < self.max_logged_queries:
+                self.statements.append((elapsed, sql))
+
+    def serializer_span(self):
+        return _SerializerSpan(self)
+
+
+def time_query(execute, sql, params, many, context):
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    return timing(execute, sql, params, many, context)
+
+
+def install_query_hook(sender, connection, **kwargs):
+    """connection_created receiver; see main.metrics.install_query_hook."""
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, time_query)
+
+
+class _SerializerSpan:
+    # Nested serializers run inside their parent's span; only the outermost counts.
+    __slots__ = ("timing", "started")
+
+    def __init__(self, timing):
+        self.timing = timing
+
+    def __enter__(self):
+        self.timing._serializer_depth += 1
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timing._serializer_depth -= 1
+        if not self.timing._serializer_depth:
+            self.timing.serializer_time += time.perf_counter() - self.started
+
+
+class TimedSerializerMixin:
+    """Adds the time spent producing ``serializer.data`` to the sampled request's timing."""
+
+    @property
+    def data(self):
+        timing = _current.get()
+        if timing is None:
+            return super().data
+        with timing.serializer_span():
+            return super().data
+
+
+class RequestTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        opts = options()
+        self.configured_rate = opts["SAMPLE_RATE"]
+        self.sample_rate = self.configured_rate
+        self.query_budget = opts["QUERY_BUDGET"]
+        self.latency_budget = opts["LATENCY_BUDGET_MS"] / 1000
+        self.refresh_seconds = opts["REFRESH_SECONDS"]
+        self.max_logged_queries = opts["MAX_LOGGED_QUERIES"]
+        self.refresh_at = 0.0
+        try:
+            self.override_cache = override_cache()
+        except ImproperlyConfigured:
+            # Runtime overrides are off; the configured rate applies
+            self.override_cache = None
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        now = time.monotonic()
+        if now >= self.refresh_at and self.override_cache is not None:
+            self.refresh_at = now + self.refresh_seconds
+            self.refresh(self.override_cache.get(SAMPLE_RATE_KEY))
+        if not self.sampled():
+            return self.get_response(request)
+
+        timing = RequestTiming(self.max_logged_queries)
+        token = _current.set(timing)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.report(request, response, timing, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        now = time.monotonic()
+        if now >= self.refresh_at and self.override_cache is not None:
+            self.refresh_at = now + self.refresh_seconds
+            self.refresh(await self.override_cache.aget(SAMPLE_RATE_KEY))
+        if not self.sampled():
+            return await self.get_response(request)
+
+        timing = RequestTiming(self.max_logged_queries)
+        token = _current.set(timing)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.report(request, response, timing, time.perf_counter() - started)
+        return response
+
+    def refresh(self, value):
+        override = unexpired(value)
+        self.sample_rate = self.configured_rate if override is None else override[0]
+
+    def sampled(self):
+        rate = self.sample_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def report(self, request, response, timing, total):
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={timing.sql_time * 1000:.1f};desc="{timing.queries} queries"',
+            f"ser;dur={timing.serializer_time * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        ])
+        if timing.queries > self.query_budget or total > self.latency_budget:
+            self.log_over_budget(request, response, timing, total)
+
+    def log_over_budget(self, request, response, timing, total):
+        statements = "\n".join(f"  {elapsed * 1000:7.2f}ms  {sql}" for elapsed, sql in timing.statements)
+        logger.warning(
+            "%s %s -> %s over budget: %d queries (budget %d), %.1fms (budget %.0fms), "
+            "%.1fms in SQL, %.1fms serializing\n%s",
+            request.method, request.get_full_path(), response.status_code,
+            timing.queries, self.query_budget, total * 1000, self.latency_budget * 1000,
+            timing.sql_time * 1000, timing.serializer_time * 1000, statements,
+        )
@@ -0,0 +1,140 @@
+"""
+Stateless signed auth tokens.
+
+A signed token is ``signing.dumps({"u": user_id, "v": token_version})``:
+Django's HMAC signer over the payload and its issue time, keyed by
+SECRET_KEY. Verifying one needs no database query; the only state is the
+user's ``token_version``, read through the cache alias CACHE_ALIAS, and
+bumping it (revoke()) invalidates every token issued before.
+
+Revocation is per user, not per token: logging out on one device signs
+out all of them, as the legacy AuthToken (one per user) would. With a
+CACHE_ALIAS the workers share, every worker sees a revocation on its next
+request; with a process-local one, after at most VERSION_CACHE_TIMEOUT
+seconds.
+"""
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db.models import F
+from django.utils.functional import cached_property
+
+from .models import User
+
+SALT = "main.tokens"
+
+
+def options():
+    defaults = {"ENABLED": False, "MAX_AGE": 86400 * 30, "CACHE_ALIAS": "default", "VERSION_CACHE_TIMEOUT": 60}
+    return {**defaults, **getattr(settings, "SIGNED_AUTH_TOKENS", {})}
+
+
+def is_signed_token(value):
+    # Legacy AuthToken values are token_urlsafe() strings, which never contain ":"
+    return ":" in value
+
+
+def issue(user):
+    return signing.dumps({"u": str(user.pk), "v": user.token_version}, salt=SALT, compress=False)
+
+
+def verify(value):
+    """The TokenUser for a valid, unexpired, unrevoked token, else None."""
+    payload = load(value)
+    if payload is None:
+        return None
+    user_id, version = payload
+    current = current_version(user_id)
+    if current is None or current != version:
+        return None
+    return TokenUser(user_id, version)
+
+
+async def averify(value):
+    """Async verify(), for async views."""
+    payload = load(value)
+    if payload is None:
+        return None
+    user_id, version = payload
+    current = await acurrent_version(user_id)
+    if current is None or current != version:
+        return None
+    return TokenUser(user_id, version)
+
+
+def load(value):
+    """(user_id, version) from a token with a valid signature that hasn't expired, else None."""
+    try:
+        payload = signing.loads(value, salt=SALT, max_age=options()["MAX_AGE"])
+        return uuid.UUID(payload["u"]), payload["v"]
+    except (signing.BadSignature, TypeError, KeyError, ValueError):
+        return None
+
+
+def version_key(user_id):
+    return f"token_version:{user_id}"
+
+
+def version_cache():
+    return caches[options()["CACHE_ALIAS"]]
+
+
+def current_version(user_id):
+    """The user's token_version, from the cache when possible; None if the user is gone."""
+    cache = version_cache()
+    version = cache.get(version_key(user_id))
+    if version is None:
+        version = User.objects.filter(pk=user_id).values_list("token_version", flat=True).first()
+        if version is not None:
+            cache.set(version_key(user_id), version, options()["VERSION_CACHE_TIMEOUT"])
+    return version
+
+
+async def acurrent_version(user_id):
+    cache = version_cache()
+    version = await cache.aget(version_key(user_id))
+    if version is None:
+        version = await User.objects.filter(pk=user_id).values_list("token_version", flat=True).afirst()
+        if version is not None:
+            await cache.aset(version_key(user_id), version, options()["VERSION_CACHE_TIMEOUT"])
+    return version
+
+
+def revoke(user_id):
+    """
+    Invalidate every signed token issued to the user so far, on every
+    device. See the module docstring for when other workers notice.
+    """
+    User.objects.filter(pk=user_id).update(token_version=F("token_version") + 1)
+    version_cache().delete(version_key(user_id))
+
+
+class TokenUser:
+    """
+    The principal behind a signed token: just the user id until a view asks
+    for more, at which point the User row is loaded once.
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, token_version):
+        self.user_id = user_id
+        self.token_version = token_version
+
+    @property
+    def pk(self):
+        return self.user_id
+
+    @cached_property
+    def user(self):
+        return User.objects.get(pk=self.user_id)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __str__(self):
+        return str(self.user_id)
@@ -1,15 +1,33 @@
+import csv
+import io
+import json
+import zlib
 from decimal import Decimal
 
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
-from django.shortcuts import get_object_or_404
-from django.db.models import F
-
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db import IntegrityError, router, transaction
+from django.db.models import F, Count, Max
+
+from . import inventory, metrics, tokens
+from .asyncviews import AsyncReadMixin
+from .cache import catalog_cache
+from .conditional import conditional_response, latest, make_etag, set_validators
+from .fastserializers import FastListSerializer, render_json
 from .models import *
+from .pagination import ItemsCursorPagination, SearchPagination
+from .search import search_item_ids, search_terms
 from .serializers import *
+from .throttling import ClientIPThrottle, UsernameThrottle
+
+SIGNED_TOKEN_COOKIE = 'auth_signed_token'
 
 
 class CustomTokenAuthentication(TokenAuthentication):
@@ -19,28 +37,83 @@ class CustomTokenAuthentication(TokenAuthentication):
         return AuthToken
 
     def authenticate(self, request):
-        # First try Authorization header
+        for value in self.get_token_values(request):
+            result = self.authenticate_token(value)
+            if result is not None:
+                return result
+        return None
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views (main.asyncviews)."""
+        for value in self.get_token_values(request):
+            result = await self.aauthenticate_token(value)
+            if result is not None:
+                return result
+        return None
+
+    def get_token_values(self, request):
+        """Tokens to try, in order: the Authorization header's alone, else the cookies."""
         auth = request.META.get('HTTP_AUTHORIZATION', '').split()
         if auth and auth[0].lower() == self.keyword.lower() and len(auth) == 2:
-            try:
-                token_obj = AuthToken.objects.get(token=auth[1])
-                return (token_obj.user, token_obj)
-            except AuthToken.DoesNotExist:
+            return [auth[1]]
+
+        # The signed cookie first; the legacy one still counts when the signed
+        # token is rejected (expired, revoked, or signed tokens switched off)
+        cookies = (request.COOKIES.get(SIGNED_TOKEN_COOKIE), request.COOKIES.get('auth_token'))
+        return [value for value in cookies if value]
+
+    def authenticate_token(self, value):
+        if tokens.is_signed_token(value):
+            # Verified without touching the database; the User row is only
+            # loaded if a view needs more than its id.
+            if not tokens.options()['ENABLED']:
                 return None
-        
-        # Fall back to cookie-based token
-        token_value = request.COOKIES.get('auth_token')
-        if token_value:
-            try:
-                token_obj = AuthToken.objects.get(token=token_value)
-                return (token_obj.user, token_obj)
-            except AuthToken.DoesNotExist:
+            principal = tokens.verify(value)
+            return (principal, value) if principal is not None else None
+        try:
+            token_obj = AuthToken.objects.select_related('user').get(token=value)
+            return (token_obj.user, token_obj)
+        except AuthToken.DoesNotExist:
+            return None
+
+    async def aauthenticate_token(self, value):
+        if tokens.is_signed_token(value):
+            if not tokens.options()['ENABLED']:
                 return None
-        
-        return None
+            principal = await tokens.averify(value)
+            return (principal, value) if principal is not None else None
+        try:
+            token_obj = await AuthToken.objects.select_related('user').aget(token=value)
+            return (token_obj.user, token_obj)
+        except AuthToken.DoesNotExist:
+            return None
+
+
+def set_auth_cookies(response, user, token):
+    """Set the legacy token cookie and, when enabled, the signed token cookie next to it."""
+    response.set_cookie(
+        key='auth_token',
+        value=token.token,
+        httponly=True,
+        samesite='Strict',
+        max_age=86400 * 30  # 30 days
+    )
+    if tokens.options()['ENABLED']:
+        response.set_cookie(
+            key=SIGNED_TOKEN_COOKIE,
+            value=tokens.issue(user),
+            httponly=True,
+            samesite='Strict',
+            max_age=tokens.options()['MAX_AGE']
+        )
+    return response
 
 
 class LoginAPIView(APIView):
+    # Credential stuffing is refused before the User lookup (main.throttling)
+    throttle_classes = (ClientIPThrottle, UsernameThrottle)
+    throttle_scope = 'login'
+
     def post(self, request):
         username = request.data.get('username')
         password = request.data.get('user_password')
@@ -79,18 +152,13 @@ class LoginAPIView(APIView):
             status=status.HTTP_200_OK
         )
         
-        # Set token as HTTP-only cookie
-        response.set_cookie(
-            key='auth_token',
-            value=token.token,
-            httponly=True,
-            samesite='Strict',
-            max_age=86400 * 30  # 30 days
-        )
-        
-        return response
+        # Set tokens as HTTP-only cookies
+        return set_auth_cookies(response, user, token)
 
 class RegisterAPIView(APIView):
+    throttle_classes = (ClientIPThrottle, UsernameThrottle)
+    throttle_scope = 'register'
+
     def post(self, request):
         username = request.data.get('username')
         password = request.data.get('user_password')
@@ -123,15 +191,7 @@ class RegisterAPIView(APIView):
             status=status.HTTP_201_CREATED
         )
         
-        response.set_cookie(
-            key='auth_token',
-            value=token.token,
-            httponly=True,
-            samesite='Strict',
-            max_age=86400 * 30  # 30 days
-        )
-        
-        return response
+        return set_auth_cookies(response, user, token)
 
 
 class LogoutAPIView(APIView):
@@ -143,18 +203,135 @@ class LogoutAPIView(APIView):
             {'message': 'Logout successful'},
             status=status.HTTP_200_OK
         )
-        
-        # Delete the authentication cookie
+
+        # Signed tokens cannot be deleted server-side; revoke them instead.
+        # This signs the user out on every device (see main.tokens).
+        if tokens.options()['ENABLED']:
+            tokens.revoke(request.user.pk)
+
+        # Delete the authentication cookies
         response.delete_cookie('auth_token')
-        
+        response.delete_cookie(SIGNED_TOKEN_COOKIE)
+
         return response
 
 
-class AllItemsAPIView(APIView):
+ITEM_COLUMNS = serializer_columns(ItemsSerializer)
+
+
+def json_response(request, content, **kwargs):
+    """Response for already rendered JSON; re-rendered only for other renderers (browsable API)."""
+    if request.accepted_renderer.format == 'json':
+        return HttpResponse(content, content_type='application/json', **kwargs)
+    return Response(json.loads(content), **kwargs)
+
+
+def catalog_response(request, entry, cache_status):
+    """Serve a cached catalog entry (``content``, ``etag``, ``last_modified``), honouring conditional headers."""
+    not_modified = conditional_response(request, entry['etag'], entry['last_modified'])
+    if not_modified is not None:
+        return not_modified
+    response = json_response(request, entry['content'], headers={'X-Cache': cache_status})
+    return set_validators(response, entry['etag'], entry['last_modified'])
+
+
+class AllItemsAPIView(AsyncReadMixin, APIView):
+    pagination_class = ItemsCursorPagination
+    # GETs may be served from a read replica (main.routers)
+    read_replica = True
+    # Read-only twin of ItemsSerializer for the listing; None uses ItemsSerializer
+    fast_list_serializer = FastListSerializer(ItemsSerializer)
+
     def get(self, request):
-        items = Items.objects.all()
-        serializer = ItemsSerializer(items, many=True)
-        return Response(serializer.data)
+        response = self.begin(request)
+        if response is None:
+            # Validate before serializing anything: row count and latest change
+            response = self.validate(
+                request,
+                Items.objects.aggregate(count=Count('id'), last_updated=Max('updated_at')),
+                ItemTombstone.objects.aggregate(last=Max('deleted_at'))['last'],
+            )
+        if response is not None:
+            return response
+
+        page = self.paginator.paginate_queryset(self.items, request, view=self)
+        deleted = self.deleted_since(request)
+        return self.finish(request, page, None if deleted is None else list(deleted))
+
+    async def aget(self, request):
+        # The catalog cache is in memory (or on local disk): begin() needs no thread
+        response = self.begin(request)
+        if response is None:
+            response = self.validate(
+                request,
+                await Items.objects.aaggregate(count=Count('id'), last_updated=Max('updated_at')),
+                (await ItemTombstone.objects.aaggregate(last=Max('deleted_at')))['last'],
+            )
+        if response is not None:
+            return response
+
+        page = await self.paginator.apaginate_queryset(self.items, request, view=self)
+        deleted = self.deleted_since(request)
+        return self.finish(request, page, None if deleted is None else [tombstone async for tombstone in deleted])
+
+    def begin(self, request):
+        """
+        The steps of get() and aget() before the first query. Returns the
+        response for invalid parameters or a cache hit, else None.
+        """
+        self.params = ItemListQuerySerializer(data=request.query_params)
+        if not self.params.is_valid():
+            return Response(self.params.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Page links are absolute, so the cache key includes the host
+        self.cache_key = 'item_list:' + request.build_absolute_uri()
+        cached = catalog_cache.get(self.cache_key)
+        if cached is not None:
+            return catalog_response(request, cached, 'HIT')
+        self.paginator, self.items = self.paginate(self.params)
+        return None
+
+    def validate(self, request, stats, last_deleted):
+        """Set the page's validators from the catalog's stats; the 304 response if the client's are current."""
+        self.last_modified = latest(stats['last_updated'], last_deleted)
+        self.etag = make_etag(stats['count'], self.last_modified and self.last_modified.isoformat(), self.cache_key)
+        return conditional_response(request, self.etag, self.last_modified)
+
+    def deleted_since(self, request):
+        """The tombstones to report with this page, None if there are none to report."""
+        since = self.params.validated_data.get('since')
+        # Deletions are reported once, on the first page of the sync
+        if since is None or request.query_params.get(self.paginator.cursor_query_param):
+            return None
+        return ItemTombstone.objects.filter(deleted_at__gt=since)
+
+    def finish(self, request, page, deleted):
+        data = self.paginator.get_paginated_response(self.serialize(page)).data
+        if self.params.validated_data.get('since') is not None:
+            if deleted is not None:
+                data['deleted'] = ItemTombstoneSerializer(deleted, many=True).data
+            data['last_modified'] = self.last_modified
+        return self.cache_page(request, self.cache_key, data, self.etag, self.last_modified)
+
+    def paginate(self, params):
+        """The paginator and the rows it pages through."""
+        paginator = self.pagination_class()
+        paginator.ordering = params.validated_data['ordering']
+        items = Items.objects.filter(**params.validated_data['filters'])
+        if self.fast_list_serializer is not None:
+            return paginator, self.fast_list_serializer.rows(items)
+        # Only load the columns the serializer emits
+        return paginator, items.only(*ITEM_COLUMNS)
+
+    def serialize(self, page):
+        if self.fast_list_serializer is not None:
+            return self.fast_list_serializer.to_representation(page)
+        return ItemsSerializer(page, many=True).data
+
+    def cache_page(self, request, cache_key, data, etag, last_modified):
+        entry = {'content': render_json(data), 'etag': etag, 'last_modified': last_modified}
+        catalog_cache.set(cache_key, entry)
+        return catalog_response(request, entry, 'MISS')
 
     def post(self, request):
         serializer = ItemsSerializer(data=request.data)
@@ -164,14 +341,192 @@ class AllItemsAPIView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ItemDetailAPIView(APIView):
+class ItemSearchAPIView(APIView):
+    pagination_class = SearchPagination
+    read_replica = True
+    fast_list_serializer = FastListSerializer(ItemsSerializer)
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        if not search_terms(query):
+            return Response({'error': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = 'item_search:' + request.build_absolute_uri()
+        content = catalog_cache.get(cache_key)
+        if content is not None:
+            return json_response(request, content, headers={'X-Cache': 'HIT'})
+
+        paginator = self.pagination_class()
+        using = router.db_for_read(Items)
+        ids = paginator.paginate_ids(lambda limit, offset: search_item_ids(query, limit, offset, using=using), request)
+        fast = self.fast_list_serializer
+        if fast is not None:
+            rows = {row.id: row for row in fast.rows(Items.objects.filter(id__in=ids).order_by())}
+            results = fast.to_representation(rows[item_id] for item_id in ids if item_id in rows)
+        else:
+            items = Items.objects.only(*ITEM_COLUMNS).in_bulk(ids)
+            results = ItemsSerializer([items[item_id] for item_id in ids if item_id in items], many=True).data
+        content = render_json(paginator.get_paginated_response(results).data)
+        catalog_cache.set(cache_key, content)
+        return json_response(request, content, headers={'X-Cache': 'MISS'})
+
+
+class ItemExportAPIView(APIView):
+    """
+    The whole catalog as NDJSON (default) or CSV (``?type=csv``), streamed
+    in id order with ItemsSerializer's fields.
+
+    Rows are read in keyset chunks (``id > last id``, one indexed query
+    each) and every chunk is written out as soon as it is read, so memory
+    use doesn't depend on the catalog size. Under ASGI the response is an
+    async iterator fetching each chunk through sync_to_async; a sync one
+    would be collected whole before the first byte is sent. Pass
+    ``?after_id=`` with the last id received to resume an interrupted
+    export. Compressed with gzip on the fly when the client accepts it.
+    """
+    fast_list_serializer = FastListSerializer(ItemsSerializer)
+    read_replica = True
+    chunk_size = 2000
+
+    def get(self, request):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in ('ndjson', 'csv'):
+            return Response({'error': 'type must be ndjson or csv'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            after_id = int(request.query_params.get('after_id', 0))
+        except ValueError:
+            return Response({'error': 'after_id must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        fast = self.fast_list_serializer
+        queryset = fast.rows(Items.objects.order_by('id'))
+        # Rows are read after the view returns; pin the database chosen now
+        queryset = queryset.using(queryset.db)
+        gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+        encoder = ExportEncoder(export_type, [key for key, _, _ in fast.plan], gzipped)
+
+        def fetch(after_id):
+            rows = list(queryset.filter(id__gt=after_id)[:self.chunk_size])
+            # A short chunk is the last one
+            return (rows[-1].id if len(rows) == self.chunk_size else None), fast.to_representation(rows)
+
+        if isinstance(request._request, ASGIRequest):
+            content = self.astream(fetch, after_id, encoder)
+        else:
+            content = self.stream(fetch, after_id, encoder)
+        content_type = 'application/x-ndjson' if export_type == 'ndjson' else 'text/csv; charset=utf-8'
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="catalog.{export_type}"'
+        response['Vary'] = 'Accept-Encoding'
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    def stream(self, fetch, after_id, encoder):
+        yield encoder.start()
+        while after_id is not None:
+            after_id, rows = fetch(after_id)
+            yield encoder.encode(rows)
+        yield encoder.finish()
+
+    async def astream(self, fetch, after_id, encoder):
+        afetch = sync_to_async(fetch)
+        yield encoder.start()
+        while after_id is not None:
+            after_id, rows = await afetch(after_id)
+            yield encoder.encode(rows)
+        yield encoder.finish()
+
+
+class ExportEncoder:
+    """Turns chunks of serialized rows into the bytes of an NDJSON or CSV export, gzipped if asked."""
+
+    def __init__(self, export_type, fields, gzipped):
+        self.export_type = export_type
+        self.fields = fields
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzipped else None  # wbits 31: gzip container
+        self.json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+        self.buffer = io.StringIO()
+        self.csv = csv.writer(self.buffer)
+
+    def start(self):
+        if self.export_type == 'csv':
+            self.csv.writerow(self.fields)
+        return self.output(self.take())
+
+    def encode(self, rows):
+        if self.export_type == 'ndjson':
+            # As DRF's JSONRenderer does, keep the two JS line separators escaped
+            text = ''.join(
+                self.json.encode(row).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029') + '\n' for row in rows
+            )
+        else:
+            self.csv.writerows(
+                [json.dumps(value, separators=(',', ':')) if isinstance(value, (dict, list)) else value for value in row.values()]
+                for row in rows
+            )
+            text = self.take()
+        return self.output(text)
+
+    def finish(self):
+        return self.compressor.flush() if self.compressor else b''
+
+    def take(self):
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def output(self, text):
+        data = text.encode('utf-8')
+        return self.compressor.compress(data) if self.compressor else data
+
+
+class ItemDetailAPIView(AsyncReadMixin, APIView):
+    read_replica = True
+
     def get_object(self, id):
         return get_object_or_404(Items, id=id)
 
     def get(self, request, id):
-        item = self.get_object(id)
+        response = self.cached(request, id)
+        if response is None:
+            response = self.validate(request, id, self.updated_at(id).first())
+        if response is not None:
+            return response
+        return self.cache_item(request, self.cache_key, self.get_object(id))
+
+    async def aget(self, request, id):
+        response = self.cached(request, id)
+        if response is None:
+            response = self.validate(request, id, await self.updated_at(id).afirst())
+        if response is not None:
+            return response
+        return self.cache_item(request, self.cache_key, await aget_object_or_404(Items, id=id))
+
+    def cached(self, request, id):
+        self.cache_key = f'item_detail:{id}'
+        cached = catalog_cache.get(self.cache_key)
+        if cached is not None:
+            return catalog_response(request, cached, 'HIT')
+        return None
+
+    def updated_at(self, id):
+        return Items.objects.filter(id=id).values_list('updated_at', flat=True)
+
+    def validate(self, request, id, last_modified):
+        """The 304 response if the client's copy of the item is current, else None."""
+        if last_modified is None:
+            raise Http404
+        return conditional_response(request, make_etag(id, last_modified.isoformat()), last_modified)
+
+    def cache_item(self, request, cache_key, item):
         serializer = ItemsSerializer(item)
-        return Response(serializer.data)
+        # The row may have changed since the validator lookup
+        etag = make_etag(item.id, item.updated_at.isoformat())
+        content = render_json(serializer.data)
+        entry = {'content': content, 'etag': etag, 'last_modified': item.updated_at}
+        catalog_cache.set(cache_key, entry)
+        return catalog_response(request, entry, 'MISS')
 
     def put(self, request, id):
         item = self.get_object(id)
@@ -187,17 +542,21 @@ class ItemDetailAPIView(APIView):
         return Response({'message': 'Item deleted successfully'}, status=status.HTTP_200_OK)
 
 
-class CartAPIView(APIView):
+class CartAPIView(AsyncReadMixin, APIView):
     permission_classes = (IsAuthenticated,)
     authentication_classes = (CustomTokenAuthentication,)
 
     def get(self, request):
-        user = request.user
-        cart, _ = Cart.objects.get_or_create(user=user)
+        cart = Cart.objects.for_user(request.user)
         # Use CartSerializer for consistent response
         serializer = CartSerializer(cart, context={"request": request})
         return Response(serializer.data)
 
+    async def aget(self, request):
+        cart = await Cart.objects.afor_user(request.user)
+        serializer = CartSerializer(cart, context={"request": request})
+        return Response(serializer.data)
+
     def post(self, request):
         slug = request.data.get('slug')
         try:
@@ -205,39 +564,143 @@ class CartAPIView(APIView):
         except (TypeError, ValueError):
             return Response({'error': 'quantity must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if quantity < 1:
+            return Response({'error': 'quantity must be >= 1'}, status=status.HTTP_400_BAD_REQUEST)
+
         if not slug:
             return Response({'error': 'slug is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        item = get_object_or_404(Items, slug=slug)
-        user = request.user
-        cart, _ = Cart.objects.get_or_create(user=user)
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.ensure_for_user(request.user)
+                if not CartItem.objects.add(cart, slug, quantity):
+                    raise Http404('No Items matches the given query.')
+        except inventory.OutOfStock:
+            return Response({'error': f'not enough stock for {slug}'}, status=status.HTTP_409_CONFLICT)
+
+        serializer = CartSerializer(cart.load_lines(), context={"request": request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, item=item, defaults={'quantity': quantity})
-        if not created:
-            cart_item.quantity = F('quantity') + quantity
-            cart_item.save()
-            cart_item.refresh_from_db()
+    def patch(self, request):
+        """Batch update: a list of {slug, quantity, op} entries, applied atomically."""
+        entries = request.data.get('items') if isinstance(request.data, dict) else request.data
+        serializer = CartOperationSerializer(data=entries, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        operations = serializer.validated_data
 
-        serializer = CartSerializer(cart, context={"request": request})
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        slugs = {op['slug'] for op in operations}
+        item_ids = dict(Items.objects.filter(slug__in=slugs).values_list('slug', 'id'))
+        missing = sorted(slugs - item_ids.keys())
+        if missing:
+            return Response({'error': f"unknown item slugs: {', '.join(missing)}"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.ensure_for_user(request.user)
+                cart.apply_changes([(item_ids[op['slug']], op['op'], op['quantity']) for op in operations])
+        except inventory.OutOfStock as exc:
+            slugs = sorted(slug for slug, item_id in item_ids.items() if item_id in exc.item_ids)
+            return Response({'error': f"not enough stock for {', '.join(slugs)}"}, status=status.HTTP_409_CONFLICT)
+
+        serializer = CartSerializer(cart.load_lines(), context={"request": request})
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
     def delete(self, request):
         slug = request.data.get('slug')
-        user = request.user
-        cart, _ = Cart.objects.get_or_create(user=user)
+        # Nothing to delete from a cart that was never created; the lines
+        # are loaded once the deletion is done
+        cart = Cart.objects.for_user(request.user, create=False, lines=False)
+        if cart is None:
+            if slug:
+                return Response({'error': 'item not in cart'}, status=status.HTTP_404_NOT_FOUND)
+            return Response(status=status.HTTP_204_NO_CONTENT)
 
         if slug:
             item = get_object_or_404(Items, slug=slug)
-            cart_item = CartItem.objects.filter(cart=cart, item=item).first()
-            if not cart_item:
+            if not cart.remove_item(item):
                 return Response({'error': 'item not in cart'}, status=status.HTTP_404_NOT_FOUND)
-            cart_item.delete()
-            serializer = CartSerializer(cart, context={"request": request})
+            serializer = CartSerializer(cart.load_lines(), context={"request": request})
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         # clear whole cart
-        cart.cart_items.all().delete()
-        serializer = CartSerializer(cart, context={"request": request})
+        cart.clear()
+        serializer = CartSerializer(cart.load_lines(), context={"request": request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class CartSummaryAPIView(APIView):
+    """Item count and total of the cart from its stored totals: one row, no lines."""
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CustomTokenAuthentication,)
+
+    def get(self, request):
+        summary = (
+            Cart.objects.filter(user_id=request.user.pk)
+            .values('item_count', 'subtotal', 'version', 'updated_at')
+            .first()
+        ) or {'item_count': 0, 'subtotal': Decimal('0.00'), 'version': 0, 'updated_at': None}
+
+        etag = make_etag('cart', request.user.pk, summary['version'])
+        not_modified = conditional_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        response = Response({
+            'item_count': summary['item_count'],
+            'total_price': str(summary['subtotal']),
+            'version': summary['version'],
+            'updated_at': summary['updated_at'],
+        })
+        response['Cache-Control'] = 'private, no-cache'
+        return set_validators(response, etag)
+
+
+class CheckoutAPIView(APIView):
+    """
+    POST /checkout/: place an order from the cart.
+
+    Send an ``Idempotency-Key`` header to make retries safe: repeating a
+    request with the same key returns the order it placed (200) instead of
+    placing another one (201).
+    """
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CustomTokenAuthentication,)
+
+    def post(self, request):
+        key = request.headers.get('Idempotency-Key', '').strip() or None
+        if key is not None and len(key) > 64:
+            return Response({'error': 'Idempotency-Key must be at most 64 characters'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            order, created = Order.objects.place(request.user, idempotency_key=key)
+        except CartEmpty:
+            return Response({'error': 'cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            # place() replays a key it finds, so an order with the key now
+            # means a concurrent request with the same key won: return its
+            # order. Any other integrity error is a real failure.
+            order = None
+            if key is not None:
+                order = Order.objects.filter(user_id=request.user.pk, idempotency_key=key).first()
+            if order is None:
+                raise
+            order, created = order.load_lines(), False
+
+        serializer = OrderSerializer(order, context={"request": request})
+        response = Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+        if not created:
+            response['Idempotent-Replayed'] = 'true'
+        return response
+
+
+class MetricsAPIView(APIView):
+    """Prometheus scrape target, for clients in METRICS['ALLOWED_NETWORKS'] only."""
+    authentication_classes = []
+    permission_classes = (metrics.ScrapePermission,)
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.render(metrics.collect()),
+            content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
@@ -0,0 +1,155 @@
+"""
+Warm-up of a freshly loaded app, before it serves its first request.
+
+sbf/wsgi.py runs warm_up() once the app is set up. With gunicorn's
+preload_app (gunicorn.conf.py) that happens once, in the master, and every
+worker forks with the modules, URL patterns, serializer fields and cached
+catalog pages already in memory, shared copy-on-write; without it, each
+worker warms itself up before it accepts connections. Either way the
+first requests after a deploy no longer pay for it.
+
+The steps: import MODULES (the views and what they pull in), compile the
+URL patterns, build every serializer's fields and the FastListSerializer
+plans, optionally render PREFILL_URLS into the catalog cache, then close
+the database connections, which must not be shared with forked workers.
+The time of each step is logged as a report; ``manage.py warmup`` prints
+it for a cold process.
+"""
+import importlib
+import logging
+import sys
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.test import RequestFactory
+from django.urls import URLResolver, get_resolver, resolve
+from rest_framework import serializers
+
+logger = logging.getLogger("main.warmup")
+
+
+def options():
+    defaults = {
+        "ENABLED": True,
+        "MODULES": ["main.serializers", "main.views", settings.ROOT_URLCONF],
+        # Catalog URLs to render into the cache, e.g. "https://shop.example.com/item_list/"
+        "PREFILL_URLS": [],
+    }
+    return {**defaults, **getattr(settings, "WARMUP", {})}
+
+
+def warm_up(prefill=True):
+    """Run every step; returns the report, ``[(step, seconds)]``."""
+    opts = options()
+    report = []
+
+    def step(name, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        report.append((name if result is None else f"{name} ({result})", time.perf_counter() - started))
+
+    for module in opts["MODULES"]:
+        step(f"import {module}", import_module, module)
+    step("compile URL patterns", compile_urls)
+    step("serializer fields", build_serializer_fields)
+    step("fast list plans", build_fast_list_plans)
+    if prefill:
+        for url in opts["PREFILL_URLS"]:
+            step(f"prefill {url}", prefill_url, url)
+    step("close database connections", connections.close_all)
+    return report
+
+
+def log_report(report, setup_seconds=None):
+    lines = [f"  {seconds * 1000:8.1f}ms  {name}" for name, seconds in report]
+    if setup_seconds is not None:
+        lines.insert(0, f"  {setup_seconds * 1000:8.1f}ms  django.setup (settings, apps, models, admin)")
+    total = sum(seconds for _, seconds in report) + (setup_seconds or 0)
+    logger.info("Warm-up took %.1fms:\n%s", total * 1000, "\n".join(lines))
+
+
+def import_module(name):
+    if name in sys.modules:
+        return "already imported"
+    importlib.import_module(name)
+    return None
+
+
+def url_patterns():
+    """Every pattern of the URLconf, included ones too."""
+    pending = list(get_resolver().url_patterns)
+    while pending:
+        pattern = pending.pop()
+        if isinstance(pattern, URLResolver):
+            pending.extend(pattern.url_patterns)
+        yield pattern
+
+
+def compile_urls():
+    # Builds the reverse() lookup tables
+    get_resolver().reverse_dict
+    count = 0
+    for pattern in url_patterns():
+        # Patterns compile their regex on first use
+        pattern.pattern.regex
+        count += 1
+    return f"{count} patterns"
+
+
+def build_serializer_fields():
+    from . import serializers as app_serializers
+
+    count = 0
+    for obj in vars(app_serializers).values():
+        if isinstance(obj, type) and issubclass(obj, serializers.Serializer) and obj.__module__ == app_serializers.__name__:
+            # ModelSerializers introspect their model here, filling its _meta caches
+            obj().fields
+            count += 1
+    return f"{count} serializers"
+
+
+def build_fast_list_plans():
+    count = 0
+    view_classes = {getattr(pattern.callback, "view_class", None) for pattern in url_patterns() if hasattr(pattern, "callback")}
+    for view_class in view_classes:
+        fast = getattr(view_class, "fast_list_serializer", None)
+        if fast is not None:
+            fast.plan
+            count += 1
+    return f"{count} views"
+
+
+def prefill_url(url):
+    """Render a catalog GET straight through its view (no middleware), as a request to ``url`` would."""
+    parts = urlsplit(url)
+    request = RequestFactory().get(
+        parts.path, parse_qsl(parts.query), HTTP_HOST=parts.netloc, secure=parts.scheme == "https",
+    )
+    match = resolve(parts.path)
+    view = match.func
+    if iscoroutinefunction(view):
+        view = async_to_sync(view)
+    response = view(request, *match.args, **match.kwargs)
+    if hasattr(response, "render"):
+        response.render()
+    return f"{response.status_code} {response.get('X-Cache', '')}".strip()
+
+
+def connect():
+    """
+    Open the persistent or pooled database connections of a freshly forked
+    worker, so its first request doesn't wait for them. Connections closed
+    after every request (CONN_MAX_AGE 0) are left alone.
+    """
+    for alias in connections:
+        config = connections[alias].settings_dict
+        if config["CONN_MAX_AGE"] == 0 and not config["OPTIONS"].get("pool"):
+            continue
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            # A replica that is down; main.routers skips it
+            logger.warning("Could not connect to database %r on worker start", alias)
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sbf.settings')
+# Catalog and cart reads as native async views (main.asyncviews)
+os.environ.setdefault('ASYNC_READ_VIEWS', '1')
 
 application = get_asgi_application()
@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
+from . import databases
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -61,6 +65,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.MetricsMiddleware',
+    'main.timing.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -68,6 +74,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Last: its process_exception must see a failed replica query first
+    'main.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'sbf.urls'
@@ -89,15 +97,178 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'sbf.wsgi.application'
 
+# Warm-up when sbf/wsgi.py loads (main.warmup): imports, URL patterns and
+# serializer fields, and the catalog pages in WARMUP_PREFILL_URLS (comma
+# separated, with scheme and host, e.g. https://shop.example.com/item_list/).
+WARMUP = {
+    'ENABLED': os.environ.get('WARMUP', '1') == '1',
+    'PREFILL_URLS': [url.strip() for url in os.environ.get('WARMUP_PREFILL_URLS', '').split(',') if url.strip()],
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # The warm-up report
+        'main.warmup': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# Serve catalog and cart GETs from native async views (main.asyncviews).
+# sbf/asgi.py turns this on; under WSGI the async views would only add an
+# event loop per request.
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', '0') == '1'
+
+
+# Catalog listing page size (clients may ask for up to CATALOG_MAX_PAGE_SIZE
+# with ?page_size=)
+CATALOG_PAGE_SIZE = 50
+CATALOG_MAX_PAGE_SIZE = 200
+
+# Carts untouched for this long give their reserved stock back
+# (`manage.py release_expired_carts`, run from cron)
+CART_RESERVATION_MINUTES = 60
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Catalog responses (main.cache.CatalogCache). Local memory is per worker;
+    # switch to django.core.cache.backends.filebased.FileBasedCache with a
+    # shared LOCATION to share entries and invalidations between workers.
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+        },
+    },
+    # State every worker must see: the request timing sample rate
+    # (main.timing) and users' token versions (main.tokens). Must not be
+    # process-local; any directory the workers of a host share will do.
+    'control': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CONTROL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sbf-control')),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Rate-limit buckets (main.throttling). Per worker; for limits shared by
+    # the workers of a host use django.core.cache.backends.filebased.FileBasedCache
+    # with a LOCATION in /dev/shm.
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'throttle',
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
+
+CATALOG_CACHE = {
+    'ALIAS': 'catalog',
+    # Per-process LRU kept in front of the alias above
+    'LOCAL_MAX_ENTRIES': 256,
+}
+
+
+# Stateless signed auth tokens (main.tokens), issued next to the legacy
+# AuthToken during the migration. Users' token versions are cached in the
+# shared 'control' cache, so a logout (which signs the user out on every
+# device) is seen by all workers at once; with a process-local cache it
+# would take up to VERSION_CACHE_TIMEOUT seconds.
+SIGNED_AUTH_TOKENS = {
+    'ENABLED': True,
+    'MAX_AGE': 86400 * 30,  # 30 days
+    'CACHE_ALIAS': 'control',
+    'VERSION_CACHE_TIMEOUT': 60,
+}
+
+
+# Token-bucket rate limits of the login and registration views
+# (main.throttling): "burst/period", per client IP and per username.
+THROTTLING = {
+    'CACHE_ALIAS': 'throttle',
+    'RATES': {
+        'login_ip': '30/min',
+        'login_username': '10/min',
+        'register_ip': '10/min',
+        'register_username': '5/min',
+    },
+}
+
+# Per-request query/timing instrumentation (main.timing). The sample rate
+# can be changed at runtime with `manage.py request_timing --sample-rate`,
+# through the 'control' cache.
+REQUEST_TIMING = {
+    'SAMPLE_RATE': 1.0 if DEBUG else 0.0,
+    'CACHE_ALIAS': 'control',
+    'QUERY_BUDGET': 20,
+    'LATENCY_BUDGET_MS': 500,
+}
+
+# Request metrics served at /metrics (main.metrics). With several worker
+# processes, point DIR at a directory they share so /metrics aggregates
+# all of them; clear it when deploying. Only clients in ALLOWED_NETWORKS
+# (METRICS_ALLOWED_NETWORKS, comma separated addresses or CIDR ranges)
+# may scrape; behind a proxy, REMOTE_ADDR is the proxy's address.
+METRICS = {
+    'DIR': os.environ.get('METRICS_DIR'),
+    'FLUSH_SECONDS': 1.0,
+    'ALLOWED_NETWORKS': [
+        network.strip() for network in os.environ.get('METRICS_ALLOWED_NETWORKS', '127.0.0.1,::1').split(',') if network.strip()
+    ],
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+#
+# DATABASE_URL sets the primary (db.sqlite3 when unset) and
+# DATABASE_REPLICA_URLS, comma separated, read replicas for the catalog
+# views (see sbf/databases.py and main/routers.py). Two SQLite files work
+# for trying it out locally; leave DATABASE_REPLICA_URLS unset when running
+# the tests.
+
+# DATABASE_PROFILE: "stock" (Django's defaults), "persistent" or "pooled"
+# connections; see sbf/databases.py.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'stock')
+
+DATABASES = databases.from_env(os.environ, default=f'sqlite:///{BASE_DIR / "db.sqlite3"}', profile=DATABASE_PROFILE)
+
+# The SQLite test database is a file: in the default shared-cache in-memory
+# database, a writer that meets another one fails at once ("database table
+# is locked") instead of waiting, and the threaded tests need them to wait.
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {'NAME': os.path.join(tempfile.gettempdir(), 'sbf-test.sqlite3')})
+
+# Set on every new SQLite connection unless DATABASE_PROFILE is "stock"
+# (main.apps). WAL lets readers and the writer run concurrently; with WAL,
+# synchronous=NORMAL only syncs at checkpoints and stays corruption-safe.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative: KiB
+}
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+DATABASE_ROUTERS = ['main.routers.ReplicaRouter']
+
+DATABASE_REPLICAS = {
+    # Catalog reads go to the primary for this long after a client's write
+    'STICKY_SECONDS': 5,
+    # A replica that failed is skipped for this long
+    'RETRY_SECONDS': 30,
 }
 
 
@@ -137,6 +308,10 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded pictures and their renditions (main.renditions)
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 from main.views import *
@@ -12,6 +14,14 @@ urlpatterns = [
           AllItemsAPIView.as_view(), name='item_list'),
     path('item_list/',
           AllItemsAPIView.as_view(), name='item_list'),
+    path('items/search/', ItemSearchAPIView.as_view(), name='item_search'),
+    path('items/export/', ItemExportAPIView.as_view(), name='item_export'),
     path('item/<int:id>/', ItemDetailAPIView.as_view(), name='item_detail'),
     path('cart/', CartAPIView.as_view(), name='cart'),
+    path('cart/summary/', CartSummaryAPIView.as_view(), name='cart_summary'),
+    path('checkout/', CheckoutAPIView.as_view(), name='checkout'),
+    path('metrics', MetricsAPIView.as_view(), name='metrics'),
 ]
+
+# Uploads are served by the web server in production
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -8,9 +8,19 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
 import os
+import time
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sbf.settings')
 
+started = time.perf_counter()
 application = get_wsgi_application()
+setup_seconds = time.perf_counter() - started
+
+# Prime the app before it serves; with gunicorn's preload_app this runs in
+# the master, before the workers fork (see gunicorn.conf.py).
+from main import warmup  # noqa: E402
+
+if warmup.options()['ENABLED']:
+    warmup.log_report(warmup.warm_up(), setup_seconds)